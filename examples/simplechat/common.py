@@ -71,7 +71,7 @@ class MessagePacket(peng3dnet.packet.SmartPacket):
                     # Should be handled by the client
                     pass
                 elif command=="/stop":
-                    self.peer.broadcast("Server will shutdown by request of user %s"%getattr(self.peer.clients[cid],"nickname","anonymous"),origin="server",internal=True,exclude_list=[cid])
+                    self.peer.broadcast_chat("Server will shutdown by request of user %s"%getattr(self.peer.clients[cid],"nickname","anonymous"),origin="server",internal=True,exclude_list=[cid])
                     try:
                         print("IP Address of User that shut down the server: %s"%self.peer.clients[cid].conn.getpeername()[0])
                     except Exception:
@@ -88,15 +88,15 @@ class MessagePacket(peng3dnet.packet.SmartPacket):
                             nick = normalize_nickname(args[0])
                             out+="Changed nickname to '%s'"%nick
                             if getattr(self.peer.clients[cid],"nickname","anonymous")!="anonymous":
-                                self.peer.broadcast("%s is now called %s"%(getattr(self.peer.clients[cid],"nickname","anonymous"),nick),origin="server",internal=True,exclude_list=[cid])
+                                self.peer.broadcast_chat("%s is now called %s"%(getattr(self.peer.clients[cid],"nickname","anonymous"),nick),origin="server",internal=True,exclude_list=[cid])
                             else:
-                                self.peer.broadcast("%s has revealed themselves"%nick,"server",internal=True,exclude_list=[cid])
+                                self.peer.broadcast_chat("%s has revealed themselves"%nick,"server",internal=True,exclude_list=[cid])
                             self.peer.clients[cid].nickname=nick
                 elif command=="/whisper":
                     out+="Not yet implemented"
                 elif command=="/anon":
                     if getattr(self.peer.clients[cid],"nickname","anonymous")!="anonymous":
-                        self.peer.broadcast("%s has gone anonymous"%(getattr(self.peer.clients[cid],"nickname","anonymous")),origin="server",internal=True,exclude_list=[cid])
+                        self.peer.broadcast_chat("%s has gone anonymous"%(getattr(self.peer.clients[cid],"nickname","anonymous")),origin="server",internal=True,exclude_list=[cid])
                         self.peer.clients[cid].nickname="anonymous"
                         out+="Gone anonymous"
                     else:
@@ -115,7 +115,7 @@ class MessagePacket(peng3dnet.packet.SmartPacket):
                     self.peer.send_message("chat:message",data,cid)
                 return
             # Redistribute to all clients except origin
-            self.peer.broadcast(message,getattr(self.peer.clients[cid],"nickname","anonymous"),timestamp=msg.get("timestamp",None),exclude_list=[cid])
+            self.peer.broadcast_chat(message,getattr(self.peer.clients[cid],"nickname","anonymous"),timestamp=msg.get("timestamp",None),exclude_list=[cid])
         elif self.peer.is_client:
             data = {"message":"","timestamp":time.time(),"origin":"anonymous","internal":False,"private":False}
             data.update(msg)
@@ -140,4 +140,4 @@ class JoinPacket(peng3dnet.packet.SmartPacket):
         nick = normalize_nickname(msg.get("nickname",self.peer.clients[cid].nickname))
         self.peer.clients[cid].mode = MODE_CHAT
         self.peer.clients[cid].nickname = nick
-        self.peer.broadcast("User %s with IP Address %s joined the server"%(self.peer.clients[cid].nickname,self.peer.clients[cid].conn.getpeername()[0]),"server",internal=True,exclude_list=[cid])
+        self.peer.broadcast_chat("User %s with IP Address %s joined the server"%(self.peer.clients[cid].nickname,self.peer.clients[cid].conn.getpeername()[0]),"server",internal=True,exclude_list=[cid])
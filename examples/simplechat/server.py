@@ -36,13 +36,13 @@ class ClientOnChatServer(peng3dnet.net.ClientOnServer):
         super().on_handshake_complete()
         self.nickname="anonymous"
         print("Handshake with IP %s complete"%self.conn.getpeername()[0])
-        #self.server.broadcast("User with IP Address %s joined the server"%(self.conn.getpeername()[0]),"server",internal=True,exclude_list=[self.cid])
+        #self.server.broadcast_chat("User with IP Address %s joined the server"%(self.conn.getpeername()[0]),"server",internal=True,exclude_list=[self.cid])
     def on_close(self,reason=None):
         if self.conntype=="classic":
-            self.server.broadcast("%s disconnected (%s)"%(getattr(self,"nickname","anonymous"),reason if reason is not None else "unknown"),"server",True)
+            self.server.broadcast_chat("%s disconnected (%s)"%(getattr(self,"nickname","anonymous"),reason if reason is not None else "unknown"),"server",True)
 
 class ChatServer(peng3dnet.ext.ping.PingableServerMixin,peng3dnet.net.Server):
-    def broadcast(self,msg,origin,internal=False,private=False,timestamp=None,exclude_list=None):
+    def broadcast_chat(self,msg,origin,internal=False,private=False,timestamp=None,exclude_list=None):
         if not self.is_server:
             raise RuntimeError("Cannot broadcast from client")
         print("Message: %s"%msg)
@@ -53,9 +53,7 @@ class ChatServer(peng3dnet.ext.ping.PingableServerMixin,peng3dnet.net.Server):
             "private":private,
             "timestamp":timestamp if timestamp is not None else time.time(),
             }
-        for client in self.clients:
-            if exclude_list is not None and client not in exclude_list:
-                self.send_message("chat:message",data,client)
+        self.broadcast("chat:message",data,exclude=exclude_list)
     
     def getPingData(self,msg,cid):
         users = [u for u in self.clients.values() if getattr(u,"nickname","anonymous")!="anonymous"]
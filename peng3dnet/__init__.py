@@ -24,6 +24,8 @@
 
 from .net import *
 from .registry import *
+from .codec import *
+from .compression import *
 from .constants import *
 from .version import *
 from .util import *
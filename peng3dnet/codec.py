@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  codec.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+"""
+This module contains the codecs used to encode and decode the payload of packets.
+
+Every packet type declares the codec used for its payload via its :py:attr:`~peng3dnet.packet.Packet.codec`
+attribute. The ID of the codec is stored in the flags of the packet header, see
+:py:data:`~peng3dnet.constants.FLAG_CODEC_MASK`\ , allowing the receiving side
+to decode the payload without knowing anything about the packet.
+
+Codecs are registered with the :py:class:`~peng3dnet.registry.CodecRegistry` of
+each peer, available as the ``codecs`` attribute of :py:class:`~peng3dnet.net.Server()`
+and :py:class:`~peng3dnet.net.Client()`\ . Custom codecs can be added via
+:py:meth:`Server.register_codec() <peng3dnet.net.Server.register_codec()>` and
+:py:meth:`Client.register_codec() <peng3dnet.net.Client.register_codec()>`\ .
+"""
+
+__all__ = [
+    "Codec",
+    "MsgpackCodec","RawCodec","StructCodec",
+    "KeyTable",
+    ]
+
+import threading
+import struct
+import numbers
+
+try:
+    import msgpack as msgpack
+    _MSGPACK_TYPE = "msgpack-python"
+except ImportError:
+    import umsgpack as msgpack
+    _MSGPACK_TYPE = "umsgpack"
+
+try:
+    import numpy
+except ImportError:
+    HAVE_NUMPY = False
+else:
+    HAVE_NUMPY = True
+
+from .constants import *
+
+# Layout of an encoded ndarray:
+# dtype length (B), dtype string, number of dimensions (B), shape (I per dimension), C-ordered data
+def _pack_ndarray(a):
+    if a.dtype.hasobject or a.dtype.fields is not None:
+        raise TypeError("Only ndarrays with simple dtypes can be sent, not %s"%a.dtype)
+    dt = a.dtype.str.encode("ascii")
+    header = struct.pack("!B%dsB%dI"%(len(dt),a.ndim),len(dt),dt,a.ndim,*a.shape)
+    return header+a.tobytes(order="C")
+
+def _unpack_ndarray(data):
+    dtlen = data[0]
+    dt = numpy.dtype(bytes(data[1:1+dtlen]).decode("ascii"))
+    ndim = data[1+dtlen]
+    shape = struct.unpack_from("!%dI"%ndim,data,2+dtlen)
+    count = 1
+    for n in shape:
+        count*=n
+    # No per-element work, the array is a read-only view of the data
+    return numpy.frombuffer(data,dtype=dt,count=count,offset=2+dtlen+4*ndim).reshape(shape)
+
+if _MSGPACK_TYPE == "umsgpack":
+    if HAVE_NUMPY:
+        _ext_handlers_pack = {numpy.ndarray:lambda a: msgpack.Ext(EXTTYPE_NDARRAY,_pack_ndarray(a))}
+        _ext_handlers_unpack = {EXTTYPE_NDARRAY:lambda ext: _unpack_ndarray(ext.data)}
+    else:
+        _ext_handlers_pack = _ext_handlers_unpack = {}
+    
+    def _packb(data):
+        return msgpack.packb(data,ext_handlers=_ext_handlers_pack)
+    def _unpackb(body):
+        # umsgpack only accepts bytes and bytearray
+        return msgpack.unpackb(bytes(body),ext_handlers=_ext_handlers_unpack)
+else:
+    def _default(obj):
+        # Called by the packer for all types it does not know
+        if HAVE_NUMPY:
+            if isinstance(obj,numpy.ndarray):
+                return msgpack.ExtType(EXTTYPE_NDARRAY,_pack_ndarray(obj))
+            elif isinstance(obj,numpy.generic):
+                return obj.item()
+        raise TypeError("Cannot serialize %r"%(obj,))
+    def _ext_hook(code,data):
+        if code==EXTTYPE_NDARRAY and HAVE_NUMPY:
+            return _unpack_ndarray(data)
+        return msgpack.ExtType(code,data)
+    
+    def _unpackb(body):
+        # Dictionaries may have integer keys, e.g. entity IDs
+        return msgpack.unpackb(body,ext_hook=_ext_hook,strict_map_key=False)
+    def _unpackb_keyed(body,object_hook):
+        return msgpack.unpackb(body,ext_hook=_ext_hook,object_hook=object_hook,strict_map_key=False)
+
+class Codec(object):
+    """
+    Base class for all codecs.
+    
+    Subclasses should override :py:meth:`encode()` and :py:meth:`decode()`\ .
+    
+    A single instance of a codec is used for all packets using it, possibly from
+    multiple threads at once. Codecs should thus not store any per-message state.
+    """
+    def encode(self,data,packet):
+        """
+        Encodes the given data.
+        
+        ``data`` is the message passed to :py:meth:`~peng3dnet.net.Server.send_message()`\ .
+        
+        ``packet`` is the :py:class:`~peng3dnet.packet.Packet` instance the message is sent with.
+        It may be used to access per-packet settings of the codec.
+        
+        Should return a bytes-like object. It is copied before this method is
+        called again from the same thread, allowing codecs to re-use their buffers.
+        """
+        raise NotImplementedError("encode() must be overridden by subclasses")
+    def decode(self,body,packet):
+        """
+        Decodes the given payload.
+        
+        ``body`` is a bytes-like object containing the payload, usually a :py:class:`memoryview`\ .
+        
+        ``packet`` is the :py:class:`~peng3dnet.packet.Packet` instance the message has been received with,
+        or ``None`` if the packet is not registered.
+        
+        The returned object will be passed to the event handlers as the message.
+        """
+        raise NotImplementedError("decode() must be overridden by subclasses")
+
+class MsgpackCodec(Codec):
+    """
+    Default codec, encoding arbitrary messages via :py:mod:`msgpack`\ .
+    
+    If ``msgpack-python`` is installed, a single :py:class:`msgpack.Packer` is
+    re-used per thread to prevent allocations. Otherwise, ``umsgpack`` is used.
+    
+    If :py:mod:`numpy` is available, :py:class:`numpy.ndarray` instances may be
+    contained anywhere within messages. They are encoded as a msgpack extension type with
+    the code :py:data:`~peng3dnet.constants.EXTTYPE_NDARRAY`\ , containing their
+    dtype, shape and data. Received arrays are read-only views of the received data,
+    created without any per-element work. Use :py:meth:`numpy.ndarray.copy()` to get
+    a writable copy. NumPy scalars are sent as their Python equivalent.
+    """
+    def __init__(self):
+        self._local = threading.local()
+    def encode(self,data,packet):
+        if _MSGPACK_TYPE == "msgpack-python":
+            # The packer and its internal buffer are re-used for all packets sent by this thread
+            packer = getattr(self._local,"packer",None)
+            if packer is None:
+                packer = msgpack.Packer(autoreset=False,default=_default)
+                self._local.packer = packer
+            packer.reset()
+            try:
+                packer.pack(data)
+            except Exception:
+                packer.reset()
+                raise
+            return packer.getbuffer()
+        else:
+            return _packb(data)
+    def decode(self,body,packet):
+        return _unpackb(body)
+
+class RawCodec(Codec):
+    """
+    Codec passing through raw binary data.
+    
+    Messages sent with this codec must be :py:class:`bytes`\ , :py:class:`bytearray`
+    or :py:class:`memoryview` objects and are sent without any modification.
+    Memoryviews may have any format, e.g. views of :py:mod:`array` or NumPy arrays,
+    but must be C-contiguous. Received messages are always passed through as a
+    :py:class:`memoryview` of bytes.
+    
+    Large :py:class:`bytes` objects are queued for sending without being copied,
+    as they cannot be modified in the meantime.
+    """
+    def encode(self,data,packet):
+        if not isinstance(data,(bytes,bytearray,memoryview)):
+            raise TypeError("Raw packets can only contain bytes-like data, not %s"%type(data))
+        if isinstance(data,memoryview):
+            if not data.c_contiguous:
+                raise TypeError("Raw packets can only contain C-contiguous memoryviews")
+            # The length of other formats is counted in items, not bytes
+            return data.cast("B")
+        return data
+    def decode(self,body,packet):
+        # Decompressed bodies are bytes, wrap them for consistency
+        return body if isinstance(body,memoryview) else memoryview(body)
+
+class StructCodec(Codec):
+    """
+    Codec encoding a fixed sequence of values via :py:mod:`struct`\ .
+    
+    The packet must have a ``struct`` attribute containing a :py:class:`struct.Struct`
+    instance. Messages must be sequences matching the format of the struct and
+    are received as tuples.
+    
+    If the packet has a ``record`` attribute containing a :py:func:`~collections.namedtuple`
+    type, messages may also be dictionaries and are received as instances of it.
+    
+    If the ``array`` attribute of the packet is true, messages are lists of records
+    packed back-to-back.
+    
+    .. seealso::
+       See :py:class:`~peng3dnet.packet.StructPacket` for a packet type using this codec.
+    """
+    def encode(self,data,packet):
+        st = packet.struct
+        if getattr(packet,"array",False):
+            buf = bytearray(st.size*len(data))
+            for i,rec in enumerate(data):
+                st.pack_into(buf,i*st.size,*self._values(rec,packet))
+            return buf
+        return st.pack(*self._values(data,packet))
+    def decode(self,body,packet):
+        record = getattr(packet,"record",None)
+        if getattr(packet,"array",False):
+            if record is None:
+                return list(packet.struct.iter_unpack(body))
+            return [record._make(rec) for rec in packet.struct.iter_unpack(body)]
+        if record is None:
+            return packet.struct.unpack_from(body)
+        return record._make(packet.struct.unpack_from(body))
+    def _values(self,data,packet):
+        if isinstance(data,dict):
+            return packet.record(**data)
+        return data
+
+class KeyTable(object):
+    """
+    Table mapping common dictionary keys to small integers.
+    
+    Most messages are dictionaries whose keys are often larger than their values.
+    If both sides support it, the server sends a key table during the handshake,
+    built from the :py:attr:`~peng3dnet.packet.Packet.fieldnames` of all registered packets.
+    Afterwards, both sides replace all known keys in messages of packets that declare
+    :py:attr:`~peng3dnet.packet.Packet.fieldnames` with their index in the table, which
+    msgpack encodes as a single byte for the first 128 keys. This is indicated by the
+    :py:data:`~peng3dnet.constants.FLAG_KEYTABLE` flag.
+    
+    The receiving side restores the original keys, event handlers will see the same
+    messages as without the key table.
+    
+    As replaced keys are integers, dictionaries with integer keys cannot be told apart
+    from replaced ones. Messages containing such dictionaries are thus sent without
+    using the key table.
+    
+    .. seealso::
+       See :confval:`net.keytable.enabled` for how to disable the key table.
+    """
+    def __init__(self,keys):
+        self.keys = list(keys)
+        """
+        List of all keys, the index of a key within this list is its replacement.
+        """
+        self.index = {k:i for i,k in enumerate(self.keys)}
+    
+    def replace(self,obj):
+        """
+        Returns a copy of the given message with all known keys of all dictionaries replaced by their index.
+        
+        Dictionaries within lists and tuples are also processed.
+        
+        Raises a :py:exc:`ValueError` if any dictionary has integer keys.
+        """
+        t = type(obj)
+        if t is dict:
+            index = self.index
+            out = {}
+            for k,v in obj.items():
+                if type(k) is not str and isinstance(k,numbers.Integral):
+                    # Would be restored as the key at that index
+                    raise ValueError("Dictionaries with integer keys cannot be sent using the key table")
+                out[index.get(k,k)] = self.replace(v)
+            return out
+        elif t is list or t is tuple:
+            return [self.replace(v) for v in obj]
+        return obj
+    def restore(self,obj):
+        """
+        Reverses :py:meth:`replace()`\ , returning a copy of the given message with all original keys.
+        """
+        t = type(obj)
+        if t is dict:
+            return self._restore_dict(obj)
+        elif t is list:
+            return [self.restore(v) for v in obj]
+        return obj
+    def decode(self,body):
+        """
+        Decodes a msgpack-encoded payload using this table.
+        """
+        if _MSGPACK_TYPE == "umsgpack":
+            # umsgpack does not support hooks, restore the keys afterwards
+            return self.restore(_unpackb(body))
+        return _unpackb_keyed(body,self._restore_map)
+    
+    def _restore_dict(self,d):
+        keys = self.keys
+        return {(keys[k] if type(k) is int else k):self.restore(v) for k,v in d.items()}
+    def _restore_map(self,d):
+        # Called by msgpack for every map, inner maps have already been restored
+        keys = self.keys
+        return {(keys[k] if type(k) is int else k):v for k,v in d.items()}
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  compression.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+"""
+This module contains the compression algorithms that may be used to compress packets.
+
+Packets larger than :confval:`net.compress.threshold` are compressed with the
+algorithm negotiated for their connection. The ID of the algorithm is stored in
+the flags of the packet header, see :py:data:`~peng3dnet.constants.FLAG_COMPRESSION_MASK`\ ,
+allowing the receiving side to decompress packets without knowing the negotiated algorithm.
+
+Algorithms are registered with the :py:class:`~peng3dnet.registry.CompressionRegistry`
+of each peer, available as the ``compressions`` attribute of :py:class:`~peng3dnet.net.Server()`
+and :py:class:`~peng3dnet.net.Client()`\ .
+
+During the handshake, the server sends a list of all algorithms it supports. The client
+then chooses the first algorithm of :confval:`net.compress.algorithms` also supported by
+the server, which is then used in both directions. Peers not supporting this negotiation
+always use :py:mod:`zlib`\ .
+
+:py:mod:`zlib` is always available, while ``lz4`` and ``zstd`` require the :py:mod:`lz4`
+and :py:mod:`zstandard` packages, respectively.
+"""
+
+__all__ = [
+    "Compressor",
+    "ZlibCompressor","LZ4Compressor","ZstdCompressor",
+    ]
+
+import threading
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    HAVE_LZ4 = False
+else:
+    HAVE_LZ4 = True
+
+try:
+    import zstandard
+except ImportError:
+    HAVE_ZSTD = False
+else:
+    HAVE_ZSTD = True
+
+class Compressor(object):
+    """
+    Base class for all compression algorithms.
+    
+    Subclasses should override :py:meth:`compress()` and :py:meth:`decompress()`\ .
+    
+    A single instance is shared between all connections and may be used from
+    multiple threads at once.
+    """
+    def compress(self,data,cfg):
+        """
+        Compresses the given bytes-like object and returns the compressed data.
+        
+        ``cfg`` is the config of the peer, which may be used to look up the compression level.
+        """
+        raise NotImplementedError("compress() must be overridden by subclasses")
+    def decompress(self,data,max_length=None):
+        """
+        Decompresses the given bytes-like object and returns the original data.
+        
+        If ``max_length`` is given, a :py:exc:`ValueError` is raised if the original data
+        would be longer than ``max_length`` bytes. This must be checked without decompressing
+        all of the data first, as a small packet may otherwise cause huge allocations.
+        """
+        raise NotImplementedError("decompress() must be overridden by subclasses")
+
+class ZlibCompressor(Compressor):
+    """
+    Compression via :py:mod:`zlib`\ , using the level configured via :confval:`net.compress.level`\ .
+    
+    This is the only algorithm supported by older versions of peng3dnet.
+    """
+    def compress(self,data,cfg):
+        return zlib.compress(data,cfg["net.compress.level"])
+    def decompress(self,data,max_length=None):
+        if max_length is None:
+            return zlib.decompress(data)
+        d = zlib.decompressobj()
+        # One more byte than allowed to detect data that is too long
+        out = d.decompress(data,max_length+1)
+        if len(out)>max_length:
+            raise ValueError("Decompressed data is longer than %s bytes"%max_length)
+        if not d.eof:
+            raise zlib.error("Incomplete or truncated stream")
+        return out
+
+class LZ4Compressor(Compressor):
+    """
+    Compression via the LZ4 frame format, using the level configured via :confval:`net.compress.lz4.level`\ .
+    
+    Compresses slightly worse than :py:mod:`zlib`\ , but is many times faster. Best
+    suited for latency-sensitive traffic.
+    
+    Requires the :py:mod:`lz4` package.
+    """
+    def compress(self,data,cfg):
+        return lz4.frame.compress(data,compression_level=cfg["net.compress.lz4.level"])
+    def decompress(self,data,max_length=None):
+        if max_length is None:
+            return lz4.frame.decompress(data)
+        d = lz4.frame.LZ4FrameDecompressor()
+        # One more byte than allowed to detect data that is too long
+        out = d.decompress(data,max_length+1)
+        if len(out)>max_length:
+            raise ValueError("Decompressed data is longer than %s bytes"%max_length)
+        if not d.eof:
+            raise RuntimeError("Incomplete or truncated LZ4 frame")
+        return out
+
+class ZstdCompressor(Compressor):
+    """
+    Compression via Zstandard, using the level configured via :confval:`net.compress.zstd.level`\ .
+    
+    Usually compresses better and faster than :py:mod:`zlib`\ , well suited for bulk transfers.
+    
+    Requires the :py:mod:`zstandard` package.
+    """
+    def __init__(self):
+        # (De-)Compression contexts may not be shared between threads
+        self._local = threading.local()
+    def compress(self,data,cfg):
+        level = cfg["net.compress.zstd.level"]
+        c = getattr(self._local,"compressor",None)
+        if c is None or self._local.level!=level:
+            c = self._local.compressor = zstandard.ZstdCompressor(level=level)
+            self._local.level = level
+        return c.compress(data)
+    def decompress(self,data,max_length=None):
+        d = getattr(self._local,"decompressor",None)
+        if d is None:
+            d = self._local.decompressor = zstandard.ZstdDecompressor()
+        if max_length is None:
+            return d.decompress(data)
+        # The output is allocated at once if the frame declares its size, otherwise max_length bounds it
+        if zstandard.frame_content_size(data)>max_length:
+            raise ValueError("Decompressed data is longer than %s bytes"%max_length)
+        return d.decompress(data,max_output_size=max_length)
@@ -47,6 +47,16 @@ class ConnectionType(object):
     possible via the ``cid`` parameter given to most methods. On the client side,
     this parameter will always be ``None``\ .
     """
+    max_packetlength = None
+    """
+    Maximum length in bytes of any packet received via a connection of this type.
+    
+    If this is ``None``\ , only the limits configured via :confval:`net.recv.maxlen.handshake`
+    and :confval:`net.recv.maxlen.active` apply. Otherwise, the lower of the two limits is used.
+    
+    Packets exceeding this limit cause the connection to be closed as soon as their
+    length prefix has been received.
+    """
     def __init__(self,peer):
         self.peer = peer
     def init(self,cid):
@@ -99,11 +109,19 @@ class ClassicConnectionType(ConnectionType):
     Currently adds no further processing to packets and starts a handshake by sending a :py:class:`~peng3dnet.packet.internal.HandshakePacket()` from the server to the client.
     
     The handshake allows the client to copy the registry of the server, preventing bugs with mismatching packet IDs.
+    
+    Additionally, the :py:class:`~peng3dnet.codec.KeyTable` is negotiated during the handshake.
     """
     def init(self,cid):
         if cid is not None:
-            self.peer.clients[cid].state = STATE_HANDSHAKE_WAIT1
-            self.peer.send_message("peng3dnet:internal.handshake",{"version":version.VERSION,"protoversion":version.PROTOVERSION,"registry":dict(self.peer.registry.reg_int_str.inv)},cid)
+            client = self.peer.clients[cid]
+            client.state = STATE_HANDSHAKE_WAIT1
+            msg = self.peer._get_prepared_internal("peng3dnet:internal.handshake")
+            # Remembered to be activated once the client accepts it
+            keytable = self.peer.get_keytable()
+            if msg.data.get("keytable",None) is keytable.keys:
+                client._keytable_offer = keytable
+            self.peer.send_message(msg,None,cid)
         elif cid is None:
             self.peer.remote_state = STATE_HANDSHAKE_WAIT1
     init.__noautodoc__ = True
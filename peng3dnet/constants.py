@@ -40,7 +40,15 @@ __all__ = [
     
     "CONNTYPE_NOTSET","CONNTYPE_CLASSIC","CONNTYPE_PING",
     
-    "FLAG_COMPRESSED","FLAG_ENCRYPTED_AES",
+    "FLAG_COMPRESSED","FLAG_ENCRYPTED_AES","FLAG_KEYTABLE",
+    "FLAG_COMPRESSION_SHIFT","FLAG_COMPRESSION_MASK",
+    "FLAG_CODEC_SHIFT","FLAG_CODEC_MASK",
+    
+    "CODEC_MSGPACK","CODEC_RAW","CODEC_STRUCT",
+    
+    "COMPRESSION_ZLIB","COMPRESSION_LZ4","COMPRESSION_ZSTD",
+    
+    "EXTTYPE_NDARRAY",
     
     "SIDE_CLIENT","SIDE_SERVER",
     
@@ -175,6 +183,76 @@ Flag bit set if the packet is AES-Encrypted.
 
 Note that this flag is currently not implemented.
 """
+FLAG_KEYTABLE =         1 << 2
+"""
+Flag bit set if the keys of dictionaries within the payload have been replaced via the key table.
+
+.. seealso::
+   See :py:class:`~peng3dnet.codec.KeyTable` for more information.
+"""
+FLAG_COMPRESSION_SHIFT = 3
+"""
+Offset of the compression algorithm ID within the flags of the packet header.
+"""
+FLAG_COMPRESSION_MASK = 0x7 << FLAG_COMPRESSION_SHIFT
+"""
+Bitmask of the flags of the packet header storing the ID of the compression algorithm.
+
+Only meaningful if :py:data:`FLAG_COMPRESSED` is set. Older versions of peng3dnet
+always leave these bits cleared, which corresponds to :py:data:`COMPRESSION_ZLIB`\ .
+
+.. seealso::
+   See :py:mod:`peng3dnet.compression` for more information about compression algorithms.
+"""
+FLAG_CODEC_SHIFT =      8
+"""
+Offset of the codec ID within the flags of the packet header.
+"""
+FLAG_CODEC_MASK =       0xFF << FLAG_CODEC_SHIFT
+"""
+Bitmask of the flags of the packet header storing the ID of the codec used for the payload.
+
+The codec ID can be extracted via ``(flags&FLAG_CODEC_MASK)>>FLAG_CODEC_SHIFT``\ .
+
+.. seealso::
+   See :py:mod:`peng3dnet.codec` for more information about codecs.
+"""
+
+CODEC_MSGPACK = 0
+"""
+ID of the default :py:class:`~peng3dnet.codec.MsgpackCodec`\ .
+
+Packets sent by older versions of peng3dnet will always use this codec.
+"""
+CODEC_RAW = 1
+"""
+ID of the :py:class:`~peng3dnet.codec.RawCodec`\ .
+"""
+CODEC_STRUCT = 2
+"""
+ID of the :py:class:`~peng3dnet.codec.StructCodec`\ .
+"""
+
+COMPRESSION_ZLIB = 0
+"""
+ID of the :py:class:`~peng3dnet.compression.ZlibCompressor`\ .
+"""
+COMPRESSION_LZ4 = 1
+"""
+ID of the :py:class:`~peng3dnet.compression.LZ4Compressor`\ .
+"""
+COMPRESSION_ZSTD = 2
+"""
+ID of the :py:class:`~peng3dnet.compression.ZstdCompressor`\ .
+"""
+
+EXTTYPE_NDARRAY = 1
+"""
+Msgpack extension type code used for :py:class:`numpy.ndarray` instances.
+
+.. seealso::
+   See :py:class:`~peng3dnet.codec.MsgpackCodec` for more information.
+"""
 
 SIDE_CLIENT = 0
 """
@@ -224,10 +302,33 @@ DEFAULT_CONFIG = {
     "net.client.addr":None,
     "net.client.addr.host":"localhost",
     "net.client.addr.port":8080,
+    "net.client.connect.timeout":10.0,
+    
+    "net.recv.bufsize":64*1024, # 64KiB
+    "net.recv.budget":1024*1024, # 1MiB
+    "net.recv.spool_threshold":32*1024*1024, # 32MiB
+    "net.recv.spool_dir":None,
+    "net.recv.maxlen.handshake":64*1024, # 64KiB
+    "net.recv.maxlen.active":MAX_PACKETLENGTH,
+    
+    "net.send.batch":False,
+    "net.send.batch.maxdelay":0.01, # 10ms
+    "net.send.bundle":True,
+    "net.send.bundle.maxsize":64*1024, # 64KiB
+    
+    "net.sock.nodelay":None,
+    "net.sock.cork":False,
+    "net.sock.sndbuf":None,
+    "net.sock.rcvbuf":None,
+    
+    "net.keytable.enabled":True,
     
     "net.compress.enabled":True,
     "net.compress.threshold":8*1024, # 8KiB
     "net.compress.level":6,
+    "net.compress.lz4.level":0,
+    "net.compress.zstd.level":3,
+    "net.compress.algorithms":["lz4","zstd","zlib"],
     
     "net.encrypt.enabled":False,
     # TODO
@@ -31,7 +31,9 @@ __all__ = [
     "InvalidAddressError","InvalidPortError","InvalidHostError",
     "UnsupportedAddressError",
     "InvalidSmartPacketActionError",
-    "TimedOutError","FailedPingError",
+    "PacketTooLongError",
+    "TimedOutError",
+    "FailedConnectionError","FailedPingError",
     "RegistryError","AlreadyRegisteredError",
     ]
 
@@ -64,6 +66,14 @@ class InvalidSmartPacketActionError(ValueError):
     """
     pass
 
+class PacketTooLongError(ValueError):
+    """
+    Raised if the length prefix of a received packet exceeds the maximum length currently allowed.
+    
+    Usually causes the connection to be closed immediately, as the rest of the stream cannot be trusted anymore.
+    """
+    pass
+
 class TimedOutError(RuntimeError):
     """
     Indicates that some action has timed out, this includes connections, requests and any other applicable action.
@@ -75,6 +85,15 @@ class FailedPingError(TimedOutError):
     """
     pass
 
+class FailedConnectionError(RuntimeError):
+    """
+    Indicates that a client could not connect to the server.
+    
+    This may be caused by a failed name resolution, a refused connection,
+    a failed SSL handshake or the connect timeout expiring.
+    """
+    pass
+
 class RegistryError(ValueError):
     """
     Indicates that a registry has encountered an error.
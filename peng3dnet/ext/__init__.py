@@ -23,3 +23,4 @@
 #  
 
 from . import ping
+from . import aoi
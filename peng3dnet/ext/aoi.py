@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  aoi.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+"""
+The area of interest extension allows servers to only send data to clients that are near a given position.
+
+This is usually used for sending updates of entities only to players that are
+close enough to see them. Positions of clients are stored in a uniform grid,
+radius queries only check clients within cells overlapping the radius. Cells
+of the grid are also used to notify the application of clients moving between
+areas.
+
+If :py:mod:`numpy` is available, positions are stored in an array and the
+distances of the clients within these cells are computed in vectorized operations.
+Otherwise, a slower pure-Python implementation is used.
+"""
+
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    HAVE_NUMPY = False
+else:
+    HAVE_NUMPY = True
+
+class AreaOfInterest(object):
+    """
+    Spatial index of the positions of clients.
+    
+    ``server`` is the :py:class:`~peng3dnet.net.Server` this index belongs to.
+    
+    ``cellsize`` is the edge length of the cells of the grid, in the same units as the positions.
+    Ideally, it should be about the radius used for most queries.
+    
+    ``dims`` is the number of dimensions of positions, usually ``2`` or ``3``\\ .
+    
+    All methods of this class are thread-safe.
+    """
+    def __init__(self,server,cellsize=64.0,dims=3):
+        self.server = server
+        self.cellsize = float(cellsize)
+        self.dims = dims
+        
+        self.cells = {}
+        """
+        Maps cells to sets of Client ID numbers of clients within them.
+        
+        Cells are represented by tuples of integers, see :py:meth:`get_cell()`\\ .
+        Empty cells are removed.
+        """
+        
+        self._cellof = {}
+        
+        # Positions are stored densely, rows of removed clients are filled by the last row
+        self._rows = {}
+        self._cids = []
+        if HAVE_NUMPY:
+            self._pos = numpy.zeros((16,dims),dtype=numpy.float64)
+        else:
+            self._pos = []
+        
+        self._lock = threading.RLock()
+    
+    def get_cell(self,pos):
+        """
+        Returns the cell containing the given position as a tuple of integers.
+        """
+        return tuple(int(math.floor(c/self.cellsize)) for c in pos)
+    def get_cell_members(self,cell):
+        """
+        Returns a set of the Client ID numbers of all clients in the given cell.
+        
+        The returned set is a copy and may be freely modified.
+        """
+        with self._lock:
+            return set(self.cells.get(cell,()))
+    def get_position(self,cid):
+        """
+        Returns the position of the given client as a tuple, or ``None`` if it has no position.
+        """
+        with self._lock:
+            row = self._rows.get(cid,None)
+            if row is None:
+                return None
+            return tuple(float(c) for c in self._pos[row])
+    
+    def update(self,cid,pos):
+        """
+        Sets the position of the given client.
+        
+        ``pos`` should be a sequence of ``dims`` numbers.
+        
+        If the client has moved to another cell, :py:meth:`on_cell_change()` is called.
+        """
+        pos = tuple(float(c) for c in pos)
+        if len(pos)!=self.dims:
+            raise ValueError("Expected a position with %s dimensions, got %s"%(self.dims,len(pos)))
+        
+        with self._lock:
+            row = self._rows.get(cid,None)
+            if row is None:
+                row = len(self._cids)
+                self._rows[cid] = row
+                self._cids.append(cid)
+                if HAVE_NUMPY:
+                    if row>=self._pos.shape[0]:
+                        self._pos = numpy.concatenate([self._pos,numpy.zeros_like(self._pos)])
+                else:
+                    self._pos.append(pos)
+            self._pos[row] = pos
+            
+            cell = self.get_cell(pos)
+            oldcell = self._cellof.get(cid,None)
+            if cell==oldcell:
+                return
+            self._move(cid,oldcell,cell)
+        
+        self.on_cell_change(cid,oldcell,cell)
+    def remove(self,cid):
+        """
+        Removes the given client from the index.
+        
+        Called automatically once a connection is closed, if :py:class:`AOIServerMixin` is used.
+        
+        If the client had a position, :py:meth:`on_cell_change()` is called with ``None`` as the new cell.
+        """
+        with self._lock:
+            row = self._rows.pop(cid,None)
+            if row is None:
+                return
+            
+            # Fill the gap with the last row
+            last = len(self._cids)-1
+            lastcid = self._cids.pop()
+            if row!=last:
+                self._cids[row] = lastcid
+                self._rows[lastcid] = row
+                self._pos[row] = self._pos[last]
+            if not HAVE_NUMPY:
+                self._pos.pop()
+            
+            oldcell = self._cellof.get(cid,None)
+            self._move(cid,oldcell,None)
+        
+        self.on_cell_change(cid,oldcell,None)
+    def _move(self,cid,oldcell,cell):
+        if oldcell is not None:
+            members = self.cells[oldcell]
+            members.discard(cid)
+            if not members:
+                del self.cells[oldcell]
+        if cell is not None:
+            self.cells.setdefault(cell,set()).add(cid)
+            self._cellof[cid] = cell
+        else:
+            self._cellof.pop(cid,None)
+    
+    def query(self,pos,radius):
+        """
+        Returns a list of the Client ID numbers of all clients within ``radius`` of ``pos``\\ .
+        
+        Only clients within cells overlapping the radius are checked. If :py:mod:`numpy`
+        is available, their distances are computed in a single vectorized operation.
+        """
+        with self._lock:
+            cids = self._candidates([c-radius for c in pos],[c+radius for c in pos])
+            if not cids:
+                return []
+            if HAVE_NUMPY:
+                d = self._pos[self._get_rows(cids)]-numpy.asarray(pos,dtype=numpy.float64)
+                mask = numpy.einsum("ij,ij->i",d,d)<=radius*radius
+                return [cids[i] for i in numpy.flatnonzero(mask)]
+            
+            r2 = radius*radius
+            out = []
+            for cid in cids:
+                p = self._pos[self._rows[cid]]
+                if sum((a-b)**2 for a,b in zip(p,pos))<=r2:
+                    out.append(cid)
+            return out
+    def _candidates(self,low,high):
+        # Returns the Client ID numbers of all clients within cells overlapping the box from low to high
+        # Must be called while holding the lock
+        low = self.get_cell(low)
+        high = self.get_cell(high)
+        ncells = 1
+        for l,h in zip(low,high):
+            ncells*=h-l+1
+        
+        if ncells>len(self.cells):
+            # Cheaper to check all occupied cells
+            cells = [cell for cell in self.cells if all(l<=c<=h for c,l,h in zip(cell,low,high))]
+        else:
+            cells = [[]]
+            for l,h in zip(low,high):
+                cells = [cell+[c] for cell in cells for c in range(l,h+1)]
+            cells = [tuple(cell) for cell in cells]
+        
+        out = []
+        for cell in cells:
+            out.extend(self.cells.get(cell,()))
+        return out
+    def _get_rows(self,cids):
+        # Returns an array of the rows of the given clients
+        return numpy.fromiter((self._rows[cid] for cid in cids),dtype=numpy.intp,count=len(cids))
+    def query_many(self,positions,radius):
+        """
+        Performs :py:meth:`query()` for many positions at once.
+        
+        ``positions`` should be a sequence of positions, e.g. of all entities that have been updated.
+        
+        Returns a list containing a list of Client ID numbers for every position.
+        
+        If :py:mod:`numpy` is available, positions within the same cell are checked
+        together against the clients of the cells around them, in a few vectorized operations.
+        """
+        if not HAVE_NUMPY:
+            return [self.query(pos,radius) for pos in positions]
+        
+        positions = numpy.asarray(positions,dtype=numpy.float64).reshape(-1,self.dims)
+        out = [[] for _ in range(positions.shape[0])]
+        if positions.shape[0]==0:
+            return out
+        
+        r2 = radius*radius
+        with self._lock:
+            if not self._cids:
+                return out
+            
+            # Positions within the same cell share their candidates
+            cells = numpy.floor(positions/self.cellsize).astype(numpy.int64)
+            keys,inverse = numpy.unique(cells,axis=0,return_inverse=True)
+            inverse = inverse.reshape(-1)
+            order = numpy.argsort(inverse,kind="stable")
+            bounds = numpy.searchsorted(inverse[order],numpy.arange(keys.shape[0]+1))
+            
+            for k,cell in enumerate(keys):
+                cids = self._candidates(cell*self.cellsize-radius,(cell+1)*self.cellsize+radius)
+                if not cids:
+                    continue
+                pos = self._pos[self._get_rows(cids)]
+                idx = order[bounds[k]:bounds[k+1]]
+                
+                # Limits the size of the temporary distance matrix
+                chunk = max(1,(1<<20)//len(cids))
+                for i in range(0,len(idx),chunk):
+                    sub = idx[i:i+chunk]
+                    d = positions[sub,None,:]-pos[None,:,:]
+                    mask = numpy.einsum("ijk,ijk->ij",d,d)<=r2
+                    for j,row in zip(sub,mask):
+                        out[j] = [cids[c] for c in numpy.flatnonzero(row)]
+        return out
+    
+    def on_cell_change(self,cid,oldcell,newcell):
+        """
+        Event handler called whenever a client moves to another cell.
+        
+        ``oldcell`` is ``None`` if the client did not have a position before, ``newcell``
+        is ``None`` if the client has been removed.
+        
+        Usually used to send the entities within the newly entered cells to the client.
+        
+        Note that this handler is called without any locks held and may thus be called from multiple threads.
+        
+        May be overridden or replaced by assigning a function to it.
+        """
+        pass
+
+class AOIServerMixin(object):
+    """
+    Mixin for :py:class:`~peng3dnet.net.Server` classes adding area of interest management.
+    
+    An :py:class:`AreaOfInterest` index is created on first use and available as the ``aoi`` attribute.
+    Clients are automatically removed from it once their connection is closed.
+    """
+    aoi_cellsize = 64.0
+    """
+    Edge length of the cells of the grid, see :py:class:`AreaOfInterest`\\ .
+    """
+    aoi_dims = 3
+    """
+    Number of dimensions of positions, see :py:class:`AreaOfInterest`\\ .
+    """
+    
+    _aoi_lock = threading.Lock()
+    
+    @property
+    def aoi(self):
+        """
+        The :py:class:`AreaOfInterest` index used by this server.
+        """
+        aoi = self.__dict__.get("_aoi",None)
+        if aoi is None:
+            with self._aoi_lock:
+                aoi = self.__dict__.get("_aoi",None)
+                if aoi is None:
+                    aoi = AreaOfInterest(self,self.aoi_cellsize,self.aoi_dims)
+                    self.__dict__["_aoi"] = aoi
+        return aoi
+    
+    def update_position(self,cid,pos):
+        """
+        Sets the position of the given client.
+        
+        See :py:meth:`AreaOfInterest.update()` for details.
+        """
+        self.aoi.update(cid,pos)
+    
+    def broadcast_near(self,pos,radius,ptype,data,exclude=None):
+        """
+        Sends a message to all clients within ``radius`` of ``pos``\\ .
+        
+        ``ptype`` and ``data`` are the same as for :py:meth:`~peng3dnet.net.Server.send_message()`\\ .
+        
+        ``exclude`` may be an iterable of Client ID numbers that should not receive the message.
+        
+        Like :py:meth:`~peng3dnet.net.Server.broadcast()`\\ , the message is only encoded once.
+        
+        Returns the number of clients the message has been sent to.
+        """
+        return self._broadcast(ptype,data,cids=self.aoi.query(pos,radius),exclude=exclude)
+    
+    def _client_closed(self,client):
+        super()._client_closed(client)
+        self.aoi.remove(client.cid)
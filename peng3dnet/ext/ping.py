@@ -53,7 +53,11 @@ class PingConnectionType(conntypes.ConnectionType):
     
     Additonally, conventional processing of packets will be disabled by this connection type,
     making it uneccessary to register packets with the client or server.
+    
+    Since ping requests and responses are usually small, packets received via
+    this connection type are limited to 1 MiB.
     """
+    max_packetlength = 1024*1024
     def init(self,cid):
         """
         Called whenever a new ping connection is established.
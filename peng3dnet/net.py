@@ -24,8 +24,10 @@
 
 __all__ = [
     "STRUCT_HEADER","STRUCT_LENGTH32",
+    "ReceiveBuffer",
     "Server","ClientOnServer",
     "Client",
+    "PreparedMessage",
     ]
 
 import sys
@@ -36,23 +38,28 @@ import socket
 import queue
 import selectors
 import warnings
+import os
 import collections
-import zlib
+import errno
+import mmap
+import tempfile
 
 
-try:
-    import msgpack as msgpack
-    _MSGPACK_TYPE = "msgpack-python"
-except ImportError:
-    import umsgpack as msgpack
-    _MSGPACK_TYPE = "umsgpack"
-
 try:
     import ssl
 except (ImportError,AttributeError):
     HAVE_SSL = False
+    
+    # Never raised, allows handling SSL errors in code shared with plain sockets
+    class _SSLWantReadError(Exception):
+        pass
+    class _SSLWantWriteError(Exception):
+        pass
 else:
     HAVE_SSL = True
+    
+    _SSLWantReadError = ssl.SSLWantReadError
+    _SSLWantWriteError = ssl.SSLWantWriteError
 
 import peng3d
 
@@ -62,6 +69,9 @@ from . import util
 from . import registry
 from . import errors
 from . import conntypes
+from . import codec
+from . import compression
+from .codec import _MSGPACK_TYPE, _unpackb
 from .constants import *
 
 STRUCT_HEADER = struct.Struct(STRUCT_FORMAT_HEADER)
@@ -79,6 +89,509 @@ STRUCT_LENGTH32 = struct.Struct(STRUCT_FORMAT_LENGTH32)
    See :py:data:`peng3dnet.constants.STRUCT_FORMAT_LENGTH32` for more information.
 """
 
+# Length prefix and header, used to encode both at once
+_STRUCT_FRAMEHEADER = struct.Struct(STRUCT_FORMAT_LENGTH32+STRUCT_FORMAT_HEADER.lstrip("!"))
+
+# Used if no codec is given, e.g. by tests
+_DEFAULT_CODEC = codec.MsgpackCodec()
+
+# Immutable payloads larger than this are queued without copying them into the frame
+_ZEROCOPY_THRESHOLD = 16*1024
+
+# Used if no compression algorithm has been negotiated
+_DEFAULT_COMPRESSOR = (compression.ZlibCompressor(),COMPRESSION_ZLIB,"zlib")
+
+def _encode_packet(pid,data,cfg,codecobj=None,codecid=CODEC_MSGPACK,pkt=None,flags=0,compressor=None):
+    # Encodes a packet including length prefix and header
+    # Returns a list of buffers to be queued for sending
+    # compressor is a tuple as returned by CompressionRegistry.getAll()
+    if codecobj is None:
+        codecobj = _DEFAULT_CODEC
+    flags |= codecid<<FLAG_CODEC_SHIFT
+    
+    # The codec may re-use its buffer, it must be copied before returning
+    raw = codecobj.encode(data,pkt)
+    with memoryview(raw) as view:
+        # The length prefix must count bytes, not items of other formats
+        body = view if view.format=="B" and view.ndim==1 else view.cast("B")
+        if len(body)>cfg["net.compress.threshold"] and cfg["net.compress.enabled"] and (pkt is None or pkt.compress):
+            # Compressed data is already a new buffer, no need to copy it again
+            compobj,compid,_ = compressor if compressor is not None else _DEFAULT_COMPRESSOR
+            cbody = compobj.compress(body,cfg)
+            flags |= FLAG_COMPRESSED|(compid<<FLAG_COMPRESSION_SHIFT)
+            header = _STRUCT_FRAMEHEADER.pack(STRUCT_HEADER.size+len(cbody),pid,flags)
+            return [header,cbody]
+        
+        if isinstance(raw,bytes) and len(body)>=_ZEROCOPY_THRESHOLD:
+            # bytes cannot change while queued, e.g. payloads of a BinaryPacket
+            header = _STRUCT_FRAMEHEADER.pack(STRUCT_HEADER.size+len(body),pid,flags)
+            return [header,raw]
+        
+        # Single contiguous frame, the body is only copied once out of the codec
+        frame = bytearray(_STRUCT_FRAMEHEADER.size+len(body))
+        _STRUCT_FRAMEHEADER.pack_into(frame,0,STRUCT_HEADER.size+len(body),pid,flags)
+        frame[_STRUCT_FRAMEHEADER.size:] = body
+        return [frame]
+
+def _encode_message(peer,pid,data,keytable=None,compressor=None):
+    # Encodes a message with the codec declared by its packet type
+    # Connection types like ping may send packets that are not registered, these always use msgpack
+    pkt = peer.registry.reg_int_obj.get(pid,None)
+    if pkt is None:
+        return _encode_packet(pid,data,peer.cfg,compressor=compressor)
+    c = pkt.codec
+    codecid = peer.codecs.getID(c)
+    if keytable is not None and pkt.fieldnames and codecid==CODEC_MSGPACK:
+        try:
+            data = keytable.replace(data)
+        except ValueError:
+            # Integer keys would be ambiguous, send the message as it is
+            pass
+        else:
+            return _encode_packet(pid,data,peer.cfg,peer.codecs.getObj(c),codecid,pkt,FLAG_KEYTABLE,compressor)
+    return _encode_packet(pid,data,peer.cfg,peer.codecs.getObj(c),codecid,pkt,0,compressor)
+
+def _decompress(peer,flags,body,client=None):
+    # The algorithm is taken from the header, any registered algorithm can be received
+    # client is the ClientOnServer the packet was received from, None on the client side
+    # Packets are not compressed before the connection type has been set, these are rejected
+    state = client.state if client is not None else peer.remote_state
+    if state in _HANDSHAKE_STATES:
+        raise ValueError("Received compressed packet during the handshake")
+    compobj = peer.compressions.getObj((flags&FLAG_COMPRESSION_MASK)>>FLAG_COMPRESSION_SHIFT)
+    # Bounded like received packets, a small packet may otherwise decompress to gigabytes
+    return compobj.decompress(body,peer.get_max_packetlength(client))
+
+def _decode_message(peer,pid,flags,body,keytable=None):
+    # Decodes the already decompressed body with the codec given in the header
+    # The codec is taken from the header to not depend on the local packet type
+    if flags&FLAG_KEYTABLE:
+        if keytable is None:
+            raise ValueError("Received packet using a key table that has not been negotiated")
+        return keytable.decode(body)
+    codecobj = peer.codecs.getObj((flags&FLAG_CODEC_MASK)>>FLAG_CODEC_SHIFT)
+    return codecobj.decode(body,peer.registry.reg_int_obj.get(pid,None))
+
+def _get_prepared_bufs(peer,msg,keytable,compressor):
+    # Prepared messages are encoded lazily, once for every key table and compression algorithm of their recipients
+    # Uncompressed messages are the same for all compression algorithms and stored with None as the algorithm
+    variants = msg._variants
+    bufs = variants.get((keytable,None),None)
+    if bufs is not None:
+        return bufs
+    compid = compressor[1] if compressor is not None else COMPRESSION_ZLIB
+    bufs = variants.get((keytable,compid),None)
+    if bufs is None:
+        bufs = _freeze_bufs(_encode_message(peer,msg.pid,msg.data,keytable,compressor))
+        if not _STRUCT_FRAMEHEADER.unpack_from(bufs[0])[2]&FLAG_COMPRESSED:
+            compid = None
+        variants[(keytable,compid)] = bufs
+    return bufs
+
+def _freeze_bufs(bufs):
+    # Immutable, as the same buffers may be queued for multiple connections
+    return tuple(bytes(buf) if isinstance(buf,bytearray) else buf for buf in bufs)
+
+class PreparedMessage(object):
+    """
+    Message that may be sent any number of times without encoding it again.
+    
+    Instances of this class should be created via :py:meth:`Server.prepare()` or
+    :py:meth:`Client.prepare()` and can be passed as the ``ptype`` argument of
+    :py:meth:`Server.send_message()`\ , :py:meth:`Server.broadcast()` and
+    :py:meth:`Client.send_message()`\ , in which case the ``data`` argument is ignored.
+    
+    The message is encoded when it is first sent, once for every combination of
+    key table and compression algorithm used by its recipients. Usually, all
+    recipients share the same encoded data.
+    
+    Note that ``data`` must thus not be modified after preparing it.
+    Event handlers will receive ``data`` as given to :py:meth:`~Server.prepare()`\ .
+    
+    Instances of this class should be treated as immutable.
+    """
+    __slots__ = ["ptype","pid","data","_variants"]
+    def __init__(self,ptype,pid,data):
+        self.ptype = ptype
+        self.pid = pid
+        self.data = data
+        # Maps key table and compression algorithm to buffers encoded with them, created when first needed
+        self._variants = {}
+
+# Internal packet ID of bundles, never registered to stay compatible with older registries
+_PID_BUNDLE = 17
+
+_RAW_CODEC = codec.RawCodec()
+
+class _Bundler(object):
+    # Collects batched frames for one connection and combines them into a single bundle
+    # Must only be used while holding the write lock of the connection
+    __slots__ = ["frames","size","count"]
+    def __init__(self):
+        self.frames = []
+        self.size = 0
+        self.count = 0
+    def add(self,bufs,queue,cfg,compressor=None):
+        n = sum(len(buf) for buf in bufs)
+        maxsize = cfg["net.send.bundle.maxsize"]
+        if self.size+n>maxsize:
+            self.close(queue,cfg,compressor)
+            if n>maxsize:
+                # Too large to be bundled at all
+                queue.extend(bufs)
+                return
+        self.frames.extend(bufs)
+        self.size+=n
+        self.count+=1
+    def close(self,queue,cfg,compressor=None):
+        # Queues the bundle, a single frame is queued unchanged
+        if self.count==1:
+            queue.extend(self.frames)
+        elif self.count>1:
+            queue.extend(_encode_packet(_PID_BUNDLE,b"".join(self.frames),cfg,_RAW_CODEC,CODEC_RAW,compressor=compressor))
+        self.frames = []
+        self.size = 0
+        self.count = 0
+
+def _iter_frames(peer,packets,client=None):
+    # Yields all received frames, replacing bundles with the frames they contain
+    for data in packets:
+        try:
+            frames = _split_bundle(peer,data,client)
+        except Exception:
+            # Malformed bundles are dropped like malformed packets, the remaining frames are still processed
+            import traceback;traceback.print_exc()
+            continue
+        yield from frames
+
+def _split_bundle(peer,data,client=None):
+    # Returns a list of the frames contained in a bundle, or the frame itself if it is not a bundle
+    # Frames too short for a header are passed through, the error is reported when processing them
+    if len(data)<STRUCT_HEADER.size:
+        return [data]
+    pid,flags = STRUCT_HEADER.unpack_from(data)
+    if pid!=_PID_BUNDLE:
+        return [data]
+    
+    frames = []
+    body = memoryview(data)[STRUCT_HEADER.size:]
+    if flags&FLAG_COMPRESSED:
+        body = memoryview(_decompress(peer,flags,body,client))
+    off = 0
+    while off<len(body):
+        if off+STRUCT_LENGTH32.size>len(body):
+            warnings.warn("Received truncated bundle")
+            break
+        n, = STRUCT_LENGTH32.unpack_from(body,off)
+        off+=STRUCT_LENGTH32.size
+        if off+n>len(body) or n<STRUCT_HEADER.size:
+            warnings.warn("Received truncated bundle")
+            break
+        frames.append(body[off:off+n])
+        off+=n
+    return frames
+
+# States in which only small handshake packets are expected from the peer
+_HANDSHAKE_STATES = frozenset([STATE_INIT,STATE_HELLOWAIT,STATE_WAITTYPE])
+
+# Maximum number of buffers passed to a single sendmsg() call
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError,ValueError,OSError):
+    _IOV_MAX = 16
+if _IOV_MAX<=0:
+    _IOV_MAX = 16
+
+HAVE_SENDMSG = hasattr(socket.socket,"sendmsg")
+
+HAVE_CORK = hasattr(socket,"TCP_CORK")
+
+def _configure_socket(sock,cfg):
+    # Applies the net.sock.* config options
+    if cfg["net.sock.nodelay"] is not None and sock.family in (socket.AF_INET,socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1 if cfg["net.sock.nodelay"] else 0)
+    if cfg["net.sock.sndbuf"] is not None:
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,cfg["net.sock.sndbuf"])
+    if cfg["net.sock.rcvbuf"] is not None:
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,cfg["net.sock.rcvbuf"])
+
+def _cork(sock,cork):
+    # Sets or clears TCP_CORK, if supported
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_CORK,1 if cork else 0)
+    except OSError:
+        pass
+
+class _Waker(object):
+    # Used to wake up a main loop waiting in select() from other threads
+    # At most one wakeup is outstanding at any time, further calls of wake() are no-ops
+    # Uses an eventfd if available, else a socketpair
+    def __init__(self):
+        self._pending = False
+        if hasattr(os,"eventfd"):
+            self._efd = os.eventfd(0,os.EFD_NONBLOCK|os.EFD_CLOEXEC)
+            self._rsock = self._wsock = None
+        else:
+            self._efd = None
+            self._rsock,self._wsock = socket.socketpair()
+            self._rsock.setblocking(False)
+            self._wsock.setblocking(False)
+    def fileno(self):
+        return self._efd if self._efd is not None else self._rsock.fileno()
+    def wake(self):
+        if self._pending:
+            return
+        self._pending = True
+        try:
+            if self._efd is not None:
+                os.eventfd_write(self._efd,1)
+            else:
+                self._wsock.send(b"\x00")
+        except (BlockingIOError,OSError):
+            # Already readable or closed
+            pass
+    def drain(self):
+        # Cleared only after reading, clearing first would allow a concurrent wake()
+        # to write after the flag is cleared and have that write consumed here,
+        # leaving the flag set with nothing to read and swallowing all further wakeups
+        # A wake() between reading and clearing is a no-op, the caller must thus
+        # check for pending work only after draining
+        try:
+            if self._efd is not None:
+                os.eventfd_read(self._efd)
+            else:
+                while self._rsock.recv(4096):
+                    pass
+        except (BlockingIOError,OSError):
+            pass
+        self._pending = False
+
+def _send_queued(sock,queue,offset,use_ssl=False):
+    # Sends as much data from the queue as the socket accepts without blocking
+    # offset is the number of bytes of the first buffer that have already been sent
+    # Returns the new offset, buffers sent completely are removed from the queue
+    while queue:
+        if use_ssl:
+            # SSL sockets do not support sendmsg()
+            bufs = [memoryview(queue[0])[offset:]]
+            try:
+                n = sock.send(bufs[0])
+            except (_SSLWantWriteError,_SSLWantReadError):
+                return offset
+        else:
+            bufs = [memoryview(queue[0])[offset:]]
+            if HAVE_SENDMSG:
+                for i in range(1,min(len(queue),_IOV_MAX)):
+                    bufs.append(queue[i])
+            try:
+                if HAVE_SENDMSG:
+                    n = sock.sendmsg(bufs)
+                else:
+                    n = sock.send(bufs[0])
+            except BlockingIOError:
+                return offset
+        
+        requested = sum(len(buf) for buf in bufs)
+        
+        # Drop all buffers that have been sent completely
+        sent = n+offset
+        while queue and sent>=len(queue[0]):
+            sent-=len(queue[0])
+            queue.popleft()
+        offset = sent
+        
+        if n<requested:
+            # Socket buffer is full
+            return offset
+    return 0
+
+class ReceiveBuffer(object):
+    """
+    Buffer used for reassembling length-prefixed packets from a stream of data.
+    
+    Data is read directly into an internal :py:class:`bytearray` via :py:meth:`recv_into()`\ ,
+    which avoids creating a new :py:class:`bytes` object for every read and re-slicing
+    the whole buffer for every packet.
+    
+    Packets small enough to fit into the internal buffer are copied out of it exactly once.
+    Larger packets are read into a dedicated :py:class:`bytearray` of the exact
+    size of the packet, which is then handed off without any further copies.
+    
+    ``size`` is the initial size of the internal buffer in bytes. Packets larger
+    than half of this size will be received into a dedicated buffer.
+    
+    If ``spool_threshold`` is given, packets larger than this many bytes are not
+    buffered on the heap at all. Instead, they are received directly into an
+    anonymous temporary file mapped into memory via :py:mod:`mmap`\ , located in
+    ``spool_dir`` or the default temporary directory. Such packets are handed
+    off as a :py:class:`memoryview` over the mapping, allowing the operating system
+    to page the data out if memory is scarce. The file is removed automatically
+    once the last reference to the packet is gone.
+    
+    This class is not thread-safe, it is intended to be only used by the thread
+    reading from the socket.
+    """
+    def __init__(self,size=64*1024,spool_threshold=None,spool_dir=None):
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # Start and end of the data not yet returned
+        self._start = 0
+        self._end = 0
+        
+        # Length of the current packet, if the prefix has already been parsed
+        self._framelen = None
+        
+        # Dedicated buffer for large packets
+        self._frame = None
+        self._frameview = None
+        self._framepos = 0
+    
+    def __len__(self):
+        n = self._end-self._start
+        if self._frame is not None:
+            n+=self._framepos
+        return n
+    
+    def _compact(self):
+        # Moves any pending data to the start of the buffer
+        pending = self._end-self._start
+        if pending:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+    def _ensure_space(self,n):
+        # Makes sure that at least n bytes may be appended to the buffer
+        if len(self._buf)-self._end>=n:
+            return
+        pending = self._end-self._start
+        if pending+n<=len(self._buf):
+            self._compact()
+        else:
+            buf = bytearray(max(len(self._buf)*2,pending+n))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+            self._start = 0
+            self._end = pending
+    
+    def _spool(self,length):
+        # The file can be closed immediately, as the mapping keeps its own handle
+        # It is also never visible in the file system on most platforms
+        with tempfile.TemporaryFile(dir=self.spool_dir) as f:
+            f.truncate(length)
+            return mmap.mmap(f.fileno(),length)
+    
+    def recv_into(self,sock,nbytes=0):
+        """
+        Reads data from the given socket directly into this buffer.
+        
+        ``sock`` may be any object with a ``recv_into()`` method, e.g. a :py:class:`socket.socket`
+        or a :py:class:`ssl.SSLSocket`\ .
+        
+        If ``nbytes`` is given, at most this many bytes will be read and the buffer
+        is compacted or grown to fit them, unless the remainder of a large packet is read.
+        Otherwise, as much data as fits into the free space of the buffer will be read.
+        
+        Returns the number of bytes read, which will be ``0`` if the peer closed the connection.
+        
+        Any exceptions raised by the socket will be passed through.
+        """
+        if self._frame is not None:
+            # Only read the remainder of the large packet into its dedicated buffer
+            view = self._frameview[self._framepos:]
+        else:
+            if self._start==self._end:
+                self._start = self._end = 0
+            elif nbytes:
+                # A read shorter than requested must only happen if the socket has been drained
+                self._ensure_space(nbytes)
+            elif len(self._buf)-self._end<len(self._buf)//4:
+                self._compact()
+            view = self._view[self._end:]
+        if nbytes:
+            view = view[:nbytes]
+        
+        n = sock.recv_into(view)
+        
+        if self._frame is not None:
+            self._framepos+=n
+        else:
+            self._end+=n
+        return n
+    def feed(self,data):
+        """
+        Appends the given bytes-like object to this buffer.
+        
+        This method is slower than :py:meth:`recv_into()` due to the additional copy
+        and only intended for data that has not been read from a socket directly.
+        """
+        data = memoryview(data).cast("B")
+        if self._frame is not None:
+            n = min(len(data),self._framelen-self._framepos)
+            self._frameview[self._framepos:self._framepos+n] = data[:n]
+            self._framepos+=n
+            data = data[n:]
+        if len(data)>0:
+            self._ensure_space(len(data))
+            self._view[self._end:self._end+len(data)] = data
+            self._end+=len(data)
+    
+    def next_frame(self,maxlen=MAX_PACKETLENGTH):
+        """
+        Extracts the next complete packet from the buffer.
+        
+        Returns the packet data without the length prefix as a bytes-like object,
+        or ``None`` if no complete packet is available yet.
+        
+        ``maxlen`` is the maximum length of a packet in bytes. If a length prefix
+        exceeding this limit is parsed, a :py:exc:`~peng3dnet.errors.PacketTooLongError`
+        is raised immediately, before any memory for the packet is allocated.
+        
+        Note that the returned object may be either a :py:class:`bytes`\ , :py:class:`bytearray`
+        or :py:class:`memoryview` object, depending on the size of the packet.
+        """
+        if self._framelen is None:
+            if self._end-self._start<STRUCT_LENGTH32.size:
+                return None
+            framelen = STRUCT_LENGTH32.unpack_from(self._buf,self._start)[0]
+            if framelen>maxlen:
+                raise errors.PacketTooLongError("Packet too long, %s bytes announced but only %s bytes allowed"%(framelen,maxlen))
+            self._framelen = framelen
+            self._start+=STRUCT_LENGTH32.size
+        
+        if self._frame is not None:
+            if self._framepos<self._framelen:
+                return None
+            frame = self._frame
+            self._frame = self._frameview = None
+            self._framepos = 0
+            self._framelen = None
+            return frame
+        
+        avail = self._end-self._start
+        if avail>=self._framelen:
+            # Enough data has been gathered, copy it out of the buffer
+            frame = bytes(self._view[self._start:self._start+self._framelen])
+            self._start+=self._framelen
+            self._framelen = None
+            return frame
+        elif self._framelen>len(self._buf)//2:
+            # Large packet, continue receiving into a dedicated buffer
+            if self.spool_threshold is not None and self._framelen>self.spool_threshold:
+                # Very large packet, spool to a temporary file instead of using the heap
+                self._frameview = memoryview(self._spool(self._framelen))
+                self._frame = self._frameview
+            else:
+                self._frame = bytearray(self._framelen)
+                self._frameview = memoryview(self._frame)
+            self._frameview[:avail] = self._view[self._start:self._end]
+            self._framepos = avail
+            self._start = self._end = 0
+        return None
+
 
 class Server(object):
     """
@@ -152,8 +665,7 @@ class Server(object):
         self._is_started = False
         self._is_initialized = False
         
-        self._irqrecv = None
-        self._irqsend = None
+        self._waker = None
         
         self.clientcls = clientcls if clientcls is not None else ClientOnServer
         
@@ -163,12 +675,28 @@ class Server(object):
         self._process_queue = queue.Queue()
         self._process_condition = threading.Condition()
         
+        # Contains (deadline,cid) tuples of batches waiting to be flushed, in order
+        self._batch_deadlines = collections.deque()
+        
+        # Contains (action,client) tuples submitted by other threads, applied by the main loop
+        self._submit_queue = collections.deque()
+        self._loop_thread = None
+        
         self.run = True
         self.clients = {}
         
+        # Maps channel names to sets of Client ID numbers
+        self.channels = {}
+        self._channel_lock = threading.Lock()
+        
+        self._prepared_cache = {}
+        self._keytable = None
+        
         self.conntypes = {}
         
         self.registry = registry.PacketRegistry()
+        self.codecs = registry.CodecRegistry()
+        self.compressions = registry.CompressionRegistry()
     
     def initialize(self):
         """
@@ -246,7 +774,7 @@ class Server(object):
                 self.cfg["net.ssl.enabled"]=False
                 warnings.warn("Potential security weakness because ssl had to be disabled")
             
-            self._irqrecv,self._irqsend = socket.socketpair()
+            self._waker = _Waker()
             
             self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
             # Use only if debugging, prevents address in use errors (ERRNO 98)
@@ -286,20 +814,76 @@ class Server(object):
             self.selector = selector()
             self.selector.register(self.sock,selectors.EVENT_READ,[self._accept,self])
             
-            self.selector.register(self._irqrecv,selectors.EVENT_READ,[self._client_ready,None])
-            self.selector.register(self._irqsend,selectors.EVENT_READ,[self._client_ready,None])
+            self.selector.register(self._waker,selectors.EVENT_READ,[self._client_ready,None])
             
             self._is_started = True
+            self._loop_thread = threading.get_ident()
             self.sendEvent("peng3dnet:server.start",{})
         
         while self.run:
-            events = self.selector.select()
+            timeout = None
+            if self._batch_deadlines:
+                timeout = max(self._batch_deadlines[0][0]-time.time(),0)
+            events = self.selector.select(timeout)
+            
+            # The waker must be drained before applying submissions
+            # Otherwise, the wakeup of a submission queued in between would be cleared without the submission being applied
+            for key,mask in events:
+                if key.fileobj is self._waker:
+                    self._waker.drain()
+                    break
+            
+            # Must be applied before handling events, as closed file descriptors may be re-used by new connections
+            self._apply_submissions()
+            
             for key,mask in events:
                 callback,data = key.data
                 try:
                     callback(key.fileobj, mask, data)
                 except Exception:
                     import traceback;traceback.print_exc()# Ignore exceptions for now...
+            
+            # Flush all batches that have been waiting for too long
+            t = time.time()
+            while self._batch_deadlines and self._batch_deadlines[0][0]<=t:
+                _,cid = self._batch_deadlines.popleft()
+                if cid in self.clients:
+                    try:
+                        self.flush(cid)
+                    except Exception:
+                        import traceback;traceback.print_exc()
+    
+    def _apply_submissions(self):
+        # Applies all changes submitted by other threads in one batch
+        while self._submit_queue:
+            action,client = self._submit_queue.popleft()
+            if action == "write":
+                with client._write_lock:
+                    if not client._write_registered:
+                        # Already flushed in the meantime
+                        continue
+                    try:
+                        self.selector.modify(client.conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,client])
+                    except (KeyError,ValueError):
+                        # Already closed
+                        pass
+            elif action == "close":
+                self._release_conn(client.conn)
+    def _in_loop(self):
+        # Checks if the calling thread is the one running the main loop
+        return threading.get_ident()==self._loop_thread
+    def _release_conn(self,conn):
+        # Unregisters and closes the socket of a client
+        # Only the main loop may touch the selector, other threads submit this action
+        try:
+            with self._selector_lock:
+                self.selector.unregister(conn)
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
     
     def runAsync(self,selector=selectors.DefaultSelector):
         """
@@ -329,15 +913,18 @@ class Server(object):
         self.interrupt()
     def interrupt(self):
         """
-        Wakes up the main loop by sending a special message to an internal socket.
+        Wakes up the main loop by signalling an internal file descriptor.
         
         This forces the main loop to iterate once and check that the system is still running.
         
+        Multiple calls before the main loop has woken up are coalesced into a single wakeup.
+        On platforms supporting it, an :py:func:`os.eventfd` is used, else a socket pair.
+        
         Also sends the :peng3d:event:`peng3dnet:server.interrupt` event.
         """
         # simply wakes the main loop up
         # used to force a check if the system is still running
-        self._irqsend.sendall(b"wake up!")
+        self._waker.wake()
         self.sendEvent("peng3dnet:server.interrupt",{})
     
     def shutdown(self,join=True,timeout=0,reason="servershutdown"):
@@ -391,9 +978,11 @@ class Server(object):
         conn,addr = sock.accept()
         
         if self.cfg["net.ssl.enabled"]:
-            conn = self.sslcontext.wrap_socket(conn, server_side=True)
+            # Handshake is done by _client_ready() to avoid blocking
+            conn = self.sslcontext.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
         
         conn.setblocking(False)
+        _configure_socket(conn,self.cfg)
         
         client = self.clientcls(self,conn,addr,self.genCID())
         self.clients[client.cid]=client
@@ -401,11 +990,15 @@ class Server(object):
         with self._selector_lock:
             self.selector.register(conn,selectors.EVENT_READ,[self._client_ready,client])
         
+        if self.cfg["net.ssl.enabled"]:
+            # Start the handshake, the client is waiting for us
+            self._client_ready(conn,0,client)
+        
         if not self.cfg["net.ssl.enabled"]:
             client.state = STATE_HELLOWAIT
             client.on_connect()
             #self.send_message("peng3dnet:internal.handshake",{"version":version.VERSION,"protoversion":version.PROTOVERSION,"registry":dict(self.registry.reg_int_str._inv)},client.cid)
-            self.send_message("peng3dnet:internal.hello",{"version":version.VERSION,"protoversion":version.PROTOVERSION},client.cid)
+            self.send_message(self._get_prepared_internal("peng3dnet:internal.hello"),None,client.cid)
             self.sendEvent("peng3dnet:server.connection.accept",{"sock":conn,"addr":addr,"client":client,"cid":client.cid})
     
     def _client_ready(self,conn,mask,data):
@@ -415,100 +1008,195 @@ class Server(object):
                 conn.do_handshake()
             except ssl.SSLWantWriteError:
                 skey = self.selector.get_key(conn)
-                if not skey&selectors.EVENT_WRITE:
+                if not skey.events&selectors.EVENT_WRITE:
                     self.selector.modify(conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,data])
                     # Interrupt not necessary, as this callback should be called while not selecting
             except ssl.SSLWantReadError:
                 # Should wait by itself again...
                 pass
+            except OSError:
+                # Handshake failed, e.g. because the client does not use SSL
+                with self._selector_lock:
+                    self.selector.unregister(conn)
+                data.close("sslfailed")
             else:
                 # Connected only now, send init packets
                 data.ssl_state = "connected"
                 data.state = STATE_HELLOWAIT
                 data.on_connect()
                 #self.send_message("peng3dnet:internal.handshake",{"version":version.VERSION,"protoversion":version.PROTOVERSION,"registry":dict(self.registry.reg_int_str._inv)},data.cid)
-                self.send_message("peng3dnet:internal.hello",{"version":version.VERSION,"protoversion":version.PROTOVERSION},data.cid)
+                self.send_message(self._get_prepared_internal("peng3dnet:internal.hello"),None,data.cid)
                 self.sendEvent("peng3dnet:server.connection.accept",{"sock":conn,"addr":data.addr,"client":data,"cid":data.cid})
             return
         
         if (mask & selectors.EVENT_READ):
             # Socket Readable
-            if conn==self._irqrecv:
-                dat = conn.recv(8)
-                if dat!=b"wake up!":
-                    conn.sendall(b"wrong socket")
-                return
-            elif conn==self._irqsend:
-                # should not happen
-                dat = conn.recv(1024)
+            if conn is self._waker:
+                # Already drained by the main loop
                 return
             
-            if self.cfg["net.ssl.enabled"]:
-                try:
-                    dat = conn.recv(1024)
-                except ssl.SSLWantWriteError:
-                    skey = self.selector.get_key(conn)
-                    if not skey&selectors.EVENT_WRITE:
-                        self.selector.modify(conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,data])
-                        # Interrupt not necessary, as this callback should be called while not selecting
-                    dat = ""
-                except ssl.SSLWantReadError:
-                    dat = ""
-                
-            else:
-                try:
-                    dat = conn.recv(1024)
-                except OSError:
-                    with self._selector_lock:
-                        self.selector.unregister(conn)
-                    data.close()
-                    return
-            if dat:
-                # Non-empty
-                try:
-                    self.receive_data(dat,data.cid)
-                except Exception:
-                    import traceback;traceback.print_exc()
-            else:
-                # Closed connection
-                with self._selector_lock:
-                    self.selector.unregister(conn)
-                data.close()
+            if not self._read_client(conn,data):
+                return
         
         if (mask & selectors.EVENT_WRITE):
             # Socket Writeable
             if data is None:
                 return # IRQ Socket
             
+            self._flush_client(conn,data)
+    
+    def flush(self,cid):
+        """
+        Sends all packets collected for the given client.
+        
+        ``cid`` should be the Client ID number.
+        
+        Only useful if :confval:`net.send.batch` is enabled, as packets are sent immediately otherwise.
+        
+        Like :py:meth:`send_message()`\ , this method tries to write the data
+        directly and leaves the rest to the main loop.
+        """
+        client = self.clients[cid]
+        with client._write_lock:
+            self._write_client(client)
+    def flush_all(self):
+        """
+        Sends all packets collected for all clients.
+        
+        Usually called at the end of each tick of the application.
+        
+        See :py:meth:`flush()` for details.
+        """
+        for cid in list(self.clients.keys()):
+            try:
+                self.flush(cid)
+            except KeyError:
+                # Closed in the meantime
+                pass
+    
+    def _schedule_flush(self,client):
+        # Must be called while holding the write lock of the client
+        if self.cfg["net.send.batch.maxdelay"] is None:
+            return
+        wake = len(self._batch_deadlines)==0
+        self._batch_deadlines.append((time.time()+self.cfg["net.send.batch.maxdelay"],client.cid))
+        if wake:
+            # The main loop may currently wait without a timeout
+            self.interrupt()
+    def _write_client(self,client):
+        # Must be called while holding the write lock of the client
+        client._batch_pending = False
+        client._bundler.close(client.write_queue,self.cfg,client._compressor)
+        if client._write_registered:
+            # Main loop is already waiting for the socket
+            return
+        if not (self.cfg["net.ssl.enabled"] or client._mark_close):
+            # Fast path, try writing directly
+            # Closing connections are left to the main loop, as it closes them once everything has been sent
             try:
-                msg = data.write_queue.popleft()
-            except IndexError:
+                client._write_offset = _send_queued(client.conn,client.write_queue,client._write_offset)
+            except OSError:
+                # Errors are handled by the main loop
+                pass
+        if len(client.write_queue)>0:
+            # Socket buffer is full, wait for it to become writeable
+            self._set_write_interest(client)
+        else:
+            self._uncork_client(client)
+    def _uncork_client(self,client):
+        # Must be called while holding the write lock of the client
+        # Sends the remaining partial segments once a batch has been written completely
+        if client._corked:
+            _cork(client.conn,False)
+            client._corked = False
+    def _set_write_interest(self,client):
+        # Must be called while holding the write lock of the client
+        client._write_registered = True
+        if self._in_loop():
+            with self._selector_lock:
+                try:
+                    self.selector.modify(client.conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,client])
+                except (KeyError,ValueError):
+                    # Already closed
+                    pass
+        else:
+            # Applied by the main loop, avoids contention on the selector
+            self._submit_queue.append(("write",client))
+            self.interrupt()
+    def _flush_client(self,conn,client):
+        # Writes as much of the write queue as the socket accepts
+        with client._write_lock:
+            try:
+                client._write_offset = _send_queued(conn,client.write_queue,client._write_offset,self.cfg["net.ssl.enabled"])
+            except OSError:
+                # Connection reset or similar
                 with self._selector_lock:
-                    self.selector.modify(conn,selectors.EVENT_READ,[self._client_ready,data])
-            else:
-                if self.cfg["net.ssl.enabled"]:
-                    try:
-                        conn.sendall(msg)
-                    except ssl.SSLWantWriteError:
-                        # Socket should already be in write mode
-                        pass
-                    except ssl.SSLWantReadError:
-                        # Socket will be in read mode
-                        pass
-                    else:
-                        # Re-insert message at the front
-                        data.write_queue.appendleft(msg)
-                else:
-                    conn.sendall(msg)
-                if len(data.write_queue)==0:
+                    self.selector.unregister(conn)
+                client.close("socketclose")
+                return False
+            
+            if len(client.write_queue)==0:
+                self._uncork_client(client)
+                if client._mark_close:
                     with self._selector_lock:
-                        self.selector.modify(conn,selectors.EVENT_READ,[self._client_ready,data])
+                        self.selector.unregister(conn)
+                    client.close()
+                    # No need to delete, handler already does it
+                    return False
+                client._write_registered = False
+                with self._selector_lock:
+                    self.selector.modify(conn,selectors.EVENT_READ,[self._client_ready,client])
+        return True
+    
+    def _read_client(self,conn,client):
+        # Reads from the socket until it would block or the budget is used up
+        # The budget prevents a single busy client from starving all others
+        # Returns False if the connection has been closed
+        bufsize = self.cfg["net.recv.bufsize"]
+        budget = self.cfg["net.recv.budget"]
+        total = 0
+        while total<budget:
+            try:
+                n = client._buf.recv_into(conn,bufsize)
+            except _SSLWantWriteError:
+                skey = self.selector.get_key(conn)
+                if not skey.events&selectors.EVENT_WRITE:
+                    self.selector.modify(conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,client])
+                    # Interrupt not necessary, as this callback should be called while not selecting
+                return True
+            except (BlockingIOError,_SSLWantReadError):
+                # Nothing left to read, try again later
+                return True
+            except OSError:
+                with self._selector_lock:
+                    self.selector.unregister(conn)
+                client.close()
+                return False
+            
+            if n==0:
+                # Closed connection
+                with self._selector_lock:
+                    self.selector.unregister(conn)
+                client.close()
+                return False
+            total+=n
             
-            if data._mark_close and len(data.write_queue)==0:
+            try:
+                self.process_packets(client)
+            except errors.PacketTooLongError:
+                # The rest of the stream cannot be parsed anymore
                 with self._selector_lock:
                     self.selector.unregister(conn)
-                data.close()
-                # No need to delete, handler already does it
+                client.close("packettoolong")
+                return False
+            except Exception:
+                import traceback;traceback.print_exc()
+            
+            if n<bufsize and not self.cfg["net.ssl.enabled"]:
+                # Short read, the socket has most likely been drained
+                # SSL sockets may still have buffered data, so they are read until they would block
+                break
+        return True
     
     def genCID(self):
         """
@@ -525,45 +1213,87 @@ class Server(object):
     
     def receive_data(self,data,cid):
         """
-        Called when new raw data has been read from a socket.
+        Called when new raw data has been received from a client.
         
         Note that the given ``data`` may contain only parts of a packet or even multiple packets.
         
         ``cid`` is the integer ID number of the client the data was received from.
         
-        By default, the received data is stored in a buffer until enough data is available to process a packet, then :py:meth:`process_single_packet()` is called.
+        By default, the received data is appended to the :py:class:`ReceiveBuffer` of the client,
+        then :py:meth:`process_packets()` is called.
+        
+        Note that data read from the socket of a client is written directly to the
+        buffer and does not pass through this method.
         """
         client = self.clients[cid]
         
-        # Length prefix code
-        client._buf+=data
-        while (client._buflen is None and len(client._buf)>0) or (client._buflen is not None and len(client._buf)>=client._buflen):
-            self.process_single_packet(client)
+        client._buf.feed(data)
+        self.process_packets(client)
+    def process_packets(self,client):
+        """
+        Called when there may be enough data to process one or more packets.
+        
+        ``client`` is an instance of :py:class:`ClientOnServer` representing the client.
+        
+        Currently extracts all complete packets from the receive buffer of the client
+        and calls :py:meth:`receive_packets()` once with all of them.
+        
+        The length of packets is limited according to :py:meth:`get_max_packetlength()`\ .
+        
+        Returns the number of packets extracted.
+        """
+        packets = []
+        maxlen = self.get_max_packetlength(client)
+        try:
+            data = client._buf.next_frame(maxlen)
+            while data is not None:
+                packets.append(data)
+                data = client._buf.next_frame(maxlen)
+        finally:
+            # Packets extracted before an error should still be processed
+            if packets:
+                self.receive_packets(packets,client.cid)
+        return len(packets)
     def process_single_packet(self,client):
         """
-        Called when there should be enough data to process a single packet.
+        Called when there may be enough data to process a single packet.
         
         ``client`` is an instance of :py:class:`ClientOnServer` representing the client.
         
-        Currently parses a single packet including length prefix and calls :py:meth:`receive_packet()` with the packet data.
+        Currently extracts a single packet from the receive buffer of the client
+        and calls :py:meth:`receive_packet()` with the packet data.
+        
+        Returns ``True`` if a packet has been processed, else ``False``\ .
         """
-        if client._buflen is None:
-            # Previous packet has been processed, begin new packet
-            if len(client._buf)<STRUCT_LENGTH32.size:
-                # Prevents errors
-                return
-            client._buflen = STRUCT_LENGTH32.unpack(client._buf[:STRUCT_LENGTH32.size])[0]
-            client._buf = client._buf[STRUCT_LENGTH32.size:]
-            if client._buflen>MAX_PACKETLENGTH:
-                # Should be pretty rare, but still
-                raise ValueError("Packet too long")
-        
-        if len(client._buf)>=client._buflen:
-            # Enough data has been gathered, process it
-            data = client._buf[:client._buflen]
-            client._buf = client._buf[client._buflen:]
-            client._buflen = None
-            self.receive_packet(data,client.cid)
+        data = client._buf.next_frame(self.get_max_packetlength(client))
+        if data is None:
+            return False
+        self.receive_packet(data,client.cid)
+        return True
+    def get_max_packetlength(self,client):
+        """
+        Returns the maximum length in bytes of a packet that may currently be received from the given client.
+        
+        ``client`` is an instance of :py:class:`ClientOnServer` representing the client.
+        
+        Until the client has sent its connection type, :confval:`net.recv.maxlen.handshake`
+        is used, afterwards :confval:`net.recv.maxlen.active`\ . The client may start sending
+        large packets as soon as it has accepted the handshake, which may happen before
+        the server has processed the acceptance. If the connection
+        type defines a lower :py:attr:`~peng3dnet.conntypes.ConnectionType.max_packetlength`\ ,
+        that limit is used instead.
+        
+        This bounds the amount of memory an unauthenticated peer may cause the server to allocate.
+        """
+        if client.state in _HANDSHAKE_STATES:
+            maxlen = self.cfg["net.recv.maxlen.handshake"]
+        else:
+            maxlen = self.cfg["net.recv.maxlen.active"]
+        
+        conntype = self.conntypes.get(client.conntype,None)
+        if conntype is not None and conntype.max_packetlength is not None:
+            maxlen = min(maxlen,conntype.max_packetlength)
+        return maxlen
     def receive_packet(self,data,cid):
         """
         Called when a full packet has been received.
@@ -572,9 +1302,21 @@ class Server(object):
         
         ``cid`` is the integer ID number of the client.
         
-        Currently, this puts the data in a queue to be processed further by :py:meth:`process()`\ .
+        Currently, this calls :py:meth:`receive_packets()` with a batch containing only this packet.
+        """
+        self.receive_packets([data],cid)
+    def receive_packets(self,packets,cid):
+        """
+        Called when one or more full packets have been received.
+        
+        ``packets`` is a list of raw packet data without length prefixes, in the order they were received.
+        
+        ``cid`` is the integer ID number of the client.
+        
+        Currently, this puts the whole batch in a queue to be processed further by :py:meth:`process()`\ .
+        Waiting threads will only be notified once per batch.
         """
-        self._process_queue.put([cid,data])
+        self._process_queue.put([cid,packets])
         with self._process_condition:
             self._process_condition.notify()
     
@@ -583,6 +1325,7 @@ class Server(object):
         Sends a message to the specified peer.
         
         ``ptype`` should be a valid packet type, e.g. either an ID, name or object.
+        It may also be a :py:class:`PreparedMessage`\ , in which case ``data`` is ignored.
         
         ``data`` should be the data to send to the peer.
         
@@ -591,36 +1334,239 @@ class Server(object):
         Note that all data encoding will be done synchronously and may cause this method to not return immediately.
         The packet may also be encrypted and compressed, if applicable.
         
+        If nothing is waiting to be sent to the peer, the packet is written
+        to the socket directly from the calling thread. Only if the socket
+        cannot accept all of it, the rest is sent by the main loop.
+        SSL connections are always written by the main loop.
+        
+        If :confval:`net.send.batch` is enabled, the packet is only queued
+        until :py:meth:`flush()` is called or :confval:`net.send.batch.maxdelay` has passed.
+        
         Additionally, the :peng3d:event:`peng3dnet:server.connection.send` event is sent if the connection type allows it.
         """
+        client = self.clients[cid]
+        if isinstance(ptype,PreparedMessage):
+            ptype,pid,data,bufs = ptype.ptype,ptype.pid,ptype.data,_get_prepared_bufs(self,ptype,client.keytable,client._compressor)
+        else:
+            pid = self.registry.getInt(ptype)
+            bufs = _encode_message(self,pid,data,client.keytable,client._compressor)
+        
         if self.cfg["net.debug.print.send"]:
             print("SEND %s to %s"%(ptype,cid))
         
-        data = msgpack.dumps(data)
+        self._queue_packet(client,pid,bufs)
+        self._call_send_handlers(client,ptype,data)
+    def broadcast(self,ptype,data,cids=None,exclude=None,predicate=None):
+        """
+        Sends a message to multiple peers at once.
         
-        flags = 0
+        ``ptype`` and ``data`` are the same as for :py:meth:`send_message()`\ , including
+        support for :py:class:`PreparedMessage`\ .
         
-        if len(data)>self.cfg["net.compress.threshold"] and self.cfg["net.compress.enabled"]:
-            data = zlib.compress(data,self.cfg["net.compress.level"])
-            flags = flags|FLAG_COMPRESSED
+        ``cids`` may be an iterable of Client ID numbers to send the message to.
+        If it is ``None``\ , the message is sent to all clients that have completed
+        the handshake, i.e. whose state is :py:data:`~peng3dnet.constants.STATE_ACTIVE`\ .
         
-        header = STRUCT_HEADER.pack(self.registry.getInt(ptype),flags)
-        data = header+data
+        ``exclude`` may be an iterable of Client ID numbers that should not receive the message.
         
-        prefix = STRUCT_LENGTH32.pack(len(data))
-        data = prefix+data
+        ``predicate`` may be a callable that is called with the :py:class:`ClientOnServer`
+        instance of each potential recipient. Only clients for which it returns
+        a truthy value will receive the message.
         
-        self.clients[cid].write_queue.append(data)
-        with self._selector_lock:
-            if not (self.selector.get_key(self.clients[cid].conn).events&selectors.EVENT_WRITE):
-                # Prevents unneccessary modification if nothing changes
-                self.selector.modify(self.clients[cid].conn,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._client_ready,self.clients[cid]])
-                self.interrupt() # forces the changes to apply
+        In contrast to calling :py:meth:`send_message()` for every client, the message
+        is only encoded and compressed once for every key table and compression algorithm
+        used by the recipients. Recipients using the same ones share the same encoded data.
+        Event handlers and the :peng3d:event:`peng3dnet:server.connection.send` event
+        are still called for every recipient.
+        
+        Returns the number of clients the message has been sent to.
+        """
+        return self._broadcast(ptype,data,cids,exclude,predicate)
+    def _broadcast(self,ptype,data,cids=None,exclude=None,predicate=None):
+        # Implementation of broadcast(), used by other methods as subclasses may override broadcast()
+        if not isinstance(ptype,PreparedMessage):
+            ptype = self.prepare(ptype,data)
+        msg = ptype
+        ptype,pid,data = msg.ptype,msg.pid,msg.data
+        
+        if self.cfg["net.debug.print.send"]:
+            print("BROADCAST %s"%ptype)
+        
+        if cids is None:
+            cids = [cid for cid,client in list(self.clients.items()) if client.state==STATE_ACTIVE]
+        exclude = set(exclude) if exclude is not None else set()
+        
+        n = 0
+        for cid in cids:
+            if cid in exclude:
+                continue
+            client = self.clients.get(cid,None)
+            if client is None:
+                # Closed in the meantime
+                continue
+            if predicate is not None and not predicate(client):
+                continue
+            
+            self._queue_packet(client,pid,_get_prepared_bufs(self,msg,client.keytable,client._compressor))
+            self._call_send_handlers(client,ptype,data)
+            n+=1
+        return n
+    
+    def prepare(self,ptype,data):
+        """
+        Prepares a message for sending it repeatedly while only encoding it once.
+        
+        ``ptype`` and ``data`` are the same as for :py:meth:`send_message()`\ .
+        
+        Returns a :py:class:`PreparedMessage` that may be passed to :py:meth:`send_message()`
+        or :py:meth:`broadcast()` instead of the packet type. This is useful for
+        messages that rarely change, e.g. a message of the day or static map data.
+        
+        Note that the message is sent with the current packet ID of ``ptype``\ ,
+        while encoding is deferred until it is first sent, see :py:class:`PreparedMessage`\ .
+        """
+        pid = self.registry.getInt(ptype)
+        return PreparedMessage(ptype,pid,data)
+    def _get_prepared_internal(self,ptype):
+        # Internal packets sent to every client are only encoded once
+        # The cache is invalidated whenever the registries change, as the hello and handshake contain them
+        rev = (self.registry.revision,self.compressions.revision)
+        cached = self._prepared_cache.get(ptype,None)
+        if cached is not None and cached[0]==rev:
+            return cached[1]
+        
+        if ptype=="peng3dnet:internal.hello":
+            data = {"version":version.VERSION,"protoversion":version.PROTOVERSION}
+            # All algorithms that can be decompressed, the client chooses one of them
+            data["compression"] = [self.compressions.getName(n) for n in sorted(self.compressions.reg_int_str.keys())]
+        elif ptype=="peng3dnet:internal.handshake":
+            data = {"version":version.VERSION,"protoversion":version.PROTOVERSION,"registry":dict(self.registry.reg_int_str.inv)}
+            if self.cfg["net.keytable.enabled"]:
+                data["keytable"] = self.get_keytable().keys
+            # Always supported, only sending bundles can be disabled
+            data["bundle"] = True
+        else:
+            raise ValueError("Unknown internal packet %s"%ptype)
+        
+        msg = self.prepare(ptype,data)
+        self._prepared_cache[ptype] = (rev,msg)
+        return msg
+    
+    def get_keytable(self):
+        """
+        Returns the :py:class:`~peng3dnet.codec.KeyTable` offered to clients during the handshake.
+        
+        The table is built from the :py:attr:`~peng3dnet.packet.Packet.fieldnames` of all registered
+        packets and rebuilt whenever the registry changes. Clients keep using the table they have
+        accepted during their handshake.
+        """
+        rev = self.registry.revision
+        if self._keytable is None or self._keytable[0]!=rev:
+            keys = set()
+            for pkt in list(self.registry.reg_int_obj.values()):
+                keys.update(pkt.fieldnames)
+            self._keytable = (rev,codec.KeyTable(sorted(keys)))
+        return self._keytable[1]
+    
+    def join_channel(self,cid,channel):
+        """
+        Adds the given client to a channel.
+        
+        ``cid`` should be the Client ID number.
+        
+        ``channel`` may be any hashable object, usually a string. Channels are
+        created on demand and removed once their last member has left.
+        
+        Channels may be used for e.g. chat rooms or lobbies. Messages can be sent
+        to all members of a channel via :py:meth:`publish()`\ .
+        
+        Joining a channel multiple times has no effect. Clients automatically leave all channels once their connection is closed.
+        """
+        client = self.clients[cid]
+        with self._channel_lock:
+            if client.state==STATE_CLOSED:
+                # Would never be removed again
+                return
+            self.channels.setdefault(channel,set()).add(cid)
+            client.channels.add(channel)
+    def leave_channel(self,cid,channel):
+        """
+        Removes the given client from a channel.
+        
+        ``cid`` should be the Client ID number.
         
-        if (isinstance(ptype,int) and ptype<64) or (isinstance(ptype,str) and ptype.startswith("peng3dnet:")) or not self.conntypes[self.clients[cid].conntype].send(data,ptype,cid):
-            self.clients[cid].on_send(ptype,data)
-            self.sendEvent("peng3dnet:server.connection.send",{"client":self.clients[cid],"pid":ptype,"data":data})
-            self.registry.getObj(ptype)._send(data,cid)
+        ``channel`` should be the channel to leave, it is ignored if the client is not a member.
+        """
+        with self._channel_lock:
+            members = self.channels.get(channel,None)
+            if members is not None:
+                members.discard(cid)
+                if not members:
+                    del self.channels[channel]
+            client = self.clients.get(cid,None)
+            if client is not None:
+                client.channels.discard(channel)
+    def _client_closed(self,client):
+        # Called once a client has been closed, Mix-ins may extend this to clean up per-client data
+        self._leave_all_channels(client)
+    def _leave_all_channels(self,client):
+        # Only visits the channels the client is a member of
+        with self._channel_lock:
+            for channel in client.channels:
+                members = self.channels.get(channel,None)
+                if members is not None:
+                    members.discard(client.cid)
+                    if not members:
+                        del self.channels[channel]
+            client.channels.clear()
+    def get_channel_members(self,channel):
+        """
+        Returns a set of the Client ID numbers of all members of the given channel.
+        
+        The returned set is a copy and may be freely modified.
+        """
+        with self._channel_lock:
+            return set(self.channels.get(channel,()))
+    def publish(self,channel,ptype,data,exclude=None):
+        """
+        Sends a message to all members of the given channel.
+        
+        ``ptype`` and ``data`` are the same as for :py:meth:`send_message()`\ .
+        
+        ``exclude`` may be an iterable of Client ID numbers that should not receive the message, e.g. the sender.
+        
+        Like :py:meth:`broadcast()`\ , the message is only encoded once.
+        
+        Returns the number of clients the message has been sent to.
+        """
+        return self._broadcast(ptype,data,cids=self.get_channel_members(channel),exclude=exclude)
+    
+    def _queue_packet(self,client,pid,bufs):
+        # Queues an encoded packet and sends it, if applicable
+        with client._write_lock:
+            if self.cfg["net.send.batch"] and pid>=64:
+                # Internal packets are never delayed
+                if client.bundle and self.cfg["net.send.bundle"]:
+                    client._bundler.add(bufs,client.write_queue,self.cfg,client._compressor)
+                else:
+                    client.write_queue.extend(bufs)
+                if self.cfg["net.sock.cork"] and HAVE_CORK and not client._corked:
+                    # Set once per batch, cleared when the batch has been written completely
+                    _cork(client.conn,True)
+                    client._corked = True
+                if not client._batch_pending:
+                    client._batch_pending = True
+                    self._schedule_flush(client)
+            else:
+                # Packets collected so far must be sent first
+                client._bundler.close(client.write_queue,self.cfg,client._compressor)
+                client.write_queue.extend(bufs)
+                self._write_client(client)
+    def _call_send_handlers(self,client,ptype,data):
+        if (isinstance(ptype,int) and ptype<64) or (isinstance(ptype,str) and ptype.startswith("peng3dnet:")) or not self.conntypes[client.conntype].send(data,ptype,client.cid):
+            client.on_send(ptype,data)
+            self.sendEvent("peng3dnet:server.connection.send",{"client":client,"pid":ptype,"data":data})
+            self.registry.getObj(ptype)._send(data,client.cid)
     
     def register_packet(self,name,obj,n=None):
         """
@@ -634,6 +1580,19 @@ class Server(object):
         """
         self.registry.register(obj,name,n)
     
+    def register_codec(self,name,obj,n=None):
+        """
+        Registers a new codec with the internal codec registry.
+        
+        ``name`` should be a string used by packets to refer to the codec via their :py:attr:`~peng3dnet.packet.Packet.codec` attribute.
+        
+        ``obj`` should be an instance of a subclass of :py:class:`peng3dnet.codec.Codec()`\ .
+        
+        ``n`` may be optionally used to force a codec to use a specific ID, otherwise one will be generated.
+        Note that the ID is not synchronized with the peer, it must match on both sides.
+        """
+        self.codecs.register(obj,name,n)
+    
     def addConnType(self,t,obj):
         """
         Adds a connection type to the internal registry.
@@ -657,8 +1616,9 @@ class Server(object):
         ``reason`` may be a string describing the reason.
         """
         # not removed immediately to ensure that the reason is transmitted
-        self.send_message("peng3dnet:internal.closeconn",{"reason":reason},cid)
+        # Marked before sending to let the main loop close the connection once the packet has been sent
         self.clients[cid]._mark_close = True
+        self.send_message("peng3dnet:internal.closeconn",{"reason":reason},cid)
     
     def process(self,wait=False,timeout=None):
         """
@@ -668,7 +1628,7 @@ class Server(object):
         
         It will then process all packets in the queue, decoding them and then
         calling the appropriate event handlers.
-        This method assumes all messages are packed with msgpack.
+        Messages are decoded with the codec given in their header, see :py:mod:`peng3dnet.codec`\ .
         
         If the connection type allows it, event handlers will be called and the
         :peng3d:event:`peng3dnet:server.connection.recv` event is sent.
@@ -683,29 +1643,34 @@ class Server(object):
         n = 0
         while not (self._process_queue.empty()):
             try:
-                cid,data = self._process_queue.get_nowait()
+                cid,packets = self._process_queue.get_nowait()
             except queue.Empty:
                 break # may happen rarely
-            else:
-                # Pre-process
-                
-                header,body = data[:STRUCT_HEADER.size],data[STRUCT_HEADER.size:]
-                pid,flags = STRUCT_HEADER.unpack(header)
-                
-                if self.cfg["net.debug.print.recv"] and (pid<64 or self.clients[cid].conntype == CONNTYPE_CLASSIC):
-                    print("RECV %s %s"%(self.registry.getStr(pid), time.time()))
-                
-                if flags&FLAG_COMPRESSED:
-                    olen = len(body)
-                    body = zlib.decompress(body)
-                    #print("Received compressed packet, compressed %sb uncompressed %sb, rate %.2f%%"%(olen,len(body),(olen/len(body))*100))
-                if flags&FLAG_ENCRYPTED_AES:
-                    raise NotImplementedError("Encryption not yet implemented")
-
-                msg = msgpack.unpackb(body)
-                
+            client = self.clients.get(cid,None)
+            if client is None:
+                # Connection has been closed in the meantime
+                continue
+            for data in _iter_frames(self,packets,client):
+                # Errors only affect the current frame, not the rest of the batch
                 try:
-                    client = self.clients[cid]
+                    # Pre-process
+                    
+                    # Avoid copying the body, the decoders can read from the view directly
+                    pid,flags = STRUCT_HEADER.unpack_from(data)
+                    body = memoryview(data)[STRUCT_HEADER.size:]
+                    
+                    if self.cfg["net.debug.print.recv"] and (pid<64 or client.conntype == CONNTYPE_CLASSIC):
+                        print("RECV %s %s"%(self.registry.getStr(pid), time.time()))
+                    
+                    if flags&FLAG_COMPRESSED:
+                        olen = len(body)
+                        body = _decompress(self,flags,body,client)
+                        #print("Received compressed packet, compressed %sb uncompressed %sb, rate %.2f%%"%(olen,len(body),(olen/len(body))*100))
+                    if flags&FLAG_ENCRYPTED_AES:
+                        raise NotImplementedError("Encryption not yet implemented")
+                    
+                    msg = _decode_message(self,pid,flags,body,client.keytable)
+                    
                     if pid<64 or not self.conntypes[client.conntype].receive(msg,pid,flags,cid):
                         self.registry.getObj(pid)._receive(msg,cid)
                         client.on_receive(pid,msg)
@@ -770,14 +1735,36 @@ class ClientOnServer(object):
         self.cid = cid
         
         self.write_queue = collections.deque()
+        self._write_offset = 0
+        self._write_lock = threading.Lock()
+        self._write_registered = False
+        self._batch_pending = False
+        self._corked = False
+        
+        self.channels = set()
         
         self.name = None
         
-        self._buf = bytes()
-        self._buflen = None
+        self._buf = ReceiveBuffer(
+            2*self.server.cfg["net.recv.bufsize"],
+            self.server.cfg["net.recv.spool_threshold"],
+            self.server.cfg["net.recv.spool_dir"],
+            )
         
         self._mark_close = False
         
+        # Key table accepted by the client, None if not negotiated
+        self.keytable = None
+        self._keytable_offer = None
+        
+        # Whether the client can receive bundles
+        self.bundle = False
+        self._bundler = _Bundler()
+        
+        # Compression algorithm chosen by the client, zlib if not negotiated
+        self.compression = "zlib"
+        self._compressor = None
+        
         self.mode = MODE_NOTSET
         self.conntype = CONNTYPE_NOTSET
         self.state = STATE_INIT
@@ -798,14 +1785,13 @@ class ClientOnServer(object):
             self.on_close(reason)
         self.state = STATE_CLOSED
         self.mode = MODE_CLOSED
-        try:
-            self.server.selector.unregister(self.conn)
-        except Exception:
-            pass
-        try:
-            self.conn.close()
-        except Exception:
-            pass
+        self.server._client_closed(self)
+        if self.server._in_loop():
+            self.server._release_conn(self.conn)
+        else:
+            # The socket is closed by the main loop, to avoid re-use of the file descriptor while still registered
+            self.server._submit_queue.append(("close",self))
+            self.server.interrupt()
         try:
             # may be already deleted
             del self.server.clients[self.cid]
@@ -929,10 +1915,17 @@ class Client(object):
         
         self._is_connected = False
         self._is_started = False
+        
+        self.connect_state = "init"
+        self._connect_deadline = None
+        self._connect_addrs = None
+        self._connect_error = None
+        
+        self._flush_deadline = None
+        self._corked = False
         self._is_initialized = False
         
-        self._irqrecv = None
-        self._irqsend = None
+        self._waker = None
         
         self._mark_close = False
         self._close_reason = None
@@ -942,10 +1935,15 @@ class Client(object):
         
         self.run = True
         
-        self._buf = bytes()
-        self._buflen = None
+        self._buf = ReceiveBuffer(
+            2*self.cfg["net.recv.bufsize"],
+            self.cfg["net.recv.spool_threshold"],
+            self.cfg["net.recv.spool_dir"],
+            )
         
-        self._write_buf = b""
+        self._write_queue = collections.deque()
+        self._write_offset = 0
+        self._write_lock = threading.RLock()
         
         self.target_conntype = conntype
         self.conntype = CONNTYPE_NOTSET
@@ -954,9 +1952,22 @@ class Client(object):
         self.ssl_state = "handshake"
         self.ssl_seclevel = SSLSEC_NONE
         
+        # Key table received from the server, None if not negotiated
+        self.keytable = None
+        
+        # Whether the server can receive bundles
+        self.bundle = False
+        self._bundler = _Bundler()
+        
+        # Compression algorithm chosen during the handshake, zlib if not negotiated
+        self.compression = "zlib"
+        self._compressor = None
+        
         self.conntypes = {}
         
         self.registry = registry.PacketRegistry()
+        self.codecs = registry.CodecRegistry()
+        self.compressions = registry.CompressionRegistry()
     
     def initialize(self):
         """
@@ -1006,7 +2017,7 @@ class Client(object):
     
     def connect(self):
         """
-        Connects the client with a server.
+        Starts connecting the client with a server.
         
         Note that the server must have been specified before calling this method
         via either the ``addr`` argument to the initializer or any of the
@@ -1016,7 +2027,19 @@ class Client(object):
         
         If SSL is enabled, this method will also initialize the SSL Context and load the certificates.
         
+        This method does not block. If the host is not a numeric address, it
+        is resolved in a separate daemon thread named ``peng3dnet Resolver Thread``\ .
+        The connection itself and the SSL handshake are driven by the main loop,
+        see :py:meth:`runBlocking()`\ . Use :py:meth:`wait_for_connection()` to
+        wait for the connection to be established.
+        
+        The progress of the connection is stored in the :py:attr:`connect_state`
+        attribute, which is one of ``init``\ , ``resolving``\ , ``connecting``\ ,
+        ``handshake``\ , ``connected`` and ``failed``\ .
+        
         After the connection has been made, the :peng3d:event:`peng3dnet.client.connect` event is sent.
+        If the connection could not be made within :confval:`net.client.connect.timeout`
+        seconds, the client is closed with the reason ``connecttimeout``\ .
         """
         if self._is_connected:
             return
@@ -1030,7 +2053,7 @@ class Client(object):
                 self.cfg["net.ssl.enabled"]=False
                 warnings.warn("Potential security weakness because ssl had to be disabled")
             
-            self._irqrecv,self._irqsend = socket.socketpair()
+            self._waker = _Waker()
             
             if self.cfg["net.ssl.enabled"]:
                 self.sslcontext = ssl.create_default_context(ssl.Purpose.SERVER_AUTH,cafile=self.cfg["net.ssl.server.certfile"])
@@ -1043,20 +2066,131 @@ class Client(object):
                 #self.sslcontext.load_verify_locations(self.cfg["net.ssl.cafile"])
                 
                 #print(self.sslcontext.get_ca_certs())
-                
-                self.sock = self.sslcontext.wrap_socket(socket.socket(socket.AF_INET),server_hostname=self.addr[0])
-                self.sock.connect(tuple(self.addr))
                 # TODO: check with self-signed certs
-            else:
-                self.sock = socket.create_connection(tuple(self.addr))
             
-                self.sock.setblocking(True)
-                
-                self.remote_state = STATE_HELLOWAIT
+            if self.cfg["net.client.connect.timeout"] is not None:
+                self._connect_deadline = time.time()+self.cfg["net.client.connect.timeout"]
             
             self._is_connected = True
             
-            self.sendEvent("peng3dnet:client.connect",{"addr":tuple(self.addr),"sock":self.sock})
+            host,port = self.addr[0],self.addr[1]
+            try:
+                # Numeric addresses do not require a lookup
+                self._connect_addrs = socket.getaddrinfo(host,port,0,socket.SOCK_STREAM,0,socket.AI_NUMERICHOST)
+            except socket.gaierror:
+                self.connect_state = "resolving"
+                t = threading.Thread(name="peng3dnet Resolver Thread",target=self._resolve,args=[host,port])
+                t.daemon = True
+                t.start()
+            else:
+                self._connect_next()
+    
+    def _resolve(self,host,port):
+        # Runs in a separate thread, as getaddrinfo() may block for a long time
+        try:
+            self._connect_addrs = socket.getaddrinfo(host,port,0,socket.SOCK_STREAM)
+        except OSError as e:
+            self._connect_error = e
+            self._connect_addrs = []
+        # The main loop picks up the result
+        self._waker.wake()
+    
+    def _connect_next(self):
+        # Starts a non-blocking connection attempt to the next resolved address
+        while self._connect_addrs:
+            family,socktype,proto,_,sockaddr = self._connect_addrs.pop(0)
+            sock = socket.socket(family,socktype,proto)
+            sock.setblocking(False)
+            _configure_socket(sock,self.cfg)
+            err = sock.connect_ex(sockaddr)
+            if err in (0,errno.EINPROGRESS,errno.EWOULDBLOCK,errno.EAGAIN):
+                self.sock = sock
+                self.connect_state = "connecting"
+                self._set_interest(selectors.EVENT_WRITE)
+                return
+            sock.close()
+            self._connect_error = OSError(err,os.strerror(err))
+        self._connect_failed("connectfailed")
+    
+    def _continue_connect(self):
+        # Called by the main loop whenever the socket is ready during connecting
+        if self.connect_state == "connecting":
+            err = self.sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+            if err!=0:
+                self._connect_error = OSError(err,os.strerror(err))
+                self._unregister_sock()
+                self.sock.close()
+                self._connect_next()
+                return
+            
+            if self.cfg["net.ssl.enabled"]:
+                # The wrapped socket replaces the raw socket in the selector
+                self._unregister_sock()
+                self.sock = self.sslcontext.wrap_socket(self.sock,server_hostname=self.addr[0],do_handshake_on_connect=False)
+                self.connect_state = "handshake"
+                self._connected()
+            else:
+                self.connect_state = "connected"
+                self._connected()
+                return
+        
+        if self.connect_state == "handshake":
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantWriteError:
+                self._set_interest(selectors.EVENT_READ|selectors.EVENT_WRITE)
+            except ssl.SSLWantReadError:
+                self._set_interest(selectors.EVENT_READ)
+            except OSError as e:
+                self._connect_error = e
+                self._connect_failed("connectfailed")
+            else:
+                # Connected only now, the server may now send its hello
+                self.ssl_state = "connected"
+                self.connect_state = "connected"
+                self._connect_deadline = None
+                self.remote_state = STATE_HELLOWAIT
+                self.pump_write_buffer()
+    
+    def _connected(self):
+        # Called once the underlying connection has been established
+        if self.connect_state == "connected":
+            self._connect_deadline = None
+            self.remote_state = STATE_HELLOWAIT
+            self._set_interest(selectors.EVENT_READ)
+            self.pump_write_buffer()
+        
+        self.sendEvent("peng3dnet:client.connect",{"addr":tuple(self.addr),"sock":self.sock})
+        self.on_connect()
+    
+    def _connect_failed(self,reason):
+        if self._connect_error is None:
+            self._connect_error = reason
+        self.connect_state = "failed"
+        self._connect_deadline = None
+        self.close(reason)
+        with self._connected_condition:
+            self._connected_condition.notify_all()
+    
+    def _set_interest(self,events):
+        # Registers the socket or changes the events it is waiting for
+        with self._selector_lock:
+            if self.selector is None:
+                # Registered by runBlocking() later on
+                return
+            try:
+                key = self.selector.get_key(self.sock)
+            except KeyError:
+                self.selector.register(self.sock,events,[self._sock_ready,self])
+            else:
+                if key.events!=events:
+                    self.selector.modify(self.sock,events,[self._sock_ready,self])
+    def _unregister_sock(self):
+        with self._selector_lock:
+            try:
+                self.selector.unregister(self.sock)
+            except (AttributeError,KeyError,ValueError):
+                pass
     
     def runBlocking(self,selector=selectors.DefaultSelector):
         """
@@ -1064,6 +2198,8 @@ class Client(object):
         
         ``selector`` may be changed to override the selector used for smart waiting.
         
+        The connection to the server is also driven by this loop, see :py:meth:`connect()`\ .
+        
         This method blocks until :py:meth:`stop()` is called.
         """
         if self._is_started:
@@ -1075,23 +2211,32 @@ class Client(object):
                 return
             
             self.selector = selector()
-            self.selector.register(self.sock,selectors.EVENT_READ,[self._sock_ready,self])
+            if self.connect_state == "connecting":
+                self.selector.register(self.sock,selectors.EVENT_WRITE,[self._sock_ready,self])
             
-            self.selector.register(self._irqrecv,selectors.EVENT_READ,[self._sock_ready,None])
-            self.selector.register(self._irqsend,selectors.EVENT_READ,[self._sock_ready,None])
+            self.selector.register(self._waker,selectors.EVENT_READ,[self._sock_ready,None])
             
             self._is_started = True
             
             self.sendEvent("peng3dnet:client.start",{})
         
         while self.run:
-            events = self.selector.select()
+            deadlines = [d for d in (self._connect_deadline,self._flush_deadline) if d is not None]
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines)-time.time(),0)
+            events = self.selector.select(timeout)
             for key,mask in events:
                 callback,data = key.data
                 try:
                     callback(key.fileobj, mask, data)
                 except Exception:
                     import traceback;traceback.print_exc() # Ignore exceptions for now...
+            t = time.time()
+            if self._connect_deadline is not None and t>=self._connect_deadline:
+                self._connect_failed("connecttimeout")
+            if self._flush_deadline is not None and t>=self._flush_deadline:
+                self.flush()
     def runAsync(self,selector=selectors.DefaultSelector):
         """
         Runs the client main loop in a seperate thread.
@@ -1120,15 +2265,17 @@ class Client(object):
         self.interrupt()
     def interrupt(self):
         """
-        Wakes up the main loop by sending a special message to an internal socket.
+        Wakes up the main loop by signalling an internal file descriptor.
         
         This forces the main loop to iterate once and check that the system is still running.
         
+        See :py:meth:`Server.interrupt()` for details.
+        
         Also sends the :peng3d:event:`peng3dnet:client.interrupt` event.
         """
         # simply wakes the main loop up
         # used to force a check if the system is still running
-        self._irqsend.sendall(b"wake up!")
+        self._waker.wake()
         self.sendEvent("peng3dnet:client.interrupt",{})
     
     def join(self,timeout=None):
@@ -1153,67 +2300,69 @@ class Client(object):
                 self._process_thread.join(max(ft-time.time(),0))
     
     def _sock_ready(self,sock,mask,data):
-        if data is not None and self.cfg["net.ssl.enabled"] and self.ssl_state=="handshake" and sock is self.sock:
-            # SSL Handshake not yet complete
-            try:
-                sock.do_handshake()
-            except ssl.SSLWantWriteError:
-                skey = self.selector.get_key(sock)
-                if not skey&selectors.EVENT_WRITE:
-                    self.selector.modify(sock,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._sock_ready,None])
-                    # Interrupt not necessary, as this callback should be called while not selecting
-            except ssl.SSLWantReadError:
-                # Should wait by itself again...
-                pass
-            else:
-                # Connected only now, send init packets
-                self.ssl_state = "connected"
+        if sock is self.sock and self.connect_state in ["connecting","handshake"]:
+            # Connection or SSL Handshake not yet complete
+            self._continue_connect()
             return
         
-        if sock==self._irqrecv:
-            dat = sock.recv(8)
-            if dat!=b"wake up!":
-                sock.sendall(b"wrong socket")
-            return
-        elif sock==self._irqsend:
-            # should not happen
-            sock.recv(1024)
+        if sock is self._waker:
+            self._waker.drain()
+            if self.connect_state == "resolving" and self._connect_addrs is not None:
+                # Name resolution has finished
+                self._connect_next()
             return
         if (mask & selectors.EVENT_READ):
             # Readable
             
-            if self.cfg["net.ssl.enabled"]:
-                try:
-                    dat = sock.recv(1024)
-                except ssl.SSLWantWriteError:
-                    skey = self.selector.get_key(sock)
-                    if not skey&selectors.EVENT_WRITE:
-                        self.selector.modify(sock,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._sock_ready,None])
-                        # Interrupt not necessary, as this callback should be called while not selecting
-                    dat = ""
-                except ssl.SSLWantReadError:
-                    dat = ""
-            else:
-                dat = sock.recv(1024)
-            if dat:
-                # Non-empty
-                try:
-                    self.receive_data(dat)
-                except Exception:
-                    import traceback;traceback.print_exc()
-            else:
-                self.close("socketclose")
+            self._read_sock(sock)
         
         if (mask & selectors.EVENT_WRITE):
             # Writeable
             
             self.pump_write_buffer()
     
+    def _read_sock(self,sock):
+        # Reads from the socket until it would block or the budget is used up
+        bufsize = self.cfg["net.recv.bufsize"]
+        budget = self.cfg["net.recv.budget"]
+        total = 0
+        while total<budget:
+            try:
+                n = self._buf.recv_into(sock,bufsize)
+            except _SSLWantWriteError:
+                skey = self.selector.get_key(sock)
+                if not skey.events&selectors.EVENT_WRITE:
+                    self.selector.modify(sock,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._sock_ready,None])
+                    # Interrupt not necessary, as this callback should be called while not selecting
+                return
+            except (BlockingIOError,_SSLWantReadError):
+                # Nothing left to read, try again later
+                return
+            
+            if n==0:
+                self.close("socketclose")
+                return
+            total+=n
+            
+            try:
+                self.process_packets()
+            except errors.PacketTooLongError:
+                # The rest of the stream cannot be parsed anymore
+                self.close("packettoolong")
+                return
+            except Exception:
+                import traceback;traceback.print_exc()
+            
+            if n<bufsize and not self.cfg["net.ssl.enabled"]:
+                # Short read, the socket has most likely been drained
+                return
+    
     def send_message(self,ptype,data,cid=None):
         """
         Sends a message to the server.
         
         ``ptype`` should be a valid packet type, e.g. either an ID, name or object.
+        It may also be a :py:class:`PreparedMessage`\ , in which case ``data`` is ignored.
         
         ``data`` should be the data to send to the server.
         
@@ -1222,8 +2371,16 @@ class Client(object):
         Note that all data encoding will be done synchronously and may cause this method to not return immediately.
         The packet may also be encrypted and compressed, if applicable.
         
+        If :confval:`net.send.batch` is enabled, the packet is only queued
+        until :py:meth:`flush()` is called or :confval:`net.send.batch.maxdelay` has passed.
+        
         Additionally, the :peng3d:event:`peng3dnet:client.send` event is sent if the connection type allows it.
         """
+        if isinstance(ptype,PreparedMessage):
+            ptype,pid,data,bufs = ptype.ptype,ptype.pid,ptype.data,_get_prepared_bufs(self,ptype,self.keytable,self._compressor)
+        else:
+            pid,bufs = None,None
+        
         if self.cfg["net.debug.print.send"]:
             print("SEND %s"%ptype)
         if (isinstance(ptype,int) and ptype<64) or (isinstance(ptype,str) and ptype.startswith("peng3dnet:")) or not self.conntypes[self.target_conntype].send(data,ptype,cid):
@@ -1231,23 +2388,52 @@ class Client(object):
             self.sendEvent("peng3dnet:client.send",{"pid":ptype,"data":data})
             self.registry.getObj(ptype)._send(data)
         
-        data = msgpack.dumps(data)
-        
-        flags = 0
-        
-        if len(data)>self.cfg["net.compress.threshold"] and self.cfg["net.compress.enabled"]:
-            data = zlib.compress(data,self.cfg["net.compress.level"])
-            flags = flags|FLAG_COMPRESSED
+        if bufs is None:
+            # Encoded after calling the handlers, as they may modify the data
+            pid = self.registry.getInt(ptype)
+            bufs = _encode_message(self,pid,data,self.keytable,self._compressor)
         
-        header = STRUCT_HEADER.pack(self.registry.getInt(ptype),flags)
-        data = header+data
-        
-        prefix = STRUCT_LENGTH32.pack(len(data))
-        data = prefix+data
+        with self._write_lock:
+            if self.cfg["net.send.batch"] and pid>=64:
+                # Internal packets are never delayed
+                if self.bundle and self.cfg["net.send.bundle"]:
+                    self._bundler.add(bufs,self._write_queue,self.cfg,self._compressor)
+                else:
+                    self._write_queue.extend(bufs)
+                if self.cfg["net.sock.cork"] and HAVE_CORK and not self._corked and self.connect_state=="connected":
+                    # Set once per batch, cleared when the batch has been written completely
+                    _cork(self.sock,True)
+                    self._corked = True
+                if self._flush_deadline is None and self.cfg["net.send.batch.maxdelay"] is not None:
+                    self._flush_deadline = time.time()+self.cfg["net.send.batch.maxdelay"]
+                    # The main loop may currently wait without a timeout
+                    self.interrupt()
+            else:
+                # Packets collected so far must be sent first
+                self._bundler.close(self._write_queue,self.cfg,self._compressor)
+                self._write_queue.extend(bufs)
+                self._flush_deadline = None
+                self._pump_write_buffer()
+    
+    def prepare(self,ptype,data):
+        """
+        Prepares a message for sending it repeatedly while only encoding it once.
         
-        self._write_buf+=bytes(data)
+        See :py:meth:`Server.prepare()` for details.
+        """
+        pid = self.registry.getInt(ptype)
+        return PreparedMessage(ptype,pid,data)
+    
+    def flush(self):
+        """
+        Sends all packets collected while :confval:`net.send.batch` is enabled.
         
-        self.pump_write_buffer()
+        See :py:meth:`Server.flush()` for details.
+        """
+        with self._write_lock:
+            self._flush_deadline = None
+            self._bundler.close(self._write_queue,self.cfg,self._compressor)
+            self._pump_write_buffer()
     
     def pump_write_buffer(self):
         """
@@ -1256,76 +2442,129 @@ class Client(object):
         Note that depending on various factors, not all data may be sent at once.
         It is possible that sent data will be fragmented at arbitrary points.
         
+        If available, multiple queued packets are sent with a single call of :py:meth:`socket.socket.sendmsg()`\ .
+        
         If an exception occurs while sending the data, it will be ignored and the error printed to the console.
         """
-        if len(self._write_buf)==0:
+        with self._write_lock:
+            self._pump_write_buffer()
+    def _pump_write_buffer(self):
+        if self.connect_state!="connected":
+            # Sent once the connection has been established
+            return
+        if len(self._write_queue)==0:
+            self._uncork()
+            self._clear_write_interest()
             return
         
         try:
-            if self.cfg["net.ssl.enabled"]:
-                # TODO: check if the current SSL bug may be related to not calling the handshake method here.
-                try:
-                    bytes_sent = self.sock.send(self._write_buf)
-                except ssl.SSLWantWriteError:
-                    # Should already be in write mode
-                    bytes_sent = 0
-                except ssl.SSLWantReadError:
-                    # Will be in read mode
-                    bytes_sent = 0
-            else:
-                bytes_sent = self.sock.send(self._write_buf)
-            self._write_buf = self._write_buf[bytes_sent:]
-            if len(self._write_buf)==0:
+            self._write_offset = _send_queued(self.sock,self._write_queue,self._write_offset,self.cfg["net.ssl.enabled"])
+            if len(self._write_queue)==0:
+                self._uncork()
                 if self._mark_close:
                     with self._selector_lock:
                         self.selector.unregister(self.sock)
                     self.on_close(self._close_reason)
+                else:
+                    self._clear_write_interest()
                 return # sent everything in one go
             if not (self.selector.get_key(self.sock).events&selectors.EVENT_WRITE):
-                self.selector.modify(self.sock,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._sock_ready,None])
+                # Socket buffer is full, wait for it to become writeable
+                self.selector.modify(self.sock,selectors.EVENT_READ|selectors.EVENT_WRITE,[self._sock_ready,self])
                 self.interrupt()
         except Exception:
             import traceback;traceback.print_exc()
+    def _uncork(self):
+        # Must be called while holding the write lock
+        # Sends the remaining partial segments once a batch has been written completely
+        if self._corked:
+            _cork(self.sock,False)
+            self._corked = False
+    def _clear_write_interest(self):
+        # Prevents the main loop from spinning on an always-writeable socket
+        try:
+            if self.selector.get_key(self.sock).events&selectors.EVENT_WRITE:
+                self.selector.modify(self.sock,selectors.EVENT_READ,[self._sock_ready,self])
+        except (AttributeError,KeyError,ValueError):
+            # Not yet started or already closed
+            pass
     
     def receive_data(self,data,cid=None):
         """
-        Called when new raw data has been read from the socket.
+        Called when new raw data has been received from the server.
         
         Note that the given ``data`` may contain only parts of a packet or even multiple packets.
         
         ``cid`` is a dummy value used for compatibility with server applications.
         
-        By default, the received data is stored in a buffer until enough data is available to process a packet, then :py:meth:`process_single_packet()` is called.
+        By default, the received data is appended to the internal :py:class:`ReceiveBuffer`\ ,
+        then :py:meth:`process_packets()` is called.
+        
+        Note that data read from the socket is written directly to the buffer and
+        does not pass through this method.
         """
-        # Length prefix code
-        self._buf+=data
-        while (self._buflen is None and len(self._buf)>0) or (self._buflen is not None and len(self._buf)>=self._buflen):
-            self.process_single_packet()
+        self._buf.feed(data)
+        self.process_packets()
+    def process_packets(self,client=None):
+        """
+        Called when there may be enough data to process one or more packets.
+        
+        ``client`` is a dummy value used for compatibility with server applications.
+        
+        Currently extracts all complete packets from the receive buffer and calls
+        :py:meth:`receive_packets()` once with all of them.
+        
+        The length of packets is limited according to :py:meth:`get_max_packetlength()`\ .
+        
+        Returns the number of packets extracted.
+        """
+        packets = []
+        maxlen = self.get_max_packetlength()
+        try:
+            data = self._buf.next_frame(maxlen)
+            while data is not None:
+                packets.append(data)
+                data = self._buf.next_frame(maxlen)
+        finally:
+            # Packets extracted before an error should still be processed
+            if packets:
+                self.receive_packets(packets)
+        return len(packets)
     def process_single_packet(self,client=None):
         """
-        Called when there should be enough data to process a single packet.
+        Called when there may be enough data to process a single packet.
+        
+        ``client`` is a dummy value used for compatibility with server applications.
         
-        ``client`` is a dummy value used for compatibilizy with server applications.
+        Currently extracts a single packet from the receive buffer and calls
+        :py:meth:`receive_packet()` with the packet data.
         
-        Currently parses a single packet including length prefix and calls :py:meth:`receive_packet()` with the packet data.
+        Returns ``True`` if a packet has been processed, else ``False``\ .
         """
-        if self._buflen is None:
-            # Previous packet has been processed, begin new packet
-            if len(self._buf)<STRUCT_LENGTH32.size:
-                # Prevents errors
-                return
-            self._buflen = STRUCT_LENGTH32.unpack(self._buf[:STRUCT_LENGTH32.size])[0]
-            self._buf = self._buf[STRUCT_LENGTH32.size:]
-            if self._buflen>MAX_PACKETLENGTH:
-                # Should be pretty rare, but still
-                raise ValueError("Packet too long")
-        
-        if len(self._buf)>=self._buflen:
-            # Enough data has been gathered, process it
-            data = self._buf[:self._buflen]
-            self._buf = self._buf[self._buflen:]
-            self._buflen = None
-            self.receive_packet(data)
+        data = self._buf.next_frame(self.get_max_packetlength())
+        if data is None:
+            return False
+        self.receive_packet(data)
+        return True
+    def get_max_packetlength(self,client=None):
+        """
+        Returns the maximum length in bytes of a packet that may currently be received from the server.
+        
+        ``client`` is a dummy value used for compatibility with server applications.
+        
+        See :py:meth:`Server.get_max_packetlength()` for details on how this limit is determined.
+        :confval:`net.recv.maxlen.handshake` only applies until the connection type has
+        been sent, as the handshake packet sent by the server afterwards contains the whole registry.
+        """
+        if self.remote_state in _HANDSHAKE_STATES:
+            maxlen = self.cfg["net.recv.maxlen.handshake"]
+        else:
+            maxlen = self.cfg["net.recv.maxlen.active"]
+        
+        conntype = self.conntypes.get(self.target_conntype,None)
+        if conntype is not None and conntype.max_packetlength is not None:
+            maxlen = min(maxlen,conntype.max_packetlength)
+        return maxlen
     def receive_packet(self,data,cid=None):
         """
         Called when a full packet has been received.
@@ -1334,9 +2573,21 @@ class Client(object):
         
         ``cid`` is a dummy value used for compatibility with server applications.
         
-        Currently, this puts the data in a queue to be processed further by :py:meth:`process()`\ .
+        Currently, this calls :py:meth:`receive_packets()` with a batch containing only this packet.
         """
-        self._process_queue.put([None,data])
+        self.receive_packets([data])
+    def receive_packets(self,packets,cid=None):
+        """
+        Called when one or more full packets have been received.
+        
+        ``packets`` is a list of raw packet data without length prefixes, in the order they were received.
+        
+        ``cid`` is a dummy value used for compatibility with server applications.
+        
+        Currently, this puts the whole batch in a queue to be processed further by :py:meth:`process()`\ .
+        Waiting threads will only be notified once per batch.
+        """
+        self._process_queue.put([None,packets])
         with self._process_condition:
             self._process_condition.notify()
     
@@ -1352,6 +2603,19 @@ class Client(object):
         """
         self.registry.register(obj,name,n)
     
+    def register_codec(self,name,obj,n=None):
+        """
+        Registers a new codec with the internal codec registry.
+        
+        ``name`` should be a string used by packets to refer to the codec via their :py:attr:`~peng3dnet.packet.Packet.codec` attribute.
+        
+        ``obj`` should be an instance of a subclass of :py:class:`peng3dnet.codec.Codec()`\ .
+        
+        ``n`` may be optionally used to force a codec to use a specific ID, otherwise one will be generated.
+        Note that the ID is not synchronized with the peer, it must match on both sides.
+        """
+        self.codecs.register(obj,name,n)
+    
     def addConnType(self,t,obj):
         """
         Adds a connection type to the internal registry.
@@ -1387,7 +2651,7 @@ class Client(object):
         
         It will then process all packets in the queue, decoding them and then
         calling the appropriate event handlers.
-        This method assumes all messages are packed with msgpack.
+        Messages are decoded with the codec given in their header, see :py:mod:`peng3dnet.codec`\ .
         
         If the connection type allows it, event handlers will be called and the
         :peng3d:event:`peng3dnet:client.recv` event is sent.
@@ -1400,30 +2664,35 @@ class Client(object):
         n = 0
         while not (self._process_queue.empty()):
             try:
-                _,data = self._process_queue.get_nowait()
+                _,packets = self._process_queue.get_nowait()
             except queue.Empty:
                 break # may happen rarely
-            else:
-                header,body = data[:STRUCT_HEADER.size],data[STRUCT_HEADER.size:]
-                pid,flags = STRUCT_HEADER.unpack(header)
-                
-                if self.cfg["net.debug.print.recv"] and (pid<64 or self.target_conntype==CONNTYPE_CLASSIC):
-                    print("RECV %s"%self.registry.getStr(pid))
-                
-                if flags&FLAG_COMPRESSED:
-                    body = zlib.decompress(body)
-                if flags&FLAG_ENCRYPTED_AES:
-                    raise NotImplementedError("Encryption not yet implemented")
-
-                msg = msgpack.unpackb(body)
-                
-                with self._process_lock:
-                    # No error catching, for better debugging
-                    if pid<64 or not self.conntypes[self.target_conntype].receive(msg,pid,flags,None):
-                        self.registry.getObj(pid)._receive(msg)
-                        self.on_receive(pid,msg)
-                        self.sendEvent("peng3dnet:client.recv",{"pid":pid,"msg":msg})
-                    n+=1
+            for data in _iter_frames(self,packets):
+                # Errors only affect the current frame, not the rest of the batch
+                try:
+                    # Avoid copying the body, the decoders can read from the view directly
+                    pid,flags = STRUCT_HEADER.unpack_from(data)
+                    body = memoryview(data)[STRUCT_HEADER.size:]
+                    
+                    if self.cfg["net.debug.print.recv"] and (pid<64 or self.target_conntype==CONNTYPE_CLASSIC):
+                        print("RECV %s"%self.registry.getStr(pid))
+                    
+                    if flags&FLAG_COMPRESSED:
+                        body = _decompress(self,flags,body)
+                    if flags&FLAG_ENCRYPTED_AES:
+                        raise NotImplementedError("Encryption not yet implemented")
+                    
+                    msg = _decode_message(self,pid,flags,body,self.keytable)
+                    
+                    with self._process_lock:
+                        if pid<64 or not self.conntypes[self.target_conntype].receive(msg,pid,flags,None):
+                            self.registry.getObj(pid)._receive(msg)
+                            self.on_receive(pid,msg)
+                            self.sendEvent("peng3dnet:client.recv",{"pid":pid,"msg":msg})
+                except Exception:
+                    # Printed instead of raised, as raising would drop the rest of the batch and stop process_forever()
+                    import traceback;traceback.print_exc()
+                n+=1
         return n
     def process_forever(self):
         """
@@ -1478,12 +2747,19 @@ class Client(object):
         Waits up to ``timeout`` seconds for the connection to be established.
         
         Returns immediately if there is an active connection.
+        
+        If the connection could not be established, a :py:exc:`~peng3dnet.errors.FailedConnectionError`
+        is raised. This includes the :confval:`net.client.connect.timeout` expiring.
         """
         with self._connected_condition:
+            if self.connect_state == "failed":
+                raise errors.FailedConnectionError("Could not connect to server: %s"%self._connect_error)
             if self.remote_state>=STATE_ACTIVE:
                 return # Already connected
             if not self._connected_condition.wait(timeout):
                 raise errors.TimedOutError("Timed out waiting for connection")
+            if self.connect_state == "failed":
+                raise errors.FailedConnectionError("Could not connect to server: %s"%self._connect_error)
     
     def wait_for_close(self,timeout=None):
         """
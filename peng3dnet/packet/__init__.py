@@ -24,9 +24,14 @@
 
 __all__ = [
     "Packet", "SmartPacket",
+    "BinaryPacket","StructPacket","DeltaPacket",
     "PrintPacket",
     ]
 
+import struct
+import collections
+import threading
+
 from ..constants import *
 from .. import errors
 
@@ -45,6 +50,36 @@ class Packet(object):
         self.reg = reg
         self.peer = peer
         self.obj = obj
+    
+    codec = "msgpack"
+    """
+    Name or ID of the codec used to encode the payload of this packet.
+    
+    The codec must be registered with the :py:class:`~peng3dnet.registry.CodecRegistry`
+    of both peers, see :py:mod:`peng3dnet.codec` for the built-in codecs.
+    
+    Defaults to ``msgpack``\ , which allows for arbitrary messages to be sent.
+    """
+    compress = True
+    """
+    Determines whether or not messages of this packet type may be compressed.
+    
+    Should be set to ``False`` for payloads that are already compressed, e.g.
+    images or compressed chunk data, as compressing them again only wastes time.
+    
+    Note that packets are only compressed if enabled via :confval:`net.compress.enabled`\ .
+    """
+    fieldnames = []
+    """
+    List of dictionary keys commonly used within messages of this packet type.
+    
+    The keys of all registered packets are combined into a :py:class:`~peng3dnet.codec.KeyTable`
+    that is negotiated during the handshake. Afterwards, these keys are replaced with
+    small integers in messages of all packet types that declare at least one key, including
+    keys of nested dictionaries.
+    
+    Only used with the ``msgpack`` codec.
+    """
     def _receive(self,msg,cid=None):
         """
         Internal handler called whenever a packet of this type is received.
@@ -217,6 +252,302 @@ class SmartPacket(Packet):
         return False
     _send.__noautodoc__ = True
 
+class BinaryPacket(SmartPacket):
+    """
+    Smart packet type for raw binary payloads, e.g. chunk data or textures.
+    
+    The payload is not encoded with msgpack, but sent as-is via the :py:class:`~peng3dnet.codec.RawCodec`\ .
+    Messages sent with this packet type must be :py:class:`bytes`\ , :py:class:`bytearray`
+    or :py:class:`memoryview` objects. Large :py:class:`bytes` objects are not copied
+    while sending, making this the preferred type for sending them.
+    
+    Received messages are passed to :py:meth:`receive()` as a :py:class:`memoryview`
+    of the received frame, without copying it. The view stays valid as long as it
+    is referenced, call :py:func:`bytes()` on it to get a copy.
+    
+    If the payload is already compressed, :py:attr:`~Packet.compress` should be set to ``False``\ .
+    
+    All checks of :py:class:`SmartPacket` are still applied.
+    """
+    codec = "raw"
+
+class StructPacket(SmartPacket):
+    """
+    Smart packet type for small messages with a fixed layout, e.g. position updates.
+    
+    Instead of msgpack, messages are encoded via a :py:class:`struct.Struct`
+    compiled once from the :py:attr:`fields` declared by subclasses. This results in
+    much smaller packets that are faster to encode and decode, as no field names
+    are transmitted.
+    
+    Messages may be given as a sequence of values in field order, e.g. an instance
+    of :py:attr:`record`\ , or as a dictionary mapping field names to values.
+    They are received as an instance of :py:attr:`record`\ .
+    
+    Example::
+        
+        class PositionPacket(StructPacket):
+            fields = [("eid","I"),("x","f"),("y","f"),("z","f")]
+        
+        server.send_message("game:position",{"eid":1,"x":0.,"y":64.,"z":0.},cid)
+    
+    If :py:attr:`array` is true, messages are lists of records instead.
+    
+    All checks of :py:class:`SmartPacket` are still applied.
+    """
+    codec = "struct"
+    
+    fields = []
+    """
+    List of ``(name,format)`` tuples describing the fields of this packet.
+    
+    ``format`` may be any :py:mod:`struct` format describing a single value, e.g.
+    ``I`` for an unsigned 32-bit integer, ``f`` for a float or ``16s`` for a
+    byte string with a fixed length of 16 bytes.
+    """
+    byteorder = "!"
+    """
+    Byte order prefix of the struct, see :py:mod:`struct` for possible values.
+    
+    Defaults to network byte order.
+    """
+    array = False
+    """
+    If true, messages of this packet type are lists containing any number of records.
+    
+    All records are packed back-to-back, without any additional overhead.
+    """
+    def __init__(self,reg,peer,obj=None):
+        super().__init__(reg,peer,obj)
+        
+        for name,fmt in self.fields:
+            if len(struct.Struct(self.byteorder+fmt).unpack(bytes(struct.calcsize(self.byteorder+fmt))))!=1:
+                raise ValueError("Format '%s' of field %s does not describe exactly one value"%(fmt,name))
+        
+        self.struct = struct.Struct(self.byteorder+"".join(fmt for name,fmt in self.fields))
+        """
+        Precompiled :py:class:`struct.Struct` instance used to encode and decode single records.
+        """
+        self.record = collections.namedtuple(self.__class__.__name__+"Record",[name for name,fmt in self.fields])
+        """
+        :py:func:`~collections.namedtuple` type used for received records.
+        """
+
+def _delta_equal(a,b):
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    try:
+        # May fail or return arrays for e.g. ndarrays
+        r = a==b
+    except ValueError:
+        return False
+    return r if isinstance(r,bool) else False
+
+def _delta_snapshot(value):
+    # Copies all mutable containers, other values are assumed to not be modified in-place
+    if type(value) is dict:
+        return {k:_delta_snapshot(v) for k,v in value.items()}
+    elif type(value) is list:
+        return [_delta_snapshot(v) for v in value]
+    return value
+
+def _delta_diff(old,new):
+    # Returns a snapshot of new and the delta from old to new
+    # Unchanged parts of the snapshot are shared with old, which is never modified
+    snap = {}
+    changed = {}
+    sub = {}
+    for k,v in new.items():
+        if k in old:
+            ov = old[k]
+            if type(v) is dict and type(ov) is dict:
+                snap[k],d = _delta_diff(ov,v)
+                if d:
+                    sub[k] = d
+                else:
+                    snap[k] = ov
+                continue
+            elif _delta_equal(ov,v):
+                snap[k] = ov
+                continue
+        snap[k] = changed[k] = _delta_snapshot(v)
+    removed = [k for k in old if k not in new]
+    
+    delta = {}
+    if changed:
+        delta["set"] = changed
+    if removed:
+        delta["del"] = removed
+    if sub:
+        delta["sub"] = sub
+    return snap,delta
+
+def _delta_apply(state,delta):
+    # Applies the delta in-place, raises KeyError if it does not match the state
+    for k in delta.get("del",[]):
+        del state[k]
+    state.update(delta.get("set",{}))
+    for k,d in delta.get("sub",{}).items():
+        if type(state.get(k,None)) is not dict:
+            raise KeyError(k)
+        _delta_apply(state[k],d)
+
+class DeltaPacket(SmartPacket):
+    """
+    Smart packet type for large state dictionaries that only change partially between sends.
+    
+    Instead of :py:meth:`~peng3dnet.net.Server.send_message()`\ , states should be
+    sent via :py:meth:`send_state()` or :py:meth:`broadcast_state()`\ . Both sides
+    keep the last state sent or received per connection as a baseline. Only keys that
+    have been added, changed or removed since the baseline are transmitted, recursing
+    into nested dictionaries.
+    
+    The receiving side reconstructs the full state and passes it to :py:meth:`receive()`\ .
+    Note that this dictionary is the baseline for the next update and must not be modified.
+    
+    Every update carries a sequence number and the sequence number of the baseline it
+    is based on. If the receiving side detects that it is not in sync anymore, e.g.
+    because a packet has been ignored, it automatically requests a full resync from
+    the sending side. A resync can also be requested manually via :py:meth:`request_resync()`
+    or forced by the sending side via :py:meth:`reset()`\ .
+    
+    Dictionaries and lists within the state are copied when sending, other values must
+    not be modified in-place after sending them.
+    
+    Packets of this type are exchanged in both directions, :py:attr:`~SmartPacket.side`
+    should thus not be restricted.
+    """
+    fieldnames = ["seq","base","set","del","sub","full","resync"]
+    def __init__(self,reg,peer,obj=None):
+        super().__init__(reg,peer,obj)
+        
+        self._seq = 0
+        self._sent = {}     # cid -> (seq,snapshot), shared between clients in sync
+        self._recv = {}     # cid -> [seq,state] or None while waiting for a resync
+        self._delta_lock = threading.RLock()
+    
+    def send_state(self,state,cid=None):
+        """
+        Sends the given state dictionary to a single peer.
+        
+        ``cid`` should be the Client ID number on the server side and ``None`` on the client side.
+        
+        If nothing has changed since the last state sent to this peer, nothing will be sent.
+        """
+        self.broadcast_state(state,[cid])
+    def broadcast_state(self,state,cids=None):
+        """
+        Sends the given state dictionary to multiple clients at once.
+        
+        ``cids`` may be an iterable of Client ID numbers, by default the state is sent
+        to all clients that have completed the handshake.
+        
+        Every delta is only computed and encoded once for all clients that share the same
+        baseline, which is usually the case for all clients that received the previous state.
+        
+        Only available on the server side, use :py:meth:`send_state()` on the client side.
+        """
+        if cids is None:
+            cids = [cid for cid,client in list(self.peer.clients.items()) if client.state==STATE_ACTIVE]
+        pid = self.reg.getInt(self)
+        
+        with self._delta_lock:
+            if self.peer.is_server:
+                # Forget baselines of clients that have disconnected in the meantime
+                for d in [self._sent,self._recv]:
+                    for cid in [cid for cid in d if cid not in self.peer.clients]:
+                        del d[cid]
+            
+            # Group peers by their baseline, so that deltas are only computed once
+            groups = collections.OrderedDict()
+            for cid in cids:
+                base = self._sent.get(cid,None)
+                groups.setdefault(id(base),(base,[]))[1].append(cid)
+            
+            self._seq+=1
+            snap = None
+            for base,gcids in groups.values():
+                if base is None:
+                    continue
+                newsnap,delta = _delta_diff(base[1],state if snap is None else snap)
+                if not delta:
+                    # Nothing changed, the old baseline remains valid
+                    continue
+                snap = newsnap if snap is None else snap
+                self._send_delta(pid,dict(delta,seq=self._seq,base=base[0]),gcids,snap)
+            if id(None) in groups:
+                snap = _delta_snapshot(state) if snap is None else snap
+                self._send_delta(pid,{"seq":self._seq,"full":snap},groups[id(None)][1],snap)
+    def _send_delta(self,pid,msg,cids,snap):
+        new = (self._seq,snap)
+        if not self.peer.is_server:
+            self.peer.send_message(pid,msg)
+            self._sent[None] = new
+            return
+        
+        if len(cids)>1:
+            pid,msg = self.peer.prepare(pid,msg),None
+        for cid in cids:
+            if cid not in self.peer.clients:
+                continue
+            self._sent[cid] = new
+            self.peer.send_message(pid,msg,cid)
+    
+    def reset(self,cid=None):
+        """
+        Forgets the baseline of the given peer, causing the next state to be sent in full.
+        
+        If ``cid`` is ``None``\ , all baselines are reset. This includes the baseline
+        of the server on the client side.
+        """
+        with self._delta_lock:
+            if cid is None:
+                self._sent.clear()
+            else:
+                self._sent.pop(cid,None)
+    def request_resync(self,cid=None):
+        """
+        Requests the peer to send the next state in full.
+        
+        All updates received until then are ignored.
+        """
+        with self._delta_lock:
+            self._recv[cid] = None
+        if cid is None:
+            self.peer.send_message(self.reg.getInt(self),{"resync":True})
+        else:
+            self.peer.send_message(self.reg.getInt(self),{"resync":True},cid)
+    
+    def _receive(self,msg,cid=None):
+        if "resync" in msg:
+            self.reset(cid)
+            return True
+        
+        with self._delta_lock:
+            cur = self._recv.get(cid,None)
+            if "full" in msg:
+                cur = self._recv[cid] = [msg["seq"],msg["full"]]
+            elif cur is None or cur[0]!=msg["base"]:
+                cur = False
+            else:
+                try:
+                    _delta_apply(cur[1],msg)
+                except KeyError:
+                    cur = False
+                else:
+                    cur[0] = msg["seq"]
+        
+        if cur is False:
+            # Out of sync, wait for a full update
+            if cid in self._recv and self._recv[cid] is None:
+                return False # already requested
+            self.request_resync(cid)
+            return False
+        return super()._receive(cur[1],cid)
+    _receive.__noautodoc__ = True
+
 class PrintPacket(Packet):
     """
     Simple dummy packet class that prints any message it receives.
@@ -36,11 +36,23 @@ Handshake
 
 Note that if a custom connection type is used, any steps after step 3. may be left out.
 
-1. Server sends a :py:class:`HelloPacket` with version information
-2. Client responds with :py:class:`SetTypePacket` containing connection type
-3. Server stores connection type and sends :py:class:`HandshakePacket` containing version and registry
-4. Client updates own registry based on packet and sends :py:class:`HandshakeAcceptPacket`
-5. Server receives packet and calls event handler to signal a successful handshake
+1. Server sends a :py:class:`HelloPacket` with version information and supported compression algorithms
+2. Client responds with :py:class:`SetTypePacket` containing connection type and chosen compression algorithm
+3. Server stores connection type and sends :py:class:`HandshakePacket` containing version, registry and key table
+4. Client updates own registry based on packet and sends :py:class:`HandshakeAcceptPacket`\ , accepting the key table if supported
+5. Server receives packet, activates the key table if accepted and calls event handler to signal a successful handshake
+
+Bundles
+=======
+
+If :confval:`net.send.batch` and :confval:`net.send.bundle` are enabled, packets
+collected for a peer are combined into a single bundle with the reserved packet ID ``17``\ .
+The payload of a bundle consists of the complete frames of the bundled packets,
+including their length prefix and header. Bundles may be compressed as a whole.
+
+The receiving side unpacks bundles before processing, handlers are called for every
+bundled packet in the order they have been sent. Bundles are only sent to peers
+that have announced support for them during the handshake.
 
 Connection shutdown
 ===================
@@ -63,6 +75,7 @@ __all__ = [
 from . import Packet, SmartPacket
 from ..constants import *
 from .. import version
+from .. import codec
 
 class HelloPacket(SmartPacket):
     """
@@ -72,6 +85,10 @@ class HelloPacket(SmartPacket):
     It contains version information for the client to check.
     
     If the client does not support the given protocol version, the connection must be aborted with the reason ``protoversionmismatch``\ .
+    
+    The ``compression`` field contains the names of all compression algorithms supported
+    by the server. The client chooses the first algorithm of :confval:`net.compress.algorithms`
+    that is also supported by the server, falling back to ``zlib``\ .
     """
     state = STATE_HELLOWAIT
     side = SIDE_CLIENT
@@ -86,7 +103,16 @@ class HelloPacket(SmartPacket):
         if self.peer.cfg["net.debug.print.connect"]:
             print("HELLO")
         
-        self.peer.send_message("peng3dnet:internal.settype",{"conntype":self.peer.target_conntype})
+        offered = msg.get("compression",["zlib"])
+        comp = "zlib"
+        for name in self.peer.cfg["net.compress.algorithms"]:
+            if name in offered and name in self.peer.compressions.reg_int_str.inv:
+                comp = name
+                break
+        
+        self.peer.send_message("peng3dnet:internal.settype",{"conntype":self.peer.target_conntype,"compression":comp})
+        self.peer.compression = comp
+        self.peer._compressor = self.peer.compressions.getAll(comp)
         
         self.peer.remote_state = STATE_WAITTYPE
         
@@ -105,6 +131,9 @@ class SetTypePacket(SmartPacket):
     If the server does not recognize the connection type, the connection must be aborted with the reason ``unknownconntype``\ .
     
     If no connection type is supplied, ``classic`` is substituted.
+    
+    The ``compression`` field contains the compression algorithm chosen by the client,
+    which is then used in both directions. If it is missing, ``zlib`` is used.
     """
     state = STATE_WAITTYPE
     side = SIDE_SERVER
@@ -116,6 +145,12 @@ class SetTypePacket(SmartPacket):
             return
         
         self.peer.clients[cid].conntype = t
+        
+        comp = msg.get("compression","zlib")
+        if comp in self.peer.compressions.reg_int_str.inv:
+            self.peer.clients[cid].compression = comp
+            self.peer.clients[cid]._compressor = self.peer.compressions.getAll(comp)
+        
         self.peer.conntypes[t].init(cid)
     receive.__noautodoc__ = True
     def send(self, msg, cid=None):
@@ -131,6 +166,11 @@ class HandshakePacket(SmartPacket):
     If the :confval:`net.registry.autosync` config value is true, the registry sent by the server will be adapted to the client.
     
     Note that only IDs are synced to names, objects will not be affected.
+    
+    If the server sends a key table and :confval:`net.keytable.enabled` is true,
+    the key table is accepted and used for all packets sent and received afterwards.
+    
+    If the ``bundle`` field is true, the server is able to receive bundles.
     """
     state = STATE_HANDSHAKE_WAIT1
     side = SIDE_CLIENT
@@ -162,7 +202,14 @@ class HandshakePacket(SmartPacket):
                     self.peer.registry.reg_int_str[pid]=name
                     self.peer.registry.reg_int_obj[pid]=obj
         
-        self.peer.send_message("peng3dnet:internal.handshake.accept",{"success":True})
+        accept = {"success":True,"bundle":True}
+        if "keytable" in msg and self.peer.cfg["net.keytable.enabled"]:
+            accept["keytable"] = True
+        # The server only uses the key table once it has received the acceptance
+        self.peer.send_message("peng3dnet:internal.handshake.accept",accept)
+        if "keytable" in accept:
+            self.peer.keytable = codec.KeyTable(msg["keytable"])
+        self.peer.bundle = msg.get("bundle",False)
         self.peer.on_handshake_complete()
         with self.peer._connected_condition:
             self.peer._connected_condition.notify_all()
@@ -173,13 +220,20 @@ class HandshakeAcceptPacket(SmartPacket):
     Internal packet sent by the client to indicate a successful handshake.
     
     Once this packet has been sent or received, the connection is established and can be used.
+    
+    If the ``keytable`` field is true, the client has accepted the key table sent with the :py:class:`HandshakePacket`\ .
+    If the ``bundle`` field is true, the client is able to receive bundles.
     """
     state = STATE_HANDSHAKE_WAIT1
     side = SIDE_SERVER
     invalid_action = "close"
     def receive(self,msg,cid=None):
         if msg["success"]:
-            self.peer.clients[cid].on_handshake_complete()
+            client = self.peer.clients[cid]
+            if msg.get("keytable",False):
+                client.keytable = client._keytable_offer
+            client.bundle = msg.get("bundle",False)
+            client.on_handshake_complete()
     receive.__noautodoc__ = True
 
 class CloseConnectionPacket(Packet):
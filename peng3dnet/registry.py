@@ -24,7 +24,7 @@
 
 __all__ = [
     "BaseRegistry",
-    "PacketRegistry",
+    "PacketRegistry","CodecRegistry","CompressionRegistry",
     ]
 
 import threading
@@ -37,6 +37,10 @@ else:
     HAVE_BIDICT = True
 
 from . import packet
+from . import codec
+from . import compression
+from . import errors
+from .constants import *
 
 class BaseRegistry(object):
     """
@@ -86,6 +90,13 @@ class BaseRegistry(object):
         
         self.nextid = 64 # allows for the first 64 IDs to be assigned manually
         self.idlock = threading.Lock()
+        
+        self.revision = 0
+        """
+        Counter increased every time an object is registered or deleted.
+        
+        May be used to invalidate data derived from the contents of this registry.
+        """
     
     def getNewID(self):
         """
@@ -117,6 +128,7 @@ class BaseRegistry(object):
         
         self.reg_int_obj[n]=obj
         self.reg_int_str[n]=name
+        self.revision+=1
     def registerObject(self,obj,n=None):
         """
         Same as :py:meth:`register()`\ , but extracts the string representation from the object's ``name`` attribute.
@@ -132,6 +144,7 @@ class BaseRegistry(object):
         intid = self.getID(obj)
         del self.reg_int_obj[intid]
         del self.reg_int_str[intid]
+        self.revision+=1
     
     def getName(self,obj):
         """
@@ -196,3 +209,63 @@ class PacketRegistry(BaseRegistry):
     Subclass of :py:class:`BaseRegistry` customized for storing :py:class:`~peng3dnet.packet.Packet` instances and instances of subclasses.
     """
     objtype = packet.Packet
+
+class CodecRegistry(BaseRegistry):
+    """
+    Subclass of :py:class:`BaseRegistry` customized for storing :py:class:`~peng3dnet.codec.Codec` instances.
+    
+    New instances of this class already contain the built-in codecs, using the
+    IDs defined by the :py:data:`~peng3dnet.constants.CODEC_*` constants.
+    
+    Codec IDs are stored in the packet header and thus limited to the range ``0-255``\ .
+    IDs below ``64`` are reserved for built-in codecs.
+    """
+    objtype = codec.Codec
+    def __init__(self,objtype=None):
+        super().__init__(objtype)
+        
+        self.register(codec.MsgpackCodec(),"msgpack",CODEC_MSGPACK)
+        self.register(codec.RawCodec(),"raw",CODEC_RAW)
+        self.register(codec.StructCodec(),"struct",CODEC_STRUCT)
+    def register(self,obj,name,n=None):
+        """
+        Same as :py:meth:`BaseRegistry.register()`\ , but ensures that the ID fits into the packet header.
+        
+        Raises a :py:exc:`~peng3dnet.errors.RegistryError` if the ID is not within the range ``0-255``\ .
+        """
+        if n is None:
+            n = self.getNewID()
+        if not 0<=n<=(FLAG_CODEC_MASK>>FLAG_CODEC_SHIFT):
+            raise errors.RegistryError("Codec ID %s does not fit into the packet header"%n)
+        super().register(obj,name,n)
+
+class CompressionRegistry(BaseRegistry):
+    """
+    Subclass of :py:class:`BaseRegistry` customized for storing :py:class:`~peng3dnet.compression.Compressor` instances.
+    
+    New instances of this class already contain all built-in compression algorithms
+    whose libraries are available, using the IDs defined by the :py:data:`~peng3dnet.constants.COMPRESSION_*` constants.
+    
+    Compression algorithm IDs are stored in the packet header and thus limited to the range ``0-7``\ .
+    """
+    objtype = compression.Compressor
+    def __init__(self,objtype=None):
+        super().__init__(objtype)
+        self.nextid = 4 # IDs 0-3 are reserved for built-in algorithms
+        
+        self.register(compression.ZlibCompressor(),"zlib",COMPRESSION_ZLIB)
+        if compression.HAVE_LZ4:
+            self.register(compression.LZ4Compressor(),"lz4",COMPRESSION_LZ4)
+        if compression.HAVE_ZSTD:
+            self.register(compression.ZstdCompressor(),"zstd",COMPRESSION_ZSTD)
+    def register(self,obj,name,n=None):
+        """
+        Same as :py:meth:`BaseRegistry.register()`\ , but ensures that the ID fits into the packet header.
+        
+        Raises a :py:exc:`~peng3dnet.errors.RegistryError` if the ID is not within the range ``0-7``\ .
+        """
+        if n is None:
+            n = self.getNewID()
+        if not 0<=n<=(FLAG_COMPRESSION_MASK>>FLAG_COMPRESSION_SHIFT):
+            raise errors.RegistryError("Compression algorithm ID %s does not fit into the packet header"%n)
+        super().register(obj,name,n)
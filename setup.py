@@ -51,6 +51,7 @@ setup(name='peng3dnet',
       url="https://github.com/not-na/peng3dnet",
       packages=['peng3dnet',"peng3dnet.packet","peng3dnet.ext"],
       install_requires=["msgpack~=1.0.0","bidict>=0.19.0"],
+      extras_require={"aoi":["numpy"],"numpy":["numpy"],"lz4":["lz4"],"zstd":["zstandard"]},
       provides=["peng3dnet"],
       setup_requires=['pytest-runner'],
       tests_require=['pytest'],
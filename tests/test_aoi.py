@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_aoi.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import pytest
+
+import peng3dnet
+from peng3dnet.ext import aoi
+
+@pytest.fixture(params=[True,False],ids=["numpy","python"])
+def index(request,monkeypatch):
+    if request.param and not aoi.HAVE_NUMPY:
+        pytest.skip("numpy not available")
+    monkeypatch.setattr(aoi,"HAVE_NUMPY",request.param)
+    return aoi.AreaOfInterest(None,cellsize=10,dims=2)
+
+def test_aoi_query(index):
+    for cid in range(100):
+        index.update(cid,(cid%10*5,cid//10*5))
+    
+    assert sorted(index.query((0,0),5))==[0,1,10]
+    assert sorted(index.query((20,20),2))==[44]
+    assert index.query((1000,1000),5)==[]
+    
+    res = index.query_many([(0,0),(22,22)],5)
+    assert [sorted(r) for r in res]==[[0,1,10],[44,45,54,55]]
+    
+    index.remove(0)
+    index.remove(44)
+    assert sorted(index.query((0,0),5))==[1,10]
+    assert index.get_position(99)==(45.0,45.0)
+
+def test_aoi_query_far(index):
+    for cid in range(10):
+        index.update(cid,(cid,cid))
+    for cid in range(10,1000):
+        index.update(cid,(1000+cid,1000+cid))
+    
+    # Clients in far away cells must not even be checked
+    checked = []
+    candidates = index._candidates
+    def f(low,high):
+        cids = candidates(low,high)
+        checked.extend(cids)
+        return cids
+    index._candidates = f
+    
+    assert sorted(index.query((0,0),3))==[0,1,2]
+    assert [sorted(r) for r in index.query_many([(0,0),(9,9),(5000,5000)],3)]==[[0,1,2],[7,8,9],[]]
+    assert checked and max(checked)<10
+
+def test_aoi_cell_change(index):
+    changes = []
+    index.on_cell_change = lambda cid,old,new: changes.append((cid,old,new))
+    
+    index.update(1,(1,1))
+    index.update(1,(2,2))
+    index.update(1,(12,2))
+    index.remove(1)
+    
+    assert changes==[(1,None,(0,0)),(1,(0,0),(1,0)),(1,(1,0),None)]
+    assert index.cells=={}
+
+class AOIServer(aoi.AOIServerMixin,peng3dnet.net.Server):
+    aoi_dims = 2
+    # Overrides broadcast() with another signature, like the simplechat example
+    def broadcast(self,msg,origin):
+        raise AssertionError("Must not be called by the library")
+
+def test_aoi_broadcast_near():
+    s = AOIServer()
+    calls = []
+    s._broadcast = lambda ptype,data,cids=None,exclude=None,predicate=None: calls.append((ptype,sorted(cids),exclude))
+    s.update_position(1,(0,0))
+    s.update_position(2,(1000,0))
+    
+    s.broadcast_near((1,1),5,"test:record",{"a":1},exclude=[3])
+    assert calls==[("test:record",[1],[3])]
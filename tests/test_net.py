@@ -0,0 +1,1024 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_net.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import os
+import time
+import array
+import socket
+import threading
+import collections
+import selectors
+import zlib
+
+import pytest
+
+import peng3dnet
+
+def frame(data):
+    return peng3dnet.net.STRUCT_LENGTH32.pack(len(data))+data
+
+def wait_for(f,timeout=5):
+    t = time.time()
+    while not f():
+        if time.time()-t>timeout:
+            raise AssertionError("Timed out")
+        time.sleep(0.005)
+
+def start_server(cfg=None):
+    # Binds to a free port on the loopback interface
+    s = peng3dnet.net.Server(addr=("127.0.0.1",0),cfg=cfg)
+    s.bind()
+    s.runAsync()
+    wait_for(lambda: s._is_started)
+    return s,s.sock.getsockname()[1]
+
+def recv_exact(sock,n):
+    data = bytearray()
+    while len(data)<n:
+        d = sock.recv(n-len(data))
+        if not d:
+            raise AssertionError("Connection closed")
+        data+=d
+    return bytes(data)
+
+def recv_frame(sock):
+    # Returns the header and the decoded body of the next frame
+    n, = peng3dnet.net.STRUCT_LENGTH32.unpack(recv_exact(sock,peng3dnet.net.STRUCT_LENGTH32.size))
+    data = recv_exact(sock,n)
+    pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+    return pid,flags,peng3dnet.net._unpackb(data[peng3dnet.net.STRUCT_HEADER.size:])
+
+def test_receivebuffer_feed():
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    
+    buf.feed(frame(b"abc")+frame(b"defg")[:3])
+    assert buf.next_frame()==b"abc"
+    assert buf.next_frame() is None
+    
+    buf.feed(frame(b"defg")[3:]+frame(b""))
+    assert buf.next_frame()==b"defg"
+    assert buf.next_frame()==b""
+    assert buf.next_frame() is None
+    assert len(buf)==0
+
+def test_receivebuffer_large():
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    data = bytes(range(256))*16
+    
+    # The dedicated buffer is only used if the length is known before the packet is complete
+    raw = frame(data)+frame(b"tail")
+    buf.feed(raw[:10])
+    assert buf.next_frame() is None
+    assert buf._frame is not None
+    
+    # The rest is fed in small pieces, the following packet ends up in the normal buffer
+    frames = []
+    for i in range(10,len(raw),7):
+        buf.feed(raw[i:i+7])
+        f = buf.next_frame()
+        while f is not None:
+            frames.append((i+7,f))
+            f = buf.next_frame()
+    assert [f for _,f in frames]==[data,b"tail"]
+    # Only returned once complete, without copying it out of the normal buffer
+    assert len(frame(data))<=frames[0][0]<len(frame(data))+7
+    assert isinstance(frames[0][1],bytearray)
+    assert buf._frame is None
+    assert len(buf)==0
+
+def test_receivebuffer_recv_into():
+    a,b = socket.socketpair()
+    try:
+        buf = peng3dnet.net.ReceiveBuffer(64)
+        data = b"x"*1000
+        
+        a.sendall(frame(b"small")+frame(data))
+        frames = []
+        while len(frames)<2:
+            assert buf.recv_into(b)>0
+            f = buf.next_frame()
+            while f is not None:
+                frames.append(f)
+                f = buf.next_frame()
+        assert frames==[b"small",data]
+        
+        a.close()
+        assert buf.recv_into(b)==0
+    finally:
+        a.close()
+        b.close()
+
+def test_receivebuffer_spool():
+    buf = peng3dnet.net.ReceiveBuffer(64,spool_threshold=256)
+    data = bytes(range(256))*4
+    
+    buf.feed(frame(data)[:100])
+    assert buf.next_frame() is None
+    buf.feed(frame(data)[100:])
+    
+    f = buf.next_frame()
+    assert isinstance(f,memoryview)
+    assert f==data
+
+def test_receivebuffer_maxlen():
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    
+    buf.feed(frame(b"x"*16)+frame(b"x"*17))
+    assert buf.next_frame(16)==b"x"*16
+    with pytest.raises(peng3dnet.errors.PacketTooLongError):
+        buf.next_frame(16)
+
+def test_server_maxlen_states():
+    s = peng3dnet.net.Server(cfg={"net.recv.maxlen.handshake":1024,"net.recv.maxlen.active":2048})
+    c = peng3dnet.net.ClientOnServer(s,None,None,0)
+    
+    # The limit is lifted once the connection type has been sent, the client may send before the server has seen its acceptance
+    for state in [peng3dnet.constants.STATE_INIT,peng3dnet.constants.STATE_HELLOWAIT,peng3dnet.constants.STATE_WAITTYPE]:
+        c.state = state
+        assert s.get_max_packetlength(c)==1024
+    for state in [peng3dnet.constants.STATE_HANDSHAKE_WAIT1,peng3dnet.constants.STATE_HANDSHAKE_WAIT2,
+                  peng3dnet.constants.STATE_ACTIVE,peng3dnet.constants.STATE_LOGGEDIN]:
+        c.state = state
+        assert s.get_max_packetlength(c)==2048
+
+def test_client_connect_refused():
+    # Find a port nobody listens on
+    s = socket.socket()
+    s.bind(("127.0.0.1",0))
+    port = s.getsockname()[1]
+    s.close()
+    
+    c = peng3dnet.net.Client(addr=("127.0.0.1",port))
+    c.runAsync()
+    try:
+        with pytest.raises(peng3dnet.errors.FailedConnectionError):
+            c.wait_for_connection(5)
+        assert c.connect_state=="failed"
+    finally:
+        c.stop()
+
+def test_send_queued_partial():
+    a,b = socket.socketpair()
+    try:
+        a.setblocking(False)
+        b.setblocking(False)
+        
+        bufs = [bytes([i%256])*(i*1000+1) for i in range(200)]
+        expected = b"".join(bufs)
+        q = collections.deque(bufs)
+        
+        offset = 0
+        received = bytearray()
+        while q:
+            offset = peng3dnet.net._send_queued(a,q,offset)
+            try:
+                while True:
+                    received+=b.recv(1024*1024)
+            except BlockingIOError:
+                pass
+        assert offset==0
+        try:
+            while True:
+                received+=b.recv(1024*1024)
+        except BlockingIOError:
+            pass
+        assert received==expected
+    finally:
+        a.close()
+        b.close()
+
+def test_waker_coalesce():
+    w = peng3dnet.net._Waker()
+    sel = selectors.DefaultSelector()
+    sel.register(w,selectors.EVENT_READ)
+    try:
+        assert sel.select(0)==[]
+        for i in range(100000):
+            w.wake()
+        assert len(sel.select(0))==1
+        w.drain()
+        assert sel.select(0)==[]
+        w.wake()
+        assert len(sel.select(0))==1
+    finally:
+        sel.close()
+
+def test_submission_from_thread():
+    s,port = start_server({"net.compress.enabled":False,"net.sock.sndbuf":4096})
+    rc = socket.socket()
+    rc.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,4096)
+    rc.settimeout(5)
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        cid = next(iter(s.clients))
+        big = os.urandom(1024*1024)
+        
+        sent = []
+        orig = s._apply_submissions
+        def apply():
+            orig()
+            if not sent:
+                # Another thread sends while the main loop is between applying submissions
+                # and handling events, the partial write must still register write interest
+                t = threading.Thread(target=s.send_message,args=("peng3dnet:internal.hello",{"big":big},cid))
+                t.start()
+                t.join()
+                sent.append(True)
+        s._apply_submissions = apply
+        s.interrupt()
+        wait_for(lambda: sent)
+        
+        assert "big" not in recv_frame(rc)[2]
+        assert recv_frame(rc)[2]["big"]==big
+    finally:
+        rc.close()
+        s.stop()
+
+@pytest.mark.parametrize("before",[True,False])
+def test_waker_wake_during_drain(monkeypatch,before):
+    w = peng3dnet.net._Waker()
+    sel = selectors.DefaultSelector()
+    sel.register(w,selectors.EVENT_READ)
+    
+    # Simulates another thread calling wake() while the main loop drains
+    def interleave(read):
+        def f(*args):
+            if before:
+                w.wake()
+            ret = read(*args)
+            if not before:
+                w.wake()
+            return ret
+        return f
+    if w._efd is not None:
+        monkeypatch.setattr(peng3dnet.net.os,"eventfd_read",interleave(peng3dnet.net.os.eventfd_read))
+    else:
+        class Sock(object):
+            recv = staticmethod(interleave(w._rsock.recv))
+        w._rsock = Sock()
+    
+    try:
+        w.wake()
+        w.drain()
+        monkeypatch.undo()
+        # Further wakeups must not be swallowed
+        w.wake()
+        assert len(sel.select(0))==1
+    finally:
+        sel.close()
+
+def test_encode_packet():
+    cfg = {"net.compress.enabled":True,"net.compress.threshold":1024,"net.compress.level":6}
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for msg in [{"a":1},{"b":"x"*4096}]:
+        for b in peng3dnet.net._encode_packet(70,msg,cfg):
+            buf.feed(b)
+        data = buf.next_frame()
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        body = memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:]
+        if flags&peng3dnet.constants.FLAG_COMPRESSED:
+            body = zlib.decompress(body)
+        assert pid==70
+        assert peng3dnet.net._unpackb(body)==msg
+
+def test_server_channels():
+    s = peng3dnet.net.Server()
+    clients = []
+    for cid in range(3):
+        c = peng3dnet.net.ClientOnServer(s,None,None,cid)
+        s.clients[cid] = c
+        clients.append(c)
+    
+    s.join_channel(0,"lobby")
+    s.join_channel(1,"lobby")
+    s.join_channel(1,"game")
+    assert s.get_channel_members("lobby")=={0,1}
+    assert clients[1].channels=={"lobby","game"}
+    
+    s.leave_channel(0,"lobby")
+    assert s.get_channel_members("lobby")=={1}
+    
+    s._leave_all_channels(clients[1])
+    assert s.channels=={}
+    assert clients[1].channels==set()
+
+def test_prepared_internal_cache():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    
+    msg = s._get_prepared_internal("peng3dnet:internal.handshake")
+    assert isinstance(msg,peng3dnet.net.PreparedMessage)
+    assert s._get_prepared_internal("peng3dnet:internal.handshake") is msg
+    
+    s.register_packet("test:packet",peng3dnet.packet.PrintPacket(s.registry,s))
+    newmsg = s._get_prepared_internal("peng3dnet:internal.handshake")
+    assert newmsg is not msg
+    assert "test:packet" in newmsg.data["registry"]
+
+class UpperCodec(peng3dnet.codec.Codec):
+    def encode(self,data,packet):
+        return data.upper().encode()
+    def decode(self,body,packet):
+        return bytes(body).decode()
+
+class UpperPacket(peng3dnet.packet.Packet):
+    codec = "upper"
+
+def test_codec_dispatch():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    s.register_codec("upper",UpperCodec())
+    s.register_packet("test:upper",UpperPacket(s.registry,s),70)
+    s.register_packet("test:default",peng3dnet.packet.Packet(s.registry,s),71)
+    
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for pid,msg,expected,codecid in [(70,"abc","ABC",64),(71,{"a":1},{"a":1},0)]:
+        for b in peng3dnet.net._encode_message(s,pid,msg):
+            buf.feed(b)
+        data = buf.next_frame()
+        rpid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        assert rpid==pid
+        assert (flags&peng3dnet.constants.FLAG_CODEC_MASK)>>peng3dnet.constants.FLAG_CODEC_SHIFT==codecid
+        body = memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:]
+        assert peng3dnet.net._decode_message(s,pid,flags,body)==expected
+    
+    with pytest.raises(peng3dnet.errors.RegistryError):
+        s.register_codec("toolarge",UpperCodec(),256)
+
+def test_binary_packet():
+    s = peng3dnet.net.Server(cfg={"net.compress.enabled":False})
+    s.initialize()
+    s.register_packet("test:binary",peng3dnet.packet.BinaryPacket(s.registry,s),70)
+    
+    payload = bytes(range(256))*256
+    bufs = peng3dnet.net._encode_message(s,70,payload)
+    assert bufs[-1] is payload
+    
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for b in bufs:
+        buf.feed(b)
+    data = buf.next_frame()
+    pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+    msg = peng3dnet.net._decode_message(s,pid,flags,memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:])
+    assert isinstance(msg,memoryview)
+    assert msg==payload
+    
+    with pytest.raises(TypeError):
+        peng3dnet.net._encode_message(s,70,{"a":1})
+    
+    # Views of other formats must be sent as bytes, the following packet must still be intact
+    ints = array.array("i",range(1000))
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for b in peng3dnet.net._encode_message(s,70,memoryview(ints))+peng3dnet.net._encode_message(s,70,b"next"):
+        buf.feed(b)
+    for expected in [ints.tobytes(),b"next"]:
+        data = buf.next_frame()
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        assert peng3dnet.net._decode_message(s,pid,flags,memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:])==expected
+    assert buf.next_frame() is None
+
+class PositionPacket(peng3dnet.packet.StructPacket):
+    fields = [("eid","I"),("x","f"),("name","4s")]
+
+class PositionsPacket(PositionPacket):
+    array = True
+
+def test_struct_packet():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    s.register_packet("test:pos",PositionPacket(s.registry,s),70)
+    s.register_packet("test:poss",PositionsPacket(s.registry,s),71)
+    
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    def roundtrip(pid,msg):
+        for b in peng3dnet.net._encode_message(s,pid,msg):
+            buf.feed(b)
+        data = buf.next_frame()
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        return peng3dnet.net._decode_message(s,pid,flags,memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:])
+    
+    msg = roundtrip(70,{"eid":3,"x":1.5,"name":b"abcd"})
+    assert msg==(3,1.5,b"abcd")
+    assert msg.eid==3 and msg.x==1.5
+    assert roundtrip(70,(4,2.0,b"efgh")).eid==4
+    
+    msgs = roundtrip(71,[(i,i/2,b"abcd") for i in range(10)])
+    assert len(msgs)==10
+    assert msgs[9].eid==9 and msgs[9].x==4.5
+    assert roundtrip(71,[])==[]
+    
+    class BadPacket(peng3dnet.packet.StructPacket):
+        fields = [("pos","3f")]
+    with pytest.raises(ValueError):
+        BadPacket(s.registry,s)
+
+def test_msgpack_ndarray():
+    numpy = pytest.importorskip("numpy")
+    
+    a = numpy.arange(24,dtype=numpy.float32).reshape((2,3,4))
+    msg = {"heightmap":a,"t":a.T,"empty":numpy.zeros((0,3),dtype="<i8"),"n":numpy.int16(5)}
+    
+    c = peng3dnet.codec.MsgpackCodec()
+    out = c.decode(memoryview(bytes(c.encode(msg,None))),None)
+    
+    assert out["heightmap"].dtype==numpy.float32 and out["heightmap"].shape==(2,3,4)
+    assert (out["heightmap"]==a).all()
+    assert (out["t"]==a.T).all()
+    assert out["empty"].shape==(0,3)
+    assert out["n"]==5
+    
+    with pytest.raises(TypeError):
+        c.encode({"o":numpy.array([object()])},None)
+
+class KeyedPacket(peng3dnet.packet.Packet):
+    fieldnames = ["origin","message"]
+
+def test_keytable():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    s.register_packet("test:keyed",KeyedPacket(s.registry,s),70)
+    
+    kt = s.get_keytable()
+    assert kt.keys==["message","origin"]
+    assert s.get_keytable() is kt
+    
+    msg = {"origin":"bob","message":"hi","other":[{"origin":1}],"t":(1,2)}
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for b in peng3dnet.net._encode_message(s,70,msg,kt):
+        buf.feed(b)
+    data = buf.next_frame()
+    pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+    assert flags&peng3dnet.constants.FLAG_KEYTABLE
+    body = memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:]
+    assert peng3dnet.net._decode_message(s,pid,flags,body,kt)=={"origin":"bob","message":"hi","other":[{"origin":1}],"t":[1,2]}
+    assert kt.restore(kt.replace(msg))["other"]==[{"origin":1}]
+    
+    with pytest.raises(ValueError):
+        peng3dnet.net._decode_message(s,pid,flags,body)
+    
+    # Integer keys cannot be told apart from replaced keys, the key table is not used
+    msg = {"origin":"bob","message":{0:"a",1:"b",7:"c"}}
+    with pytest.raises(ValueError):
+        kt.replace(msg)
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for b in peng3dnet.net._encode_message(s,70,msg,kt):
+        buf.feed(b)
+    data = buf.next_frame()
+    pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+    assert not flags&peng3dnet.constants.FLAG_KEYTABLE
+    assert peng3dnet.net._decode_message(s,pid,flags,memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:],kt)==msg
+
+def test_bundle():
+    cfg = {"net.compress.enabled":True,"net.compress.threshold":1024,"net.compress.level":6,"net.send.bundle.maxsize":4096}
+    msgs = [{"i":i,"s":"x"*50} for i in range(100)]
+    
+    queue = collections.deque()
+    bundler = peng3dnet.net._Bundler()
+    for msg in msgs:
+        bundler.add(peng3dnet.net._encode_packet(70,msg,cfg),queue,cfg)
+    bundler.close(queue,cfg)
+    # A packet exceeding the maximum size is sent on its own
+    bundler.add(peng3dnet.net._encode_packet(71,{"big":"y"*5000},cfg),queue,cfg)
+    bundler.close(queue,cfg)
+    
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    for b in queue:
+        buf.feed(b)
+    frames = []
+    while True:
+        data = buf.next_frame()
+        if data is None:
+            break
+        frames.append(data)
+    assert 1<len(frames)<10
+    
+    s = peng3dnet.net.Server()
+    c = peng3dnet.net.ClientOnServer(s,None,None,0)
+    c.state = peng3dnet.constants.STATE_ACTIVE
+    out = []
+    for data in peng3dnet.net._iter_frames(s,frames,c):
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        body = memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:]
+        if flags&peng3dnet.constants.FLAG_COMPRESSED:
+            body = zlib.decompress(body)
+        out.append(peng3dnet.net._unpackb(body))
+    assert out==msgs+[{"big":"y"*5000}]
+
+def test_bundle_compression():
+    cfg = {"net.compress.enabled":True,"net.compress.threshold":1024,"net.compress.level":6,"net.compress.lz4.level":0,"net.compress.zstd.level":3,
+           "net.send.bundle.maxsize":4096}
+    s = peng3dnet.net.Server()
+    msgs = [{"i":i,"s":"x"*50} for i in range(300)]
+    
+    for cid in s.compressions.reg_int_str.keys():
+        compressor = s.compressions.getAll(cid)
+        queue = collections.deque()
+        bundler = peng3dnet.net._Bundler()
+        for msg in msgs:
+            bundler.add(peng3dnet.net._encode_packet(70,msg,cfg),queue,cfg,compressor)
+        
+        # Bundles sealed because they grew too large use the negotiated algorithm
+        data = b"".join(queue)
+        bundles = 0
+        off = 0
+        while off<len(data):
+            n, = peng3dnet.net.STRUCT_LENGTH32.unpack_from(data,off)
+            off+=peng3dnet.net.STRUCT_LENGTH32.size
+            pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data,off)
+            assert pid==peng3dnet.net._PID_BUNDLE
+            assert flags&peng3dnet.constants.FLAG_COMPRESSED
+            assert (flags&peng3dnet.constants.FLAG_COMPRESSION_MASK)>>peng3dnet.constants.FLAG_COMPRESSION_SHIFT==cid
+            off+=n
+            bundles+=1
+        assert bundles>1
+
+def test_compression():
+    s = peng3dnet.net.Server(cfg={"net.recv.maxlen.handshake":1024,"net.recv.maxlen.active":64*1024})
+    c = peng3dnet.net.ClientOnServer(s,None,None,0)
+    c.state = peng3dnet.constants.STATE_ACTIVE
+    cfg = {"net.compress.enabled":True,"net.compress.threshold":1024,"net.compress.level":6,"net.compress.lz4.level":0,"net.compress.zstd.level":3}
+    msg = {"data":"abc"*1000}
+    
+    # All available algorithms can be received, regardless of the negotiated one
+    for cid in s.compressions.reg_int_str.keys():
+        bufs = peng3dnet.net._encode_packet(70,msg,cfg,compressor=s.compressions.getAll(cid))
+        data = b"".join(bufs)[peng3dnet.net.STRUCT_LENGTH32.size:]
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        assert flags&peng3dnet.constants.FLAG_COMPRESSED
+        assert (flags&peng3dnet.constants.FLAG_COMPRESSION_MASK)>>peng3dnet.constants.FLAG_COMPRESSION_SHIFT==cid
+        body = peng3dnet.net._decompress(s,flags,memoryview(data)[peng3dnet.net.STRUCT_HEADER.size:],c)
+        assert peng3dnet.net._unpackb(body)==msg
+        
+        # Decompressing is limited to the maximum packet length, without decompressing everything first
+        compobj = s.compressions.getObj(cid)
+        bomb = compobj.compress(bytes(64*1024+1),cfg)
+        assert compobj.decompress(bomb)==bytes(64*1024+1)
+        with pytest.raises(ValueError):
+            compobj.decompress(bomb,64*1024)
+        assert compobj.decompress(compobj.compress(bytes(64*1024),cfg),64*1024)==bytes(64*1024)
+        with pytest.raises(Exception):
+            compobj.decompress(bomb[:-8],64*1024)
+        flags = peng3dnet.constants.FLAG_COMPRESSED|(cid<<peng3dnet.constants.FLAG_COMPRESSION_SHIFT)
+        with pytest.raises(ValueError):
+            peng3dnet.net._decompress(s,flags,bomb,c)
+        
+        # Compressed packets are not accepted during the handshake
+        c.state = peng3dnet.constants.STATE_WAITTYPE
+        with pytest.raises(ValueError):
+            peng3dnet.net._decompress(s,flags,compobj.compress(b"x"*2000,cfg),c)
+        c.state = peng3dnet.constants.STATE_ACTIVE
+    
+    # zlib must stay at ID 0 for compatibility with older peers
+    assert s.compressions.getObj(0).__class__ is peng3dnet.compression.ZlibCompressor
+    with pytest.raises(peng3dnet.errors.RegistryError):
+        s.compressions.register(peng3dnet.compression.ZlibCompressor(),"toolarge",8)
+
+class RecordPacket(peng3dnet.packet.Packet):
+    def __init__(self,reg,peer):
+        super().__init__(reg,peer)
+        self.received = []
+        self.sent = []
+    def receive(self,msg,cid=None):
+        self.received.append(msg)
+    def send(self,msg,cid=None):
+        self.sent.append(cid)
+
+def socket_clients(s,n,state=peng3dnet.constants.STATE_ACTIVE):
+    # Adds clients connected via socket pairs, returns the remote ends
+    peers = []
+    for cid in range(n):
+        conn,peer = socket.socketpair()
+        conn.setblocking(False)
+        peer.setblocking(False)
+        c = peng3dnet.net.ClientOnServer(s,conn,None,cid)
+        c.conntype = peng3dnet.constants.CONNTYPE_CLASSIC
+        c.state = state
+        s.clients[cid] = c
+        peers.append(peer)
+    return peers
+
+def read_available(sock,keytable=None):
+    # Returns all messages that have been received so far
+    buf = peng3dnet.net.ReceiveBuffer(64)
+    try:
+        while True:
+            buf.feed(sock.recv(1024*1024))
+    except BlockingIOError:
+        pass
+    out = []
+    while True:
+        data = buf.next_frame()
+        if data is None:
+            return out
+        pid,flags = peng3dnet.net.STRUCT_HEADER.unpack_from(data)
+        body = data[peng3dnet.net.STRUCT_HEADER.size:]
+        out.append(keytable.decode(body) if flags&peng3dnet.constants.FLAG_KEYTABLE else peng3dnet.net._unpackb(body))
+
+def test_process_bad_frames(capsys):
+    s = peng3dnet.net.Server()
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    s.register_packet("test:record",pkt,70)
+    c = peng3dnet.net.ClientOnServer(s,None,None,0)
+    c.conntype = peng3dnet.constants.CONNTYPE_CLASSIC
+    c.state = peng3dnet.constants.STATE_ACTIVE
+    s.clients[0] = c
+    
+    def frames(bufs):
+        return b"".join(bufs)[peng3dnet.net.STRUCT_LENGTH32.size:]
+    good = frames(peng3dnet.net._encode_packet(70,{"a":1},s.cfg))
+    # Unknown compression algorithm
+    badcomp = peng3dnet.net.STRUCT_HEADER.pack(70,peng3dnet.constants.FLAG_COMPRESSED|peng3dnet.constants.FLAG_COMPRESSION_MASK)+b"xyz"
+    badbundle = peng3dnet.net.STRUCT_HEADER.pack(peng3dnet.net._PID_BUNDLE,peng3dnet.constants.FLAG_COMPRESSED)+b"not zlib"
+    
+    # A single batch, as handed off by the main loop
+    s.receive_packets([good,b"x",badcomp,badbundle,good],0)
+    s.process()
+    assert pkt.received==[{"a":1},{"a":1}]
+    assert capsys.readouterr().err.count("Traceback")==3
+    
+    # The client must not raise out of process() either
+    cl = peng3dnet.net.Client()
+    cl.initialize()
+    pkt = RecordPacket(cl.registry,cl)
+    cl.register_packet("test:record",pkt,70)
+    cl.receive_packets([good,b"x",badcomp,badbundle,good])
+    cl.process()
+    assert pkt.received==[{"a":1},{"a":1}]
+    assert capsys.readouterr().err.count("Traceback")==3
+
+def test_broadcast():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    s.register_packet("test:record",pkt,70)
+    peers = socket_clients(s,4)
+    s.clients[3].state = peng3dnet.constants.STATE_WAITTYPE
+    
+    def check(n,expected):
+        assert n==len(expected)
+        # Send handlers are called once for every recipient
+        assert pkt.sent==expected
+        del pkt.sent[:]
+        for cid,peer in enumerate(peers):
+            assert read_available(peer)==([{"a":1}] if cid in expected else [])
+    
+    # Only clients that have completed the handshake by default
+    check(s.broadcast("test:record",{"a":1}),[0,1,2])
+    check(s.broadcast("test:record",{"a":1},cids=[1,3]),[1,3])
+    check(s.broadcast("test:record",{"a":1},exclude=[0]),[1,2])
+    check(s.broadcast("test:record",{"a":1},predicate=lambda c: c.cid%2==0),[0,2])
+    check(s.broadcast(s.prepare("test:record",{"a":1}),None,cids=[0,1,2,3],exclude=[1],predicate=lambda c: c.cid>0),[2,3])
+
+class ChatServer(peng3dnet.net.Server):
+    # Overrides broadcast() with another signature, like the simplechat example
+    def broadcast(self,msg,origin):
+        raise AssertionError("Must not be called by the library")
+
+def test_publish_overridden_broadcast():
+    s = ChatServer()
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    s.register_packet("test:record",pkt,70)
+    peers = socket_clients(s,3)
+    s.join_channel(0,"lobby")
+    s.join_channel(2,"lobby")
+    
+    assert s.publish("lobby","test:record",{"a":1},exclude=[2])==1
+    assert [read_available(peer) for peer in peers]==[[{"a":1}],[],[]]
+
+def test_broadcast_encode_once(monkeypatch):
+    s = peng3dnet.net.Server()
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    pkt.fieldnames = ["a"]
+    s.register_packet("test:record",pkt,70)
+    peers = socket_clients(s,4)
+    for cid in range(3):
+        s.clients[cid].keytable = s.get_keytable()
+    
+    encoded = []
+    encode = peng3dnet.net._encode_message
+    def f(peer,pid,data,keytable=None,compressor=None):
+        encoded.append(keytable)
+        return encode(peer,pid,data,keytable,compressor)
+    monkeypatch.setattr(peng3dnet.net,"_encode_message",f)
+    
+    # Only the variants needed by the recipients are encoded
+    s.broadcast("test:record",{"a":1},cids=[0,1,2])
+    assert encoded==[s.get_keytable()]
+    del encoded[:]
+    s.broadcast("test:record",{"a":1})
+    assert sorted(encoded,key=lambda k: k is None)==[s.get_keytable(),None]
+    
+    assert [read_available(peer,s.get_keytable()) for peer in peers]==[[{"a":1}]*2]*3+[[{"a":1}]]
+
+def test_send_direct():
+    s = peng3dnet.net.Server()
+    s.initialize()
+    peers = socket_clients(s,1)
+    c = s.clients[0]
+    
+    # Written by the calling thread, the main loop is not involved
+    s.send_message("peng3dnet:internal.hello",{"a":1},0)
+    assert len(c.write_queue)==0
+    assert not c._write_registered
+    assert len(s._submit_queue)==0
+    assert read_available(peers[0])==[{"a":1}]
+
+def test_send_partial():
+    s,port = start_server({"net.compress.enabled":False,"net.sock.sndbuf":4096})
+    rc = socket.socket()
+    rc.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,4096)
+    rc.settimeout(5)
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        c = next(iter(s.clients.values()))
+        assert "big" not in recv_frame(rc)[2]
+        
+        # The socket cannot accept everything, the rest is left to the main loop
+        big = os.urandom(1024*1024)
+        s.send_message("peng3dnet:internal.hello",{"big":big},c.cid)
+        assert c._write_registered
+        assert recv_frame(rc)[2]["big"]==big
+        wait_for(lambda: not c._write_registered)
+        assert len(c.write_queue)==0
+    finally:
+        rc.close()
+        s.stop()
+
+def test_close_after_send():
+    s,port = start_server({"net.compress.enabled":False,"net.sock.sndbuf":4096})
+    rc = socket.socket()
+    rc.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,4096)
+    rc.settimeout(5)
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        cid = next(iter(s.clients))
+        assert "big" not in recv_frame(rc)[2]
+        
+        # Everything queued before closing must still be sent
+        big = os.urandom(1024*1024)
+        s.send_message("peng3dnet:internal.hello",{"big":big},cid)
+        s.close_connection(cid,"bye")
+        assert recv_frame(rc)[2]["big"]==big
+        assert recv_frame(rc)[2]=={"reason":"bye"}
+        assert rc.recv(1)==b""
+        wait_for(lambda: cid not in s.clients)
+    finally:
+        rc.close()
+        s.stop()
+
+def test_flush():
+    s = peng3dnet.net.Server(cfg={"net.send.batch":True,"net.send.batch.maxdelay":None})
+    s.initialize()
+    s.register_packet("test:record",RecordPacket(s.registry,s),70)
+    peers = socket_clients(s,2)
+    
+    for cid in range(2):
+        s.send_message("test:record",{"a":cid},cid)
+        s.send_message("test:record",{"b":cid},cid)
+    assert [read_available(peer) for peer in peers]==[[],[]]
+    
+    s.flush(0)
+    assert [read_available(peer) for peer in peers]==[[{"a":0},{"b":0}],[]]
+    s.flush_all()
+    assert [read_available(peer) for peer in peers]==[[],[{"a":1},{"b":1}]]
+    
+    # Internal packets are sent immediately, together with everything collected so far
+    s.send_message("test:record",{"a":0},0)
+    s.send_message("peng3dnet:internal.hello",{"c":0},0)
+    assert read_available(peers[0])==[{"a":0},{"c":0}]
+
+def test_flush_maxdelay():
+    s,port = start_server({"net.send.batch":True,"net.send.batch.maxdelay":0.05})
+    s.register_packet("test:record",RecordPacket(s.registry,s),70)
+    rc = socket.socket()
+    rc.settimeout(5)
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        cid = next(iter(s.clients))
+        s.clients[cid].conntype = peng3dnet.constants.CONNTYPE_CLASSIC
+        recv_frame(rc)
+        
+        # Flushed by the main loop once the deadline has passed
+        t = time.time()
+        s.send_message("test:record",{"a":1},cid)
+        assert recv_frame(rc)[2]=={"a":1}
+        assert time.time()-t>=0.04
+    finally:
+        rc.close()
+        s.stop()
+
+@pytest.mark.skipif(not peng3dnet.net.HAVE_CORK,reason="TCP_CORK not supported")
+def test_cork(monkeypatch):
+    calls = []
+    cork = peng3dnet.net._cork
+    def record_cork(sock,value):
+        calls.append(value)
+        cork(sock,value)
+    monkeypatch.setattr(peng3dnet.net,"_cork",record_cork)
+    
+    s,port = start_server({"net.send.batch":True,"net.send.batch.maxdelay":None,"net.sock.cork":True})
+    s.register_packet("test:record",RecordPacket(s.registry,s),70)
+    rc = socket.socket()
+    rc.settimeout(5)
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        c = next(iter(s.clients.values()))
+        c.conntype = peng3dnet.constants.CONNTYPE_CLASSIC
+        recv_frame(rc)
+        
+        # Corked once per batch, until the batch has been written
+        for i in range(10):
+            s.send_message("test:record",{"a":i},c.cid)
+        assert calls==[True]
+        assert c.conn.getsockopt(socket.IPPROTO_TCP,socket.TCP_CORK)
+        s.flush(c.cid)
+        assert calls==[True,False]
+        assert not c.conn.getsockopt(socket.IPPROTO_TCP,socket.TCP_CORK)
+        assert [recv_frame(rc)[2] for i in range(10)]==[{"a":i} for i in range(10)]
+    finally:
+        rc.close()
+        s.stop()
+
+def test_socket_options():
+    s,port = start_server({"net.sock.nodelay":True,"net.sock.sndbuf":32768,"net.sock.rcvbuf":32768})
+    rc = socket.socket()
+    rc.connect(("127.0.0.1",port))
+    try:
+        wait_for(lambda: len(s.clients)==1)
+        conn = next(iter(s.clients.values())).conn
+        assert conn.getsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY)
+        # Some platforms double the given sizes
+        assert conn.getsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF)>=32768
+        assert conn.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF)>=32768
+    finally:
+        rc.close()
+        s.stop()
+
+def test_read_without_ssl(monkeypatch):
+    # The read loops are shared with SSL sockets, but must not depend on the ssl module
+    monkeypatch.delattr(peng3dnet.net,"ssl")
+    s = peng3dnet.net.Server()
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    s.register_packet("test:record",pkt,70)
+    peers = socket_clients(s,1)
+    c = s.clients[0]
+    
+    peers[0].sendall(b"".join(peng3dnet.net._encode_packet(70,{"a":1},s.cfg)))
+    assert s._read_client(c.conn,c)
+    # Nothing left to read
+    assert s._read_client(c.conn,c)
+    s.process()
+    assert pkt.received==[{"a":1}]
+    
+    cl = peng3dnet.net.Client()
+    a,b = socket.socketpair()
+    try:
+        a.setblocking(False)
+        cl._read_sock(a)
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.parametrize("budget,minreads",[(1024*1024,1),(4096,5)])
+def test_read_budget(budget,minreads):
+    s = peng3dnet.net.Server(cfg={"net.recv.bufsize":1024,"net.recv.budget":budget})
+    s.initialize()
+    pkt = RecordPacket(s.registry,s)
+    s.register_packet("test:record",pkt,70)
+    peers = socket_clients(s,1)
+    c = s.clients[0]
+    
+    msgs = [{"i":i,"s":"x"*1000} for i in range(20)]
+    for msg in msgs:
+        peers[0].sendall(b"".join(peng3dnet.net._encode_packet(70,msg,s.cfg)))
+    
+    # Each call reads until the socket would block or the budget is used up
+    reads = 0
+    while len(pkt.received)<len(msgs):
+        assert s._read_client(c.conn,c)
+        reads+=1
+        s.process()
+        assert reads<=50
+    assert pkt.received==msgs
+    assert reads>=minreads
+    if budget>=1024*1024:
+        assert reads==1
+
+class EchoPacket(peng3dnet.packet.SmartPacket):
+    fieldnames = ["i","text","big"]
+    def __init__(self,reg,peer):
+        super().__init__(reg,peer)
+        self.received = []
+    def receive(self,msg,cid=None):
+        self.received.append(msg)
+        if self.peer.is_server:
+            self.peer.send_message("test:echo",msg,cid)
+
+def test_loopback():
+    s = peng3dnet.net.Server(addr=("127.0.0.1",0))
+    spkt = EchoPacket(s.registry,s)
+    s.register_packet("test:echo",spkt)
+    s.bind()
+    s.runAsync()
+    s.process_async()
+    wait_for(lambda: s._is_started)
+    
+    c = peng3dnet.net.Client(addr=("127.0.0.1",s.sock.getsockname()[1]))
+    cpkt = EchoPacket(c.registry,c)
+    c.register_packet("test:echo",cpkt)
+    try:
+        c.runAsync()
+        c.process_async()
+        c.wait_for_connection(5)
+        wait_for(lambda: len(s.clients)==1 and next(iter(s.clients.values())).state==peng3dnet.constants.STATE_ACTIVE)
+        sc = next(iter(s.clients.values()))
+        
+        # Both sides agree on the preferred compression, key table and bundling
+        comp = next(name for name in c.cfg["net.compress.algorithms"] if name in c.compressions.reg_int_str.inv)
+        assert c.compression==comp
+        assert sc.compression==comp
+        assert c.keytable is not None and sc.keytable is not None
+        assert c.keytable.keys==sc.keytable.keys
+        assert "text" in c.keytable.keys
+        assert c.bundle and sc.bundle
+        assert c.registry.getInt("test:echo")==s.registry.getInt("test:echo")
+        
+        msgs = [{"i":i,"text":"x"*(i*100)} for i in range(50)]
+        msgs.append({"i":50,"big":os.urandom(3*1024*1024)})
+        for msg in msgs:
+            c.send_message("test:echo",msg)
+        wait_for(lambda: len(cpkt.received)==len(msgs),timeout=20)
+        assert spkt.received==msgs
+        assert cpkt.received==msgs
+        
+        c.close_connection(reason="done")
+        wait_for(lambda: len(s.clients)==0)
+    finally:
+        c.stop()
+        s.stop()
+
+def test_send_after_connect():
+    s = peng3dnet.net.Server(addr=("127.0.0.1",0))
+    spkt = EchoPacket(s.registry,s)
+    s.register_packet("test:echo",spkt)
+    s.bind()
+    s.runAsync()
+    wait_for(lambda: s._is_started)
+    
+    # Packets are processed slowly, like in a game loop
+    running = [True]
+    def tick():
+        while running[0]:
+            s.process()
+            time.sleep(0.05)
+    t = threading.Thread(target=tick,daemon=True)
+    t.start()
+    
+    c = peng3dnet.net.Client(addr=("127.0.0.1",s.sock.getsockname()[1]))
+    cpkt = EchoPacket(c.registry,c)
+    c.register_packet("test:echo",cpkt)
+    try:
+        c.runAsync()
+        c.process_async()
+        c.wait_for_connection(5)
+        
+        # The server may not have processed the handshake acceptance yet
+        msg = {"i":0,"big":os.urandom(200*1024)}
+        c.send_message("test:echo",msg)
+        wait_for(lambda: len(cpkt.received)==1)
+        assert spkt.received==[msg]
+        assert cpkt.received==[msg]
+    finally:
+        running[0] = False
+        c.stop()
+        s.stop()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_packet.py
+#  
+#  Copyright 2017 notna <notna@apparat.org>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import copy
+
+import peng3dnet
+from peng3dnet.packet import _delta_diff, _delta_apply
+from peng3dnet.constants import *
+
+def test_delta_roundtrip():
+    old = {"tick":1,"ents":{"1":{"x":1,"y":2},"2":{"x":3}},"l":[1,2],"gone":True}
+    new = copy.deepcopy(old)
+    new["tick"] = 2
+    new["ents"]["1"]["x"] = 5
+    del new["ents"]["2"]
+    new["l"].append(3)
+    del new["gone"]
+    new["added"] = {"a":1}
+    
+    snap,delta = _delta_diff(old,new)
+    assert snap==new
+    assert delta=={
+        "set":{"tick":2,"l":[1,2,3],"added":{"a":1}},
+        "del":["gone"],
+        "sub":{"ents":{"del":["2"],"sub":{"1":{"set":{"x":5}}}}},
+        }
+    
+    # Snapshots are independent of later modifications
+    new["ents"]["1"]["y"] = 7
+    assert snap["ents"]["1"]["y"]==2
+    
+    state = copy.deepcopy(old)
+    _delta_apply(state,delta)
+    assert state==snap
+    
+    # Unchanged subtrees are shared with the old snapshot
+    snap2,delta2 = _delta_diff(snap,snap)
+    assert delta2=={}
+    assert snap2["ents"] is snap["ents"]
+
+class StatePacket(peng3dnet.packet.DeltaPacket):
+    def __init__(self,reg,peer):
+        super().__init__(reg,peer)
+        self.states = []
+    def receive(self,msg,cid=None):
+        self.states.append(copy.deepcopy(msg))
+
+def roundtrip(data):
+    # Messages are encoded and decoded like on a real connection
+    return peng3dnet.net._unpackb(bytes(peng3dnet.codec.MsgpackCodec().encode(data,None)))
+
+def delta_peers(n):
+    # Connects a server with n clients via an in-memory wire
+    s = peng3dnet.net.Server()
+    s.initialize()
+    sp = StatePacket(s.registry,s)
+    s.register_packet("test:state",sp,70)
+    
+    wire = []
+    drop = set()
+    def server_send(ptype,data,cid):
+        if isinstance(ptype,peng3dnet.net.PreparedMessage):
+            data = ptype.data
+        wire.append((cid,data))
+        if cid in drop:
+            drop.discard(cid)
+            return
+        clients[cid][1]._receive(roundtrip(data),None)
+    s.send_message = server_send
+    
+    clients = []
+    for cid in range(n):
+        c = peng3dnet.net.Client()
+        c.initialize()
+        cp = StatePacket(c.registry,c)
+        c.register_packet("test:state",cp,70)
+        c.remote_state = STATE_ACTIVE
+        c.send_message = lambda ptype,data,cid=None,_cid=cid: sp._receive(roundtrip(data),_cid)
+        
+        soc = peng3dnet.net.ClientOnServer(s,None,None,cid)
+        soc.state = STATE_ACTIVE
+        soc.conntype = CONNTYPE_CLASSIC
+        s.clients[cid] = soc
+        clients.append((c,cp))
+    return s,sp,clients,wire,drop
+
+def test_delta_sync():
+    s,sp,clients,wire,drop = delta_peers(2)
+    state = {"tick":0,"ents":{"1":{"x":1},"2":{"x":2}}}
+    
+    sp.broadcast_state(state)
+    assert [sorted(msg) for _,msg in wire]==[["full","seq"]]*2
+    
+    # Clients sharing a baseline receive the same delta, computed and encoded once
+    del wire[:]
+    state["tick"] = 1
+    state["ents"]["1"]["x"] = 5
+    sp.broadcast_state(state)
+    assert wire[0][1] is wire[1][1]
+    assert wire[0][1]=={"seq":2,"base":1,"set":{"tick":1},"sub":{"ents":{"sub":{"1":{"set":{"x":5}}}}}}
+    for c,cp in clients:
+        assert cp.states[-1]==state
+    
+    # Nothing is sent if nothing has changed
+    del wire[:]
+    sp.broadcast_state(state)
+    assert wire==[]
+    
+    # Client to server
+    clients[0][1].send_state({"a":1,"b":1})
+    clients[0][1].send_state({"a":2,"b":1})
+    assert sp.states==[{"a":1,"b":1},{"a":2,"b":1}]
+
+def test_delta_resync():
+    s,sp,clients,wire,drop = delta_peers(2)
+    state = {"tick":0,"x":0}
+    sp.broadcast_state(state)
+    
+    # The update is lost for client 1, the following one does not match its baseline
+    drop.add(1)
+    state["tick"] = 1
+    sp.broadcast_state(state)
+    state["tick"] = 2
+    sp.broadcast_state(state)
+    assert clients[0][1].states[-1]==state
+    assert clients[1][1].states[-1]=={"tick":0,"x":0}
+    # The resync request has reset the baseline of client 1 on the server
+    assert 1 not in sp._sent
+    
+    # Client 0 still receives a delta, client 1 the full state
+    del wire[:]
+    state["tick"] = 3
+    sp.broadcast_state(state)
+    assert sorted(wire[0][1])==["base","seq","set"]
+    assert sorted(wire[1][1])==["full","seq"]
+    for c,cp in clients:
+        assert cp.states[-1]==state
+    
+    # Manual resync and reset
+    clients[0][1].request_resync()
+    sp.reset(1)
+    del wire[:]
+    state["x"] = 1
+    sp.broadcast_state(state)
+    assert [sorted(msg) for _,msg in wire]==[["full","seq"]]*2
+    for c,cp in clients:
+        assert cp.states[-1]==state
+    
+    # Baselines of disconnected clients are forgotten
+    del s.clients[1]
+    state["x"] = 2
+    sp.broadcast_state(state)
+    assert sorted(sp._sent)==[0]